@@ -0,0 +1,109 @@
+"""
+Fit many data files at once, as described by a manifest, and write the results to a single
+summary table. From the command line:
+
+    python BatchFit.py data/manifest.json -o data/summary.txt
+
+The manifest is a json file with a list of entries, one per data file, eg.
+
+    [
+        {"file": "data/sapphire_disk_706nm.txt", "thickness": 2.29, "wavelength": 706},
+        {"file": "data/bk7_glass.txt", "thickness": 5.59, "column": "centroid", "trim": 10,
+         "bounds": [[-6, -1.5, 1.4], [6, 1.5, 1.7]]}
+    ]
+
+where the thickness is in mm and the wavelength in nm. The column, trim and bounds are
+optional (see DEFAULT_ENTRY), and relative file paths are taken relative to where the
+script is run from.
+
+The files are fit in parallel in separate processes (see Fitting.fitDisplacement), and
+the results are cached (see FitCache.py), so running it again only fits the files (or
+settings) that have changed, unless --no-cache is given.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from Fitting import N_AIR, DEFAULT_BOUNDS, loadData, fitDisplacement, displacementModel
+from FitCache import fitFile
+
+# Values used for anything not given in a manifest entry
+DEFAULT_ENTRY = {'wavelength': np.nan,
+                 'column': 'gauss_center',
+                 'trim': 5,
+                 'bounds': DEFAULT_BOUNDS,
+                 'n0': N_AIR}
+
+# Columns of the summary table, in order
+SUMMARY_COLUMNS = ['file', 'wavelength', 'thickness', 'column', 'n', 'n_std', 'residual_rms', 'a0', 'a1']
+
+
+def fitEntry(entry, useCache=True):
+    """
+    Fit the file described by a single manifest entry, returning a row of the summary table
+    as a dictionary. The uncertainty in n is the standard deviation from the covariance of
+    the fit, and the rms of the residuals is in mm.
+    """
+    entry = {**DEFAULT_ENTRY, **entry}
+
+    if useCache:
+        popt, pcov, residualRms = fitFile(entry['file'], entry['thickness'], entry['column'], entry['trim'],
+                                          entry['n0'], entry['bounds'], full_output=True)
+    else:
+        angleArr, displacementArr = loadData(entry['file'], entry['column'], entry['trim'])
+        popt, pcov = fitDisplacement(angleArr, displacementArr, entry['thickness'], entry['n0'], entry['bounds'])
+        residuals = displacementArr - displacementModel(angleArr, *popt, entry['thickness'], entry['n0'])
+        residualRms = np.sqrt(np.mean(residuals**2))
+
+    return {'file': entry['file'],
+            'wavelength': entry['wavelength'],
+            'thickness': entry['thickness'],
+            'column': entry['column'],
+            'n': popt[2],
+            'n_std': np.sqrt(pcov[2,2]),
+            'residual_rms': residualRms,
+            'a0': popt[0],
+            'a1': popt[1]}
+
+
+def fitManifest(manifest, processes=None, useCache=True):
+    """
+    Fit every entry in a manifest (a list of dictionaries, see above) in parallel, returning
+    the rows of the summary table in the same order as the manifest.
+    """
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(partial(fitEntry, useCache=useCache), manifest))
+
+
+def writeSummary(rows, path):
+    with open(path, 'w') as outFile:
+        outFile.write(','.join(SUMMARY_COLUMNS) + '\n')
+        for row in rows:
+            outFile.write(','.join(str(row[key]) for key in SUMMARY_COLUMNS) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit the index of refraction for every file in a manifest.')
+    parser.add_argument('manifest', help='json file listing the data files and their settings')
+    parser.add_argument('-o', '--output', default='summary.txt', help='where to write the summary table')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), help='number of processes to use')
+    parser.add_argument('--no-cache', action='store_true', help='fit every file again, even if it has been fit before')
+    args = parser.parse_args()
+
+    with open(args.manifest, 'r') as manifestFile:
+        manifest = json.load(manifestFile)
+
+    rows = fitManifest(manifest, args.processes, not args.no_cache)
+    writeSummary(rows, args.output)
+
+    for row in rows:
+        print(f'{row["file"]:40} n = {row["n"]:.5f} +/- {row["n_std"]:.5f}')
+
+
+# So that the file can be run from the command line
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+"""
+Benchmarks for the parts of the code that a measurement (or an analysis) spends its time in,
+which run headless (eg. on a linux machine) using the stand-ins from Simulation.py in place
+of the beam profiler server and the rotation stage. From the command line:
+
+    python Benchmark.py                                 # Run everything, save to benchmarks/
+    python Benchmark.py -o before.json --quick          # Fewer repeats
+    python Benchmark.py -k fit -k grid                  # Only the groups whose name matches
+    python Benchmark.py --compare benchmarks/old.json   # Flag anything that got slower
+
+The groups are:
+
+    parse       Parsing a text measurement (parseMeasurement), and TLBP2.getMeasurement as a
+                whole (status request, measure request and parsing)
+    pipe        Round trips to the server: a status request, and batches of measurements
+                with the text and binary protocols, through the simulated pipe and through a
+                real socket (with the binary frames through shared memory as well), and
+                the same number of samples taken one getMeasurement at a time, to show
+                how much batching saves
+    profiles    Batches of raw profiles (TLBP2.getProfiles) through a socket and through shared
+                memory, and estimating the beam centers of many profiles at once (Profiles.py)
+    motion      How much longer than the move itself waiting for the stage takes
+    scan        A whole 100 angle scan with ScanRunner, with short (but nonzero) delays
+    fit         fitDisplacement on each of the data files, and the sandwich fit on the ruby
+                files
+    grid        The 50x50 grid sweep from the AdvancedCurveFitting notebook (fitSandwichGrid)
+
+Each result is the time per call in seconds (median, min, mean and std over the repeats),
+and the whole run is saved as json along with the commit and machine it was run on, so that
+runs can be compared over time (see compareResults). Only runs on the same machine are
+really comparable.
+
+For the pipe benchmarks, the stand-in server only simulates each different request once and
+then sends back the same response (see ReplayPipe), so that they time the transport and our
+side of it rather than the simulator.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import scipy
+
+from Fitting import SAMPLE_WIDTHS, loadData, fitDisplacement, fitSandwichGrid
+from Profiles import profileCentroids, gaussianCenters
+from Scan import ScanRunner
+from Simulation import SimulatedRotationStage, SimulatedTLBP2, SimulatedPipe
+from TLBP2Control.Control import parseMeasurement, MAX_PROFILE_LENGTH
+
+# Changes whenever the benchmarks change in a way that makes old results incomparable
+BENCHMARK_VERSION = 1
+
+DEFAULT_REPEATS = 7
+QUICK_REPEATS = 3
+
+# A median time that is this much (as a fraction) longer than before counts as a regression
+REGRESSION_THRESHOLD = .2
+
+RESULTS_DIR = 'benchmarks'
+
+# Number of measurements in each batch for the pipe benchmarks
+PIPE_BATCH_SIZE = 100
+
+# Raw profiles, as long as the device can take them: batches of PROFILE_BATCH_SIZE samples
+# for acquisition, and the profiles of PROFILE_FIT_SIZE samples for the estimators
+PROFILE_BATCH_SIZE = 10
+PROFILE_FIT_SIZE = 100
+
+# Scan benchmark: 100 angles, with delays small enough that the whole scan only takes a
+# couple of seconds, but not zero so that the waiting still happens the same way
+SCAN_ANGLES = np.linspace(50, -50, 100)
+SCAN_SAMPLES_PER_ANGLE = 10
+SCAN_VELOCITY = 1000.
+SCAN_SETTLE_TIME = .005
+SCAN_COMMAND_LATENCY = .0005
+SCAN_PIPE_LATENCY = .0005
+SCAN_SAMPLE_TIME = .001
+
+# Motion benchmark: 1 degree moves at 100 degrees/second
+MOTION_STEP = 1.
+MOTION_VELOCITY = 100.
+
+# The ruby sample between two glass slides from the AdvancedCurveFitting notebook: sample
+# thickness d1, index of refraction of the slides n1, and total thickness dtot (in mm)
+SANDWICH_SAMPLES = {'data/ruby_flat_700nm.txt': (2.06 - 2*.99, (1.5248 + 1.5449)/2, 2.06),
+                    'data/ruby_flat_700nm_2.txt': (2.06 - 2*.99, (1.5248 + 1.5449)/2, 2.06)}
+
+# Grid sweep from the AdvancedCurveFitting notebook
+GRID_FILE = 'data/ruby_flat_700nm_2.txt'
+GRID_D1 = np.linspace(.06, .16, 50)
+GRID_N1 = np.linspace(1.5, 1.53, 50)
+GRID_DTOT = 2.06
+GRID_BOUNDS = ([-6, -np.pi/2 + .01, 1.4], [6, np.pi/2 - .01, 1.5])
+
+
+def timeCall(func, repeats=DEFAULT_REPEATS, number=1, setup=None, warmup=True, **extra):
+    """
+    Time func (called with no arguments) number times in a row, repeats times over, and
+    return the statistics of the time per call (in seconds), along with anything in extra.
+    setup (if given) is called before each repeat, and isn't timed.
+    """
+    if warmup:
+        if setup is not None:
+            setup()
+        func()
+
+    times = np.zeros(repeats)
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+
+        start = perf_counter()
+        for j in range(number):
+            func()
+        times[i] = (perf_counter() - start) / number
+
+    return {'median': float(np.median(times)),
+            'min': float(np.min(times)),
+            'mean': float(np.mean(times)),
+            'std': float(np.std(times)),
+            'repeats': repeats,
+            'number': number,
+            **extra}
+
+
+class ReplayPipe(SimulatedPipe):
+    """
+    SimulatedPipe that only simulates each different measure request once, and answers
+    the same request with the same response every time after that.
+    """
+
+    def __init__(self, device):
+        super().__init__(device)
+        self._replies = {}
+
+    def respond(self, command):
+        # Anything else (status, switching protocol) is cheap, and may change state
+        if not command.startswith(('measure', 'profiles')):
+            return super().respond(command)
+
+        key = (command, self._binaryMode)
+        if key not in self._replies:
+            self._replies[key] = super().respond(command)
+
+        return self._replies[key]
+
+
+class ReplayTLBP2(SimulatedTLBP2):
+    """
+    SimulatedTLBP2 whose requests are answered by a ReplayPipe.
+    """
+
+    def _simulatedPipe(self):
+        return ReplayPipe(self)
+
+
+def replayDevice(binary=False, transport=None, sharedMemory=False, profileLength=MAX_PROFILE_LENGTH):
+    """
+    A connected ReplayTLBP2, with no delays.
+    """
+    stage = SimulatedRotationStage(commandLatency=0, seed=0)
+    bp2Device = ReplayTLBP2(stage, ior=1.51, width=.99, pipeLatency=0, sampleTime=0, spinUpTime=0, seed=0,
+                            binary=binary, transport=transport, sharedMemory=sharedMemory,
+                            profileLength=profileLength)
+    bp2Device.connect()
+
+    return bp2Device
+
+
+def benchmarkParse(repeats):
+    bp2Device = replayDevice()
+
+    # A typical measurement, as the server sends it
+    bp2Device._pipeCon.write('measure')
+    rawData = bp2Device._pipeCon.read()[1].decode().strip()
+
+    return {'parse.parseMeasurement': timeCall(lambda: parseMeasurement(rawData), repeats, 1000),
+            'parse.getMeasurement': timeCall(bp2Device.getMeasurement, repeats, 200)}
+
+
+def benchmarkPipe(repeats):
+    """
+    Round trips through the simulated pipe, and through a real socket to a SimulatedServer
+    (with and without the binary frames coming back through shared memory).
+
+    pipe.single takes PIPE_BATCH_SIZE samples with one getMeasurement each, and
+    pipe.singleVsBatch takes them with a single getMeasurements on the same device, with
+    how many times faster that is as speedup.
+    """
+    devices = {'pipe.text': replayDevice(binary=False),
+               'pipe.binary': replayDevice(binary=True),
+               'pipe.socketText': replayDevice(binary=False, transport='socket'),
+               'pipe.socketBinary': replayDevice(binary=True, transport='socket'),
+               'pipe.sharedMemory': replayDevice(binary=True, transport='socket', sharedMemory=True)}
+
+    results = {'pipe.status': timeCall(devices['pipe.text'].getStatus, repeats, 1000),
+               'pipe.socketStatus': timeCall(devices['pipe.socketText'].getStatus, repeats, 1000)}
+
+    textDevice = devices['pipe.text']
+    single = timeCall(lambda: [textDevice.getMeasurement() for i in range(PIPE_BATCH_SIZE)], repeats, 2,
+                      samples=PIPE_BATCH_SIZE)
+    batch = timeCall(lambda: textDevice.getMeasurements(PIPE_BATCH_SIZE), repeats, 20, samples=PIPE_BATCH_SIZE)
+    results['pipe.single'] = single
+    results['pipe.singleVsBatch'] = {**batch, 'speedup': single['median'] / batch['median']}
+
+    for name, bp2Device in devices.items():
+        results[name] = timeCall(lambda: bp2Device.getMeasurements(PIPE_BATCH_SIZE), repeats, 20,
+                                 samples=PIPE_BATCH_SIZE)
+        bp2Device.disconnect()
+
+    return results
+
+
+def benchmarkProfiles(repeats):
+    results = {}
+
+    devices = {'profiles.socket': replayDevice(binary=True, transport='socket'),
+               'profiles.sharedMemory': replayDevice(binary=True, transport='socket', sharedMemory=True)}
+
+    for name, bp2Device in devices.items():
+        results[name] = timeCall(lambda: bp2Device.getProfiles(PROFILE_BATCH_SIZE), repeats, 10,
+                                 samples=PROFILE_BATCH_SIZE)
+
+    samples, positions, intensities = devices['profiles.socket'].getProfiles(PROFILE_FIT_SIZE)
+    positions, intensities = positions.copy(), intensities.copy()
+
+    for bp2Device in devices.values():
+        bp2Device.disconnect()
+
+    results['profiles.centroids'] = timeCall(lambda: profileCentroids(positions, intensities), repeats,
+                                             profiles=positions.shape[0] * positions.shape[1])
+    results['profiles.gaussian'] = timeCall(lambda: gaussianCenters(positions, intensities), repeats,
+                                            profiles=positions.shape[0] * positions.shape[1])
+
+    return results
+
+
+class _FakeESP301():
+    """
+    Stand-in for the ESP301 .NET interface, with just the commands that
+    ESP301Control.RotationStage uses to move and wait, answered by a SimulatedRotationStage.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.polls = 0
+
+    def TP(self, axis, angle, errorMsg):
+        return 0, self.stage._trueAngle(), errorMsg
+
+    def PA_Set(self, axis, theta, errorMsg):
+        self.stage._startMove(theta)
+        return 0, errorMsg
+
+    def MD(self, axis, delay, errorMsg):
+        self.polls += 1
+        return 0, self.stage._remainingTime() <= 0, errorMsg
+
+    def VA_Get(self, axis, velocity, errorMsg):
+        return 0, self.stage._velocity, errorMsg
+
+    def ST(self, errorMsg):
+        self.stage.stop()
+        return 0
+
+
+def benchmarkMotion(repeats):
+    """
+    Time 1 degree moves (back and forth), for the simulated stage and (if the ESP301 library
+    can be loaded) for RotationStage with the controller simulated. The difference between
+    the time and 'expected' is the overhead of waiting.
+    """
+    expected = MOTION_STEP / MOTION_VELOCITY
+    results = {}
+
+    simulated = SimulatedRotationStage(velocity=MOTION_VELOCITY, settleTime=0, commandLatency=0, seed=0)
+    target = [0.]
+
+    def move(stage):
+        target[0] = MOTION_STEP - target[0]
+        stage.moveAbsolute(target[0])
+
+    results['motion.simulated'] = timeCall(lambda: move(simulated), repeats, 10, expected=expected)
+
+    # Needs pythonnet and the .NET library, so only on the lab machine
+    try:
+        from ESP301Control.Control import RotationStage
+    except Exception:
+        return results
+
+    controller = _FakeESP301(SimulatedRotationStage(velocity=MOTION_VELOCITY, settleTime=0, commandLatency=0, seed=0))
+    stage = RotationStage()
+    stage._espDev = controller
+
+    result = timeCall(lambda: move(stage), repeats, 10, expected=expected)
+    # Average number of times the controller was asked whether the move was done (the warm
+    # up included)
+    result['polls'] = controller.polls / ((repeats + 1) * 10)
+    results['motion.polling'] = result
+
+    return results
+
+
+def benchmarkScan(repeats):
+    stage = SimulatedRotationStage(velocity=SCAN_VELOCITY, settleTime=SCAN_SETTLE_TIME,
+                                   commandLatency=SCAN_COMMAND_LATENCY, seed=0)
+    bp2Device = SimulatedTLBP2(stage, ior=1.51, width=.99, pipeLatency=SCAN_PIPE_LATENCY,
+                               sampleTime=SCAN_SAMPLE_TIME, spinUpTime=0, seed=0)
+    bp2Device.connect()
+
+    # Time spent waiting on the (simulated) hardware itself: moving, settling and sampling
+    moveTime = np.sum(np.abs(np.diff(SCAN_ANGLES))) / SCAN_VELOCITY
+    hardware = moveTime + len(SCAN_ANGLES) * (SCAN_SETTLE_TIME + SCAN_SAMPLES_PER_ANGLE * SCAN_SAMPLE_TIME)
+
+    def runScan():
+        ScanRunner(stage, bp2Device, SCAN_ANGLES, samplesPerAngle=SCAN_SAMPLES_PER_ANGLE).run()
+
+    # Every scan starts from the first angle
+    return {'scan.simulated': timeCall(runScan, repeats, setup=lambda: stage.moveAbsolute(SCAN_ANGLES[0]),
+                                       warmup=False, angles=len(SCAN_ANGLES), hardware=hardware)}
+
+
+def benchmarkFit(repeats):
+    results = {}
+
+    for file, d in SAMPLE_WIDTHS.items():
+        angleArr, displacementArr = loadData(file)
+        name = os.path.splitext(os.path.basename(file))[0]
+        results[f'fit.{name}'] = timeCall(lambda: fitDisplacement(angleArr, displacementArr, d), repeats, 10)
+
+    for file, (d1, n1, dtot) in SANDWICH_SAMPLES.items():
+        angleArr, displacementArr = loadData(file)
+        name = os.path.splitext(os.path.basename(file))[0]
+        results[f'fit.{name}'] = timeCall(lambda: fitSandwichGrid(angleArr, displacementArr, [d1], [n1], dtot),
+                                          repeats, 10)
+
+    return results
+
+
+def benchmarkGrid(repeats):
+    angleArr, displacementArr = loadData(GRID_FILE)
+
+    return {'grid.sandwich': timeCall(lambda: fitSandwichGrid(angleArr, displacementArr, GRID_D1, GRID_N1,
+                                                              GRID_DTOT, bounds=GRID_BOUNDS),
+                                      repeats, cells=GRID_D1.size * GRID_N1.size)}
+
+
+# In the order they are run
+BENCHMARKS = {'parse': benchmarkParse,
+              'pipe': benchmarkPipe,
+              'profiles': benchmarkProfiles,
+              'motion': benchmarkMotion,
+              'scan': benchmarkScan,
+              'fit': benchmarkFit,
+              'grid': benchmarkGrid}
+
+
+def _commit():
+    """
+    The current git commit (with '-dirty' if there are uncommitted changes), or None.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True)
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit.stdout.strip() + ('-dirty' if status.stdout.strip() else '')
+
+
+def machineInfo():
+    return {'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__}
+
+
+def runBenchmarks(groups=None, repeats=DEFAULT_REPEATS, verbose=True):
+    """
+    Run the benchmarks in the given groups (default all, see BENCHMARKS), returning the
+    results along with the commit and machine (as saved by saveResults).
+    """
+    groups = list(BENCHMARKS.keys()) if groups is None else groups
+
+    benchmarks = {}
+    for group in groups:
+        start = perf_counter()
+        results = BENCHMARKS[group](repeats)
+        benchmarks.update(results)
+
+        if verbose:
+            for name, result in results.items():
+                speedup = f'   ({result["speedup"]:.1f}x faster)' if 'speedup' in result else ''
+                print(f'{name:36} {1e3*result["median"]:12.4f} ms{speedup}')
+            print(f'({group} took {perf_counter() - start:.1f} s)')
+
+    return {'version': BENCHMARK_VERSION,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'commit': _commit(),
+            'machine': machineInfo(),
+            'repeats': repeats,
+            'benchmarks': benchmarks}
+
+
+def saveResults(results, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'w') as outFile:
+        json.dump(results, outFile, indent=2)
+
+
+def loadResults(path):
+    with open(path, 'r') as inFile:
+        return json.load(inFile)
+
+
+def compareResults(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare the median times of the benchmarks that are in both old and new (as from
+    runBenchmarks or loadResults). Returns a list of (name, old median, new median, ratio,
+    regressed), where regressed is True if the new median is more than threshold (as a
+    fraction) slower.
+    """
+    if old.get('version') != new.get('version'):
+        raise ValueError(f'Benchmark versions differ ({old.get("version")} and {new.get("version")}), '
+                         'so the results are not comparable')
+
+    comparison = []
+    for name, result in new['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+
+        oldMedian = old['benchmarks'][name]['median']
+        ratio = result['median'] / oldMedian
+        comparison.append((name, oldMedian, result['median'], ratio, ratio > 1 + threshold))
+
+    return comparison
+
+
+def printComparison(comparison):
+    print(f'{"benchmark":36} {"old [ms]":>12} {"new [ms]":>12} {"ratio":>7}')
+    for name, oldMedian, newMedian, ratio, regressed in comparison:
+        print(f'{name:36} {1e3*oldMedian:12.4f} {1e3*newMedian:12.4f} {ratio:7.2f}' + ('  SLOWER' if regressed else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the acquisition and analysis code.')
+    parser.add_argument('-o', '--output', help=f'where to save the results (default a new file in {RESULTS_DIR}/)')
+    parser.add_argument('-k', '--only', action='append', help='only run the groups whose name contains this')
+    parser.add_argument('--quick', action='store_true', help=f'only repeat each benchmark {QUICK_REPEATS} times')
+    parser.add_argument('--compare', help='earlier results to compare against; exits with 1 if anything is slower')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='how much slower (as a fraction) counts as a regression')
+    args = parser.parse_args()
+
+    groups = [group for group in BENCHMARKS if args.only is None or any(pattern in group for pattern in args.only)]
+    results = runBenchmarks(groups, QUICK_REPEATS if args.quick else DEFAULT_REPEATS)
+
+    output = args.output
+    if output is None:
+        output = os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    saveResults(results, output)
+    print(f'Saved results to {output}')
+
+    if args.compare is not None:
+        comparison = compareResults(loadResults(args.compare), results, args.threshold)
+        printComparison(comparison)
+
+        if any(regressed for *rest, regressed in comparison):
+            sys.exit(1)
+
+
+# So that the benchmarks can be run from the command line
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
 import sys
 import clr
 import os
+import asyncio
+import threading
+from time import sleep, monotonic
+
+from Utils import Deadline, runWithDeadline
+from Instrumentation import instrumented
 
 ASSEMBLY_FILE = 'ESP301_CommandInterface'
 CURR_DIR = os.path.dirname(__file__)
@@ -8,6 +14,11 @@ CURR_DIR = os.path.dirname(__file__)
 # Constants for the motion controller
 BAUD_RATE = 921600
 
+# Bounds on how often we ask the controller whether a move is done (in seconds), once the
+# move should have finished; see RotationStage._pollIntervals
+MIN_POLL_INTERVAL = .005
+MAX_POLL_INTERVAL = .25
+
 # Add the reference to the .Net library so we can use it
 sys.path.append(CURR_DIR)
 clr.AddReference(ASSEMBLY_FILE)
@@ -21,20 +32,29 @@ class RotationStage():
         self._espDev = ESP301()
         self._axisNum = axisNum # Where the stage is plugged into the motion controller
         self._comPort = comPort
+        # Only changes through setVelocity, so we don't need to ask the controller every move
+        self._velocity = None
+        # Held for each command (and its reply), so that commands from different threads (eg.
+        # stopping the stage after waitForMove times out, while the worker is still polling)
+        # don't get mixed up on the serial connection
+        self._lock = threading.RLock()
         pass
 
     def connect(self):
         """
         Establish the connection to the motion controller. Must be run before using any other commands.
         """
-        return self._espDev.OpenInstrument(self._comPort, BAUD_RATE)
+        with self._lock:
+            return self._espDev.OpenInstrument(self._comPort, BAUD_RATE)
 
     def disconnect(self):
         """
         Disconnect from the motion controller, preventing any further commands from being issued.
         """
-        return self._espDev.CloseInstrument()
+        with self._lock:
+            return self._espDev.CloseInstrument()
 
+    @instrumented('stage.getAngle')
     def getAngle(self):
         """
         Get the current angle reading of the stage. Note that this is the *actual* angle,
@@ -42,7 +62,8 @@ class RotationStage():
         """
         errorMsg = ''
         angle = 0
-        status, angle, errorMsg = self._espDev.TP(self._axisNum, angle, errorMsg)
+        with self._lock:
+            status, angle, errorMsg = self._espDev.TP(self._axisNum, angle, errorMsg)
 
         if status == 0:
             return angle
@@ -50,48 +71,209 @@ class RotationStage():
         else:
             raise Exception('Error reading angle: ' + errorMsg)
 
-    def moveRelative(self, deltaTheta, wait=True):
+    @instrumented('stage.moveRelative')
+    def moveRelative(self, deltaTheta, wait=True, timeout=None):
         """
         Move the rotation stage by some number of degrees relative to the current position.
+
+        If wait is True, this blocks until the move is finished (see waitForMove), raising
+        a TimeoutError if it takes longer than timeout seconds.
         """
-        errorMsg = ''
-        status, errorMsg = self._espDev.PR(self._axisNum, deltaTheta, errorMsg)
+        status = self._sendMove(self._espDev.PR, deltaTheta)
 
         if wait:
-            while True:
-                # The 0 is passed in as 'delay' but I don't really know what it does
-                ret, done, errorMsg = self._espDev.MD(self._axisNum, 0, errorMsg)
-
-                if done:
-                    break
+            self.waitForMove(self._expectedMoveTime(deltaTheta), timeout)
 
         return status
 
-    def moveAbsolute(self, theta, wait=True):
+    @instrumented('stage.moveAbsolute')
+    def moveAbsolute(self, theta, wait=True, timeout=None):
         """
         Move the rotation stage to some angle, relative to 0 position.
 
         For large numbers of small movements, it is more accurate to calculate the angles
         beforehand and move absolutely, as opposed to moving by a fixed relative angle.
+
+        If wait is True, this blocks until the move is finished (see waitForMove), raising
+        a TimeoutError if it takes longer than timeout seconds.
         """
-        errorMsg = ''
-        status, errorMsg = self._espDev.PA_Set(self._axisNum, theta, errorMsg)
+        # The distance is only needed to know how long to wait for
+        distance = theta - self.getAngle() if wait else 0
+
+        status = self._sendMove(self._espDev.PA_Set, theta)
 
         if wait:
-            while True:
-                # The 0 is passed in as 'delay' but I don't really know what it does
-                ret, done, errorMsg = self._espDev.MD(self._axisNum, 0, errorMsg)
+            self.waitForMove(self._expectedMoveTime(distance), timeout)
 
-                if done:
-                    break
+        return status
+
+    async def moveRelativeAsync(self, deltaTheta, timeout=None):
+        """
+        Same as moveRelative, but waits for the move to finish without blocking the event
+        loop, so other work (eg. reading sensors) can be done in the meantime:
+
+            moveTask = asyncio.create_task(stage.moveRelativeAsync(-1))
+            ...
+            await moveTask
+
+        Every command to the controller is sent from another thread (see waitForMoveAsync).
+        """
+        loop = asyncio.get_event_loop()
+        status = await loop.run_in_executor(None, self._sendMove, self._espDev.PR, deltaTheta)
+        expectedDuration = await loop.run_in_executor(None, self._expectedMoveTime, deltaTheta)
+
+        await self.waitForMoveAsync(expectedDuration, timeout)
 
         return status
 
+    async def moveAbsoluteAsync(self, theta, timeout=None):
+        """
+        Same as moveAbsolute, but waits for the move to finish without blocking the event
+        loop (see moveRelativeAsync).
+        """
+        loop = asyncio.get_event_loop()
+        distance = theta - await loop.run_in_executor(None, self.getAngle)
+
+        status = await loop.run_in_executor(None, self._sendMove, self._espDev.PA_Set, theta)
+        expectedDuration = await loop.run_in_executor(None, self._expectedMoveTime, distance)
+
+        await self.waitForMoveAsync(expectedDuration, timeout)
+
+        return status
+
+    def _sendMove(self, command, theta):
+        """
+        Start a move with command (PR or PA_Set of the controller), returning its status.
+        """
+        errorMsg = ''
+        with self._lock:
+            status, errorMsg = command(self._axisNum, theta, errorMsg)
+        return status
+
+    @instrumented('stage.waitForMove')
+    def waitForMove(self, expectedDuration=0, timeout=None):
+        """
+        Block until the stage has finished moving.
+
+        Rather than asking the controller constantly (which uses up a whole core and
+        floods the serial connection), we sleep for most of the expected duration of the
+        move, checking only a handful of times (halving the wait each time), and then poll
+        with an increasing interval (see _pollIntervals).
+
+        If the stage is still moving after timeout seconds (or the controller stops
+        responding), it is stopped and a TimeoutError is raised.
+        """
+        if timeout is None:
+            self._pollUntilDone(expectedDuration, Deadline())
+            return
+
+        deadline = Deadline(timeout)
+        try:
+            done = runWithDeadline(self._pollUntilDone, deadline, expectedDuration, deadline, cleanup=[self._forceStop])
+        except TimeoutError:
+            raise TimeoutError(f'Stage did not finish moving within {timeout} seconds')
+
+        # The worker can also give up by itself, right as the deadline runs out
+        if not done:
+            self._forceStop()
+            raise TimeoutError(f'Stage did not finish moving within {timeout} seconds')
+
+    def _pollUntilDone(self, expectedDuration, deadline):
+        """
+        Worker for waitForMove; returns whether the move is done, giving up (returning
+        False) once the deadline has expired, since the caller will have stopped waiting
+        by then.
+        """
+        for interval in self._pollIntervals(expectedDuration):
+            # Once the deadline has expired, the caller is stopping the stage instead
+            if deadline.expired():
+                return False
+            if self._isDone():
+                return True
+
+            remaining = deadline.remaining()
+            sleep(interval if remaining is None else min(interval, remaining))
+
+    async def waitForMoveAsync(self, expectedDuration=0, timeout=None):
+        """
+        Same as waitForMove, but sleeps with asyncio so other tasks can run while the
+        stage is moving.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = Deadline(timeout)
+
+        for interval in self._pollIntervals(expectedDuration):
+            # Commands to the controller block (for as long as the serial link takes, or
+            # another thread holds the lock), so they are run in another thread rather
+            # than holding up every other task
+            if await loop.run_in_executor(None, self._isDone):
+                return
+
+            if deadline.expired():
+                await loop.run_in_executor(None, self._forceStop)
+                raise TimeoutError(f'Stage did not finish moving within {timeout} seconds')
+
+            remaining = deadline.remaining()
+            await asyncio.sleep(interval if remaining is None else min(interval, remaining))
+
+    # Each call is one poll of the controller (MD) while waiting for a move
+    @instrumented('stage.MD')
+    def _isDone(self):
+        """
+        Ask the controller whether the current move is done.
+        """
+        errorMsg = ''
+        # The 0 is passed in as 'delay' but I don't really know what it does
+        with self._lock:
+            ret, done, errorMsg = self._espDev.MD(self._axisNum, 0, errorMsg)
+        return bool(done)
+
+    def _expectedMoveTime(self, deltaTheta):
+        """
+        How long (in seconds) we expect a move of deltaTheta degrees to take, ignoring
+        acceleration; 0 if the velocity isn't known.
+        """
+        velocity = self._velocity if self._velocity is not None else self.getVelocity()
+        if not velocity:
+            return 0
+
+        return abs(deltaTheta) / velocity
+
+    def _pollIntervals(self, expectedDuration):
+        """
+        Generate the time to sleep between each check of whether a move is done.
+
+        Until the move is expected to be done, we sleep for half of the remaining time, so
+        only a few checks are made (about log2(expectedDuration / MIN_POLL_INTERVAL), eg. 11
+        for a 10 second move); after that (acceleration and settling mean moves always take
+        a bit longer) the interval starts small and doubles each time, up to MAX_POLL_INTERVAL.
+        """
+        end = monotonic() + expectedDuration
+        backoff = MIN_POLL_INTERVAL
+
+        while True:
+            remaining = end - monotonic()
+            if remaining > MIN_POLL_INTERVAL:
+                yield remaining / 2
+            else:
+                yield backoff
+                backoff = min(2*backoff, MAX_POLL_INTERVAL)
+
     def stop(self):
         """
         Stop the stage from moving.
         """
         errorMsg = ''
+        with self._lock:
+            return self._espDev.ST(errorMsg)
+
+    def _forceStop(self):
+        """
+        Stop the stage without waiting for the command lock, for when waitForMove times out:
+        if the controller has stopped answering, the worker that is polling it still holds
+        the lock (and always will), and the stage should be told to stop regardless.
+        """
+        errorMsg = ''
         return self._espDev.ST(errorMsg)
 
     def setVelocity(self, velocity):
@@ -100,7 +282,9 @@ class RotationStage():
         is not setting the *current* velocity.
         """
         errorMsg = ''
-        status, errorMsg = self._espDev.VA_Set(self._axisNum, velocity, errorMsg)
+        with self._lock:
+            status, errorMsg = self._espDev.VA_Set(self._axisNum, velocity, errorMsg)
+        self._velocity = velocity if status == 0 else None
         return status
 
     def getVelocity(self):
@@ -109,8 +293,10 @@ class RotationStage():
         not the current velocity of the stage.
         """
         errorMsg = ''
-        status, velocity, errorMsg = self._espDev.VA_Get(self._axisNum, 0, errorMsg)
+        with self._lock:
+            status, velocity, errorMsg = self._espDev.VA_Get(self._axisNum, 0, errorMsg)
         if status == 0:
+            self._velocity = velocity
             return velocity
         return None 
 
@@ -119,7 +305,8 @@ class RotationStage():
         Returns whether or not the stage is currently moving to a new position.
         """
         errorMsg = ''
-        ret, done, errorMsg = self._espDev.MD(self._axisNum, 0, errorMsg)
+        with self._lock:
+            ret, done, errorMsg = self._espDev.MD(self._axisNum, 0, errorMsg)
 
         return bool(done)
         
@@ -130,5 +317,6 @@ class RotationStage():
         turned off/unplugged/etc.
         """
         errorMsg = ''
-        status, errorMsg = self._espDev.OR(self._axisNum, 0, errorMsg)
+        with self._lock:
+            status, errorMsg = self._espDev.OR(self._axisNum, 0, errorMsg)
         return status
@@ -0,0 +1,188 @@
+"""
+Background sampling of the tinkerforge sensors (temperature and humidity), so that a scan
+doesn't have to wait on them: readings are recorded with their (monotonic) timestamps as
+they come in, and the value at any time (eg. when the beam profiler samples were taken) is
+looked up from them without talking to the sensors at all.
+
+    from Environment import EnvironmentSampler
+
+    environment = EnvironmentSampler()
+    environment.addBricklet('temp', temperatureSensor, 'temperature', .01)
+    environment.addBricklet('humid', humiditySensor, 'humidity', .1)
+    environment.start()
+
+    scan = ScanRunner(stage, bp2Device, angles, environment=environment)
+    scan.run()
+
+    # The whole record, eg. for correcting for drift
+    times, temps = environment.trace('temp')
+
+Bricklets send their readings to us (using their callbacks) where they can; anything else
+is read in a background thread every period seconds. Since the bricklets only call back
+when the value changes, the value at any time is the last reading before it (rather than
+interpolating towards a reading that was only sent once the value had already changed).
+"""
+import threading
+from time import monotonic
+
+import numpy as np
+
+from TLBP2Control.Buffer import MeasurementBuffer
+from Instrumentation import timed
+
+# Time between readings (in seconds)
+DEFAULT_PERIOD = .5
+# Number of readings of each sensor that are kept (about 14 hours at the default period)
+DEFAULT_CAPACITY = 100000
+
+
+class EnvironmentSampler():
+
+    def __init__(self, period=DEFAULT_PERIOD, capacity=DEFAULT_CAPACITY):
+        self.period = period
+        self.capacity = capacity
+
+        self._buffers = {}
+        # Sensors that have to be read by the background thread, as functions
+        self._polled = {}
+        # Bricklets that call us back, along with the function that sets their period, and
+        # the function to read them directly
+        self._callbacks = {}
+        self._initialReads = {}
+
+        self._thread = None
+        self._stopEvent = threading.Event()
+
+        # Readings come from both the callback thread and the polling thread, and have to
+        # stay in order of time
+        self._recordLock = threading.Lock()
+        self._lastTimes = {}
+
+    @property
+    def names(self):
+        return list(self._buffers.keys())
+
+    def addSensor(self, name, read):
+        """
+        Add a sensor that is read (with no arguments) in the background thread, eg. one of
+        the functions from DeviceHealth.sensors.
+        """
+        self._buffers[name] = MeasurementBuffer(self.capacity, 'double')
+        self._polled[name] = read
+
+    def addBricklet(self, name, device, quantity, scale=1):
+        """
+        Add a tinkerforge bricklet that measures quantity (eg. 'temperature' for a
+        BrickletTemperature, 'humidity' for a BrickletHumidity), whose readings are
+        multiplied by scale (eg. .01 to get degrees from the temperature bricklet).
+
+        If the bricklet supports callbacks, it sends its readings to us (the real bricklets
+        only do so when the value changes), otherwise it is read in the background thread.
+        """
+        self._buffers[name] = MeasurementBuffer(self.capacity, 'double')
+
+        getter = getattr(device, f'get_{quantity}')
+        def read():
+            return getter() * scale
+
+        callbackId = getattr(device, f'CALLBACK_{quantity.upper()}', None)
+        setPeriod = getattr(device, f'set_{quantity}_callback_period', None)
+
+        if hasattr(device, 'register_callback') and callbackId is not None and setPeriod is not None:
+            device.register_callback(callbackId, lambda value: self._record(name, value * scale))
+            self._callbacks[name] = setPeriod
+            self._initialReads[name] = read
+        else:
+            self._polled[name] = read
+
+    def _record(self, name, value, t=None):
+        t = monotonic() if t is None else t
+
+        with self._recordLock:
+            # eg. the first reading of a bricklet with callbacks, if a callback beat it to it;
+            # the newer reading is the better one anyway
+            if t < self._lastTimes.get(name, -np.inf):
+                return
+            self._lastTimes[name] = t
+            self._buffers[name].append(np.array([value], dtype='double'), np.array([t]))
+
+    def start(self):
+        """
+        Start recording readings (if it isn't already).
+        """
+        if self._thread is not None:
+            return
+
+        for setPeriod in self._callbacks.values():
+            setPeriod(int(self.period * 1000))
+
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        for setPeriod in self._callbacks.values():
+            setPeriod(0)
+
+        self._stopEvent.set()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _poll(self):
+        # The bricklets with callbacks don't send anything until their value changes, so
+        # they get one reading to start with as well
+        self._readAll(self._initialReads)
+
+        while not self._stopEvent.is_set():
+            start = monotonic()
+            self._readAll(self._polled)
+            self._stopEvent.wait(max(self.period - (monotonic() - start), 0))
+
+    def _readAll(self, sensors):
+        for name, read in sensors.items():
+            start = monotonic()
+            try:
+                with timed(f'environment.{name}'):
+                    value = read()
+            except Exception:
+                # A missed reading isn't worth stopping for; the next one will be along soon
+                continue
+            # The middle of the read is the best guess for when it was measured
+            self._record(name, value, (start + monotonic()) / 2)
+
+    def at(self, name, t):
+        """
+        Value of a sensor at time t (or an array of times), in the same units as
+        time.monotonic(): the last reading at or before t. Before the first reading this
+        is nan.
+        """
+        timestamps, values = self._buffers[name].latest()
+        if len(timestamps) == 0:
+            return np.full(np.shape(t), np.nan) if np.ndim(t) > 0 else np.nan
+
+        index = np.searchsorted(timestamps, t, side='right') - 1
+        return np.where(index >= 0, values[np.maximum(index, 0)], np.nan)[()]
+
+    def latest(self, name):
+        """
+        The most recent reading of a sensor (nan if there hasn't been one yet).
+        """
+        timestamps, values = self._buffers[name].latest(1)
+        return values[0] if len(values) > 0 else np.nan
+
+    def trace(self, name):
+        """
+        Copies of all of the readings of a sensor that are still kept, as (timestamps, values).
+        """
+        timestamps, values = self._buffers[name].latest()
+        return timestamps.copy(), values.copy()
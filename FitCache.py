@@ -0,0 +1,249 @@
+"""
+Cache of fit results on disk, so that files that have already been fit (with the same
+settings) don't have to be fit again, eg. when re-running a notebook or BatchFit over
+the whole data directory:
+
+    from FitCache import fitFile
+
+    popt, pcov = fitFile('data/glass_slide_2_700nm.txt', d=.99)
+
+Results are stored under a hash of the contents of the data file (not its name or when it
+was modified), the model, every setting that affects the fit (thickness, n0, trim, column,
+bounds, ...) and the source of the fitting code itself (Fitting.py and ScanFile.py, see
+CODE_MODULES), so a result is only ever reused for exactly the same fit, and changing the
+model or how the data is loaded means everything is fit again. The cache
+is shared by everything that uses it (see Settings.FIT_CACHE_DIR), and once it grows past
+Settings.FIT_CACHE_MAX_SIZE, the results that were used least recently are removed.
+
+CACHE_VERSION only needs to change when what is stored in the cache changes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import Fitting
+import ScanFile
+import Settings
+from Fitting import N_AIR, DEFAULT_BOUNDS, loadData, fitDisplacement, displacementModel, fitSandwichGrid
+
+CACHE_VERSION = 2
+CACHE_EXTENSION = '.npz'
+
+# Read buffer size used when hashing data files
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hashFile(path):
+    """
+    sha256 of the contents of a data file, or of every file in a scan directory (see
+    ScanFile.py).
+    """
+    digest = hashlib.sha256()
+
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        files = [path]
+
+    for file in files:
+        digest.update(os.path.basename(file).encode())
+        with open(file, 'rb') as inFile:
+            for chunk in iter(lambda: inFile.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# Modules whose source is part of every key, so that changing the model or the fit (or how
+# the data files are read) doesn't reuse results from the old code
+CODE_MODULES = [Fitting, ScanFile]
+
+
+def hashCode(modules=CODE_MODULES):
+    """
+    sha256 of the source files of the given modules.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as sourceFile:
+            digest.update(sourceFile.read())
+    return digest.hexdigest()
+
+
+CODE_HASH = hashCode()
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class FitCache():
+
+    def __init__(self, path=None, maxSize=None):
+        """
+        path is the directory the results are kept in, and maxSize the largest the cache can
+        get, in MB (by default, the values in Settings.py).
+        """
+        self.path = path if path is not None else Settings.FIT_CACHE_DIR
+        self.maxSize = maxSize if maxSize is not None else Settings.FIT_CACHE_MAX_SIZE
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Hashes of the files seen so far, by (path, size, modification time), so files
+        # aren't read again just to find out that they haven't changed
+        self._fileHashes = {}
+
+    def key(self, file, model, **settings):
+        """
+        The key for a fit of the given model (eg. 'slab') to a data file with the given
+        settings, which should include everything that could change the result.
+        """
+        stat = os.stat(file)
+        fileId = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+        if fileId not in self._fileHashes:
+            self._fileHashes[fileId] = hashFile(file)
+
+        description = {'version': CACHE_VERSION,
+                       'code': CODE_HASH,
+                       'data': self._fileHashes[fileId],
+                       'model': model,
+                       'settings': {key: _jsonable(value) for key, value in settings.items()}}
+
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        """
+        The result stored under key (a dictionary of arrays), or None if there isn't one.
+        """
+        file = self._file(key)
+
+        try:
+            with np.load(file) as data:
+                result = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+
+        # The modification time keeps track of when each result was last used
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+
+        return result
+
+    def put(self, key, **arrays):
+        """
+        Store the given arrays under key, then make room if the cache is too big.
+        """
+        # Written to a temporary file first, so that other processes using the cache never
+        # see a result that is only half written
+        handle, tempFile = tempfile.mkstemp(suffix=CACHE_EXTENSION, dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as outFile:
+                np.savez(outFile, **arrays)
+            os.replace(tempFile, self._file(key))
+        except BaseException:
+            os.remove(tempFile)
+            raise
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove the least recently used results until the cache fits in maxSize.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(CACHE_EXTENSION):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        maxBytes = self.maxSize * 1e6
+
+        for mtime, size, name in sorted(entries):
+            if total <= maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(CACHE_EXTENSION):
+                os.remove(os.path.join(self.path, name))
+
+
+# Used by fitFile and fitSandwichFile unless they are given a different one
+_defaultCache = None
+
+
+def defaultCache():
+    global _defaultCache
+    if _defaultCache is None:
+        _defaultCache = FitCache()
+    return _defaultCache
+
+
+def fitFile(file, d, column='gauss_center', trim=5, n0=N_AIR, bounds=DEFAULT_BOUNDS, cache=None,
+            full_output=False):
+    """
+    Fitting.fitDisplacement for a data file (see Fitting.loadData), using the cached result
+    if this file has been fit with the same settings before. Returns popt and pcov (and the
+    rms of the residuals in mm as well if full_output is True, which is cached along with
+    the fit, so the data file is only read when it actually has to be fit).
+    """
+    cache = cache if cache is not None else defaultCache()
+    key = cache.key(file, 'slab', d=d, column=column, trim=trim, n0=n0, bounds=bounds)
+
+    result = cache.get(key)
+    if result is None:
+        angleArr, displacementArr = loadData(file, column, trim)
+        popt, pcov = fitDisplacement(angleArr, displacementArr, d, n0, bounds)
+        residuals = displacementArr - displacementModel(angleArr, *popt, d, n0)
+
+        result = {'popt': popt, 'pcov': pcov, 'residual_rms': np.sqrt(np.mean(residuals**2))}
+        cache.put(key, **result)
+
+    if full_output:
+        return result['popt'], result['pcov'], float(result['residual_rms'])
+    return result['popt'], result['pcov']
+
+
+def fitSandwichFile(file, d1Arr, n1Arr, dtot, column='gauss_center', trim=5, n0=N_AIR,
+                    bounds=DEFAULT_BOUNDS, cache=None):
+    """
+    Fitting.fitSandwichGrid for a data file, using the cached result if there is one.
+    Returns the fit index of refraction for each cell of the grid.
+    """
+    cache = cache if cache is not None else defaultCache()
+    key = cache.key(file, 'sandwich', d1=np.asarray(d1Arr, dtype='double'), n1=np.asarray(n1Arr, dtype='double'),
+                    dtot=dtot, column=column, trim=trim, n0=n0, bounds=bounds)
+
+    result = cache.get(key)
+    if result is not None:
+        return result['ior']
+
+    angleArr, displacementArr = loadData(file, column, trim)
+    ior = fitSandwichGrid(angleArr, displacementArr, d1Arr, n1Arr, dtot, n0, bounds)
+
+    cache.put(key, ior=ior)
+    return ior
@@ -0,0 +1,679 @@
+"""
+Fitting of the beam displacement model from Nemoto (1992) to the data collected in the
+BeamTracking notebook (see the CurveFitting notebook for the theory):
+
+    from Fitting import loadData, fitDisplacement
+
+    angleArr, displacementArr = loadData('data/glass_slide_2_700nm.txt')
+    popt, pcov = fitDisplacement(angleArr, displacementArr, d=.99)
+    n = popt[2]
+
+This gives the same result as calling curve_fit on func_form directly, but uses the exact
+derivatives of the model (instead of estimating them numerically) and starts from a guess
+that is already close to the answer, so far fewer evaluations of the model are needed, and
+the faster unbounded solver can usually be used.
+
+Running this file compares the two approaches on the files in data/:
+
+    python Fitting.py
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from ScanFile import loadScan
+
+N_AIR = 1.00029 # Weisstein Eric. Index of Refraction. Wolfram Research. 2005.
+
+# Bounds for [displacement offset, phase offset, IoR], as used in the CurveFitting notebook
+DEFAULT_BOUNDS = ([-6, -np.pi/2 + .01, 1.2], # Lower bound
+                  [6, np.pi/2 - .01, 1.9]) # Upper bound
+
+# Number of indices of refraction that are tried for the initial guess
+GUESS_GRID_SIZE = 41
+
+# Settings for fitting many cells at once (see fitSandwichGrid)
+BATCH_MAX_ITERATIONS = 100
+BATCH_INITIAL_DAMPING = 1e-3
+BATCH_MAX_DAMPING = 1e10
+BATCH_TOLERANCE = 1e-12
+
+# A live fit (see LiveFit) isn't attempted until there are at least this many points
+LIVE_MIN_POINTS = 5
+# Number of updates in a row that have to agree for a live fit to count as converged
+LIVE_WINDOW = 3
+
+
+def nemotoDisplacement(theta, ior, width, n0=N_AIR):
+    """
+    Displacement of a beam passing through a slab of thickness width and index of
+    refraction ior, rotated by theta (in radians), from Nemoto (1992). The result
+    is in the same units as width.
+    """
+    return width * (1 - (n0 * np.cos(theta)) / np.sqrt(ior**2 - n0**2 * np.sin(theta)**2)) * np.sin(theta)
+
+
+def displacementModel(theta, a0, a1, a2, d, n0=N_AIR):
+    """
+    The functional form that is fit to the data: the Nemoto displacement for a slab of
+    thickness d and index of refraction a2, with a displacement offset a0 and a phase
+    offset a1 to account for the stage not being perfectly centered. Theta should be
+    in radians.
+    """
+    return a0 + nemotoDisplacement(theta - a1, a2, d, n0)
+
+
+def displacementJacobian(theta, a0, a1, a2, d, n0=N_AIR):
+    """
+    Derivatives of displacementModel with respect to (a0, a1, a2), as an array of shape
+    (len(theta), 3).
+    """
+    u = theta - a1
+    s = np.sin(u)
+    c = np.cos(u)
+
+    R = np.sqrt(a2**2 - n0**2 * s**2)
+    R3 = R**3
+
+    jac = np.empty((len(u), 3))
+    jac[:,0] = 1
+    # d/du of s*(1 - n0*c/R), with dR/du = -n0^2*s*c/R
+    jac[:,1] = -d * (c - n0*c**2/R + n0*s**2/R - n0**3 * s**2 * c**2 / R3)
+    jac[:,2] = d * n0 * a2 * s * c / R3
+
+    return jac
+
+
+def toModelAngle(angles):
+    """
+    Convert angles in degrees, as read from the stage, to the angle (in radians) used in
+    the model.
+    """
+    # There may or may not have to be a negative here, not quite sure why
+    return -np.asarray(angles, dtype='double') * np.pi / 180
+
+
+def loadData(file, column='gauss_center', trim=5):
+    """
+    Read a data file saved by the BeamTracking notebook (or a scan, see ScanFile.py), and convert it in the same way as
+    the CurveFitting notebook: angles to radians (with the opposite sign), displacements to
+    mm relative to their mean, and trim points cut off of each end (to avoid issues with
+    centering/interference at the extreme angles).
+
+    Returns the angles and displacements as numpy arrays.
+    """
+    # Either a text file, or a directory in the binary scan format (see ScanFile.py)
+    if os.path.isdir(file):
+        data = loadScan(file)
+    else:
+        data = np.genfromtxt(file, delimiter=',', names=True)
+
+    angleArr = toModelAngle(data['angle'])
+    displacementArr = data[column] * 1e-3 - np.mean(data[column] * 1e-3)
+
+    if trim > 0:
+        angleArr = angleArr[trim:-trim]
+        displacementArr = displacementArr[trim:-trim]
+
+    return angleArr, displacementArr
+
+
+def initialGuess(theta, displacement, d, n0=N_AIR, bounds=DEFAULT_BOUNDS):
+    """
+    Estimate (a0, a1, a2) by evaluating the model for a range of indices of refraction all
+    at once, assuming no phase offset (it is almost always small, and is easy for the fit
+    to find from there). For each index, the best displacement offset is just the mean of
+    the difference, so it doesn't need to be searched for.
+    """
+    lower, upper = bounds
+    iors = np.linspace(lower[2], upper[2], GUESS_GRID_SIZE)
+
+    # Shape (ior, theta)
+    model = nemotoDisplacement(theta[None,:], iors[:,None], d, n0)
+    offsets = np.mean(displacement - model, axis=-1)
+    cost = np.sum((displacement - model - offsets[:,None])**2, axis=-1)
+
+    i = np.argmin(cost)
+
+    guess = np.array([offsets[i], 0, iors[i]])
+    # curve_fit needs the guess to be strictly inside of the bounds
+    return np.clip(guess, np.array(lower) + 1e-9, np.array(upper) - 1e-9)
+
+
+def fitDisplacement(theta, displacement, d, n0=N_AIR, bounds=DEFAULT_BOUNDS, p0=None, full_output=False):
+    """
+    Fit displacementModel to the data, returning popt and pcov for (a0, a1, a2) as with
+    curve_fit (and the infodict from curve_fit as well if full_output is True).
+
+    If p0 isn't given, it is estimated with initialGuess.
+    """
+    theta = np.asarray(theta, dtype='double')
+    displacement = np.asarray(displacement, dtype='double')
+
+    if p0 is None:
+        p0 = initialGuess(theta, displacement, d, n0, bounds)
+
+    def model(theta, a0, a1, a2):
+        return displacementModel(theta, a0, a1, a2, d, n0)
+
+    def jacobian(theta, a0, a1, a2):
+        return displacementJacobian(theta, a0, a1, a2, d, n0)
+
+    # Starting this close to the answer, the bounds are almost never needed, so first try
+    # the (much faster) unbounded Levenberg-Marquardt method, and only fall back on the
+    # bounded one (the same as the notebook) if that ends up out of bounds
+    try:
+        popt, pcov, infodict, mesg, ier = curve_fit(model, theta, displacement, p0=p0, jac=jacobian, full_output=True)
+        inBounds = np.all(popt >= bounds[0]) and np.all(popt <= bounds[1]) and ier in [1, 2, 3, 4]
+    except RuntimeError:
+        inBounds = False
+
+    if not inBounds:
+        popt, pcov, infodict, mesg, ier = curve_fit(model, theta, displacement, p0=p0, jac=jacobian,
+                                                    bounds=bounds, full_output=True)
+
+    if full_output:
+        return popt, pcov, infodict
+
+    return popt, pcov
+
+
+class LiveFit():
+    """
+    Fit of the displacement model that is updated one point at a time as a scan goes on,
+    so that the index of refraction (and its uncertainty) is known before the scan is
+    finished. Each update starts from the previous fit, which is almost always very close,
+    so it only takes a few evaluations of the model.
+
+        fit = LiveFit(d=.99)
+        for angle in angles:
+            ...
+            n, nStd = fit.add(angle, position)
+            if fit.converged(1e-3):
+                break
+    """
+
+    def __init__(self, d, n0=N_AIR, bounds=DEFAULT_BOUNDS, minPoints=LIVE_MIN_POINTS):
+        self.d = d
+        self.n0 = n0
+        self.bounds = bounds
+        self.minPoints = minPoints
+
+        # Everything added so far: angles in degrees (from the stage), positions and their
+        # standard errors in mm
+        self.angles = []
+        self.positions = []
+        self.stderrs = []
+
+        # The beam profiler position has an arbitrary offset, so the displacements are
+        # measured from the first position
+        self._offset = None
+
+        self.params = None
+        self.pcov = None
+
+        # (number of points, n, standard deviation of n) after each successful update
+        self.history = []
+
+    def __len__(self):
+        return len(self.angles)
+
+    @property
+    def n(self):
+        return self.params[2] if self.params is not None else np.nan
+
+    @property
+    def nStd(self):
+        return np.sqrt(self.pcov[2,2]) if self.pcov is not None else np.nan
+
+    def measured(self):
+        """
+        The angles (in degrees), displacements (relative to the first, in mm) and standard
+        errors added so far, leaving out any points that couldn't be measured (nan).
+        """
+        angles = np.array(self.angles, dtype='double')
+        positions = np.array(self.positions, dtype='double')
+        good = np.isfinite(angles) & np.isfinite(positions)
+
+        offset = self._offset if self._offset is not None else 0
+        return angles[good], positions[good] - offset, np.array(self.stderrs, dtype='double')[good]
+
+    def add(self, angle, position, stderr=np.nan):
+        """
+        Add the beam position (in microns, as from the beam profiler) measured at the given
+        angle (in degrees) and update the fit. Returns the current estimate of n and its
+        standard deviation (nan until there are enough points).
+        """
+        self.angles.append(angle)
+        self.positions.append(position * 1e-3)
+        self.stderrs.append(stderr * 1e-3)
+
+        if self._offset is None and np.isfinite(position):
+            self._offset = position * 1e-3
+
+        self._refit()
+        return self.n, self.nStd
+
+    def _refit(self):
+        angles, displacement, stderrs = self.measured()
+        if len(angles) < max(self.minPoints, 4):
+            return
+
+        # Start from the last fit, if there is one
+        p0 = None
+        if self.params is not None:
+            p0 = np.clip(self.params, np.array(self.bounds[0]) + 1e-9, np.array(self.bounds[1]) - 1e-9)
+
+        # With only a few points (all on one side), the fit can wander off to where the
+        # model isn't defined on the way to the answer
+        try:
+            with np.errstate(invalid='ignore'):
+                popt, pcov = fitDisplacement(toModelAngle(angles), displacement, self.d, self.n0, self.bounds, p0)
+        except (RuntimeError, ValueError):
+            return
+
+        if np.all(np.isfinite(popt)) and np.all(np.isfinite(pcov)):
+            self.params = popt
+            self.pcov = pcov
+            self.history.append((len(angles), self.n, self.nStd))
+
+    def converged(self, tolerance, window=LIVE_WINDOW):
+        """
+        Whether the estimate of n has settled down: for the last window updates, its standard
+        deviation has been below tolerance, and it hasn't changed by more than tolerance.
+        """
+        if len(self.history) < window:
+            return False
+
+        recent = np.array(self.history[-window:])
+        return np.all(recent[:,2] < tolerance) and np.ptp(recent[:,1]) < tolerance
+
+
+def layeredDisplacement(theta, thicknesses, iors, n0=N_AIR):
+    """
+    Displacement of a beam passing through a stack of parallel layers, rotated by theta
+    (in radians). The thickness and index of refraction of each layer are along the last
+    axis of thicknesses and iors; any other axes are separate stacks, which are all
+    evaluated at once, giving a result with shape (stacks..., len(theta)).
+
+    Since n0*sin(theta) is the same in every layer (Snell's law), each layer just adds its
+    own Nemoto displacement, and the trig only has to be worked out once for the whole stack.
+    """
+    theta = np.asarray(theta, dtype='double')
+    thicknesses = np.asarray(thicknesses, dtype='double')[...,None]
+    iors = np.asarray(iors, dtype='double')[...,None]
+
+    s = np.sin(theta)
+    c = np.cos(theta)
+
+    # Shape (stacks..., layers, theta)
+    R = np.sqrt(iors**2 - (n0 * s)**2)
+
+    return s * (np.sum(thicknesses, axis=-2) - n0 * c * np.sum(thicknesses / R, axis=-2))
+
+
+def layeredModel(theta, a0, a1, a2, thicknesses, iors, sample=0, n0=N_AIR):
+    """
+    The functional form for a stack of layers (see layeredDisplacement) where the index of
+    refraction of one of them (the sample-th) is unknown: a2 takes the place of iors[sample],
+    and a0 and a1 are the displacement and phase offsets, as in displacementModel.
+    """
+    iors = np.array(iors, dtype='double')
+    iors[...,sample] = a2
+    return a0 + layeredDisplacement(theta - a1, thicknesses, iors, n0)
+
+
+def _layeredResiduals(theta, displacement, params, thicknesses, iors, sample, n0):
+    """
+    Residuals and jacobians of layeredModel for many stacks at once; params should have
+    shape (cells, 3) and thicknesses and iors shape (cells, layers).
+
+    Returns the residuals with shape (cells, len(theta)) and the jacobians with shape
+    (cells, len(theta), 3).
+    """
+    a0, a1, a2 = params[:,0,None], params[:,1,None], params[:,2,None]
+
+    iors = np.array(iors, dtype='double')
+    iors[:,sample] = params[:,2]
+
+    u = theta - a1
+    s = np.sin(u)
+    c = np.cos(u)
+
+    s2 = s * s
+    c2 = c * c
+
+    # Shape (cells, layers, theta), sharing n0^2 sin^2 between all of the layers
+    invR = 1 / np.sqrt((iors * iors)[:,:,None] - (n0 * n0 * s2)[:,None,:])
+    invR3 = invR * invR * invR
+    d = thicknesses[:,:,None]
+
+    total = np.sum(thicknesses, axis=-1)[:,None]
+    sum1 = np.sum(d * invR, axis=1)
+    sum3 = np.sum(d * invR3, axis=1)
+
+    residuals = a0 + s * (total - n0 * c * sum1) - displacement
+
+    jac = np.empty(residuals.shape + (3,))
+    jac[...,0] = 1
+    # The sum over the layers of d * d/du of s*(1 - n0*c/R) (see displacementJacobian)
+    jac[...,1] = -(c * total - n0 * (c2 - s2) * sum1 - n0**3 * s2 * c2 * sum3)
+    jac[...,2] = thicknesses[:,sample,None] * n0 * a2 * s * c * invR3[:,sample]
+
+    return residuals, jac
+
+
+def _layeredGuess(theta, displacement, thicknesses, iors, sample, n0, bounds):
+    """
+    Initial guess for each stack, like initialGuess, but for layeredModel.
+    """
+    guessIors = np.linspace(bounds[0][2], bounds[1][2], GUESS_GRID_SIZE)
+
+    # Shape (cells, guess, layers)
+    trialIors = np.repeat(np.array(iors, dtype='double')[:,None,:], GUESS_GRID_SIZE, axis=1)
+    trialIors[:,:,sample] = guessIors
+
+    # Shape (cells, guess, theta)
+    model = layeredDisplacement(theta, thicknesses[:,None,:], trialIors, n0)
+    offsets = np.mean(displacement - model, axis=-1)
+    cost = np.sum((displacement - model - offsets[...,None])**2, axis=-1)
+
+    best = np.argmin(cost, axis=-1)
+    cells = np.arange(len(thicknesses))
+
+    return np.stack([offsets[cells,best], np.zeros(len(thicknesses)), guessIors[best]], axis=-1)
+
+
+def fitLayers(theta, displacement, thicknesses, iors, sample=0, n0=N_AIR, bounds=DEFAULT_BOUNDS, p0=None):
+    """
+    Fit layeredModel to the data, for a single stack (thicknesses and iors with one entry
+    per layer) or for many stacks at once (shape (stacks, layers)), eg. for a sample in a
+    cuvette, where only the index of refraction of the sample (the middle layer) is unknown:
+
+        popt, pcov = fitLayers(angleArr, displacementArr, [1.25, 1., 1.25], [1.46, 1.33, 1.46], sample=1)
+
+    The value of iors[sample] is ignored. Returns popt and pcov as with fitDisplacement (with
+    an extra leading axis for many stacks).
+    """
+    theta = np.asarray(theta, dtype='double')
+    displacement = np.asarray(displacement, dtype='double')
+    thicknesses = np.asarray(thicknesses, dtype='double')
+    iors = np.asarray(iors, dtype='double')
+
+    single = thicknesses.ndim == 1
+    thicknesses = np.atleast_2d(thicknesses)
+    iors = np.atleast_2d(iors)
+
+    if p0 is None:
+        p0 = _layeredGuess(theta, displacement, thicknesses, iors, sample, n0, bounds)
+    else:
+        p0 = np.broadcast_to(p0, (len(thicknesses), 3))
+
+    def residualFunc(params, cells):
+        return _layeredResiduals(theta, displacement, params, thicknesses[cells], iors[cells], sample, n0)
+
+    popt = _batchLeastSquares(residualFunc, p0, bounds)
+
+    # Covariance scaled by the variance of the residuals, as curve_fit does by default
+    residuals, jac = residualFunc(popt, np.arange(len(popt)))
+    variance = np.sum(residuals**2, axis=-1) / max(len(theta) - 3, 1)
+    pcov = np.linalg.inv(np.einsum('cni,cnj->cij', jac, jac)) * variance[:,None,None]
+
+    if single:
+        return popt[0], pcov[0]
+
+    return popt, pcov
+
+
+def sandwichModel(theta, a0, a1, a2, d1, n1, dtot, n0=N_AIR):
+    """
+    The functional form for a sample between two pieces of glass (see the AdvancedCurveFitting
+    notebook): the Nemoto displacement for the sample, with thickness d1 and index of
+    refraction a2, plus that of the glass, which makes up the rest of the total thickness dtot
+    and has index of refraction n1.
+    """
+    return layeredModel(theta, a0, a1, a2, [d1, dtot - d1], [a2, n1], 0, n0)
+
+
+def _sandwichLayers(d1, n1, dtot):
+    """
+    The sandwich as a stack of two layers (the sample first, with a placeholder index of
+    refraction, then the glass) for many cells, each with shape (cells, 2).
+    """
+    return np.stack([d1, dtot - d1], axis=-1), np.stack([np.ones(len(n1)), n1], axis=-1)
+
+
+def _sandwichResiduals(theta, displacement, params, d1, n1, dtot, n0):
+    """
+    Residuals and jacobians of sandwichModel for many sets of parameters (and values of d1
+    and n1) at once; params should have shape (cells, 3) and d1 and n1 shape (cells,).
+
+    Returns the residuals with shape (cells, len(theta)) and the jacobians with shape
+    (cells, len(theta), 3).
+    """
+    thicknesses, iors = _sandwichLayers(d1, n1, dtot)
+    return _layeredResiduals(theta, displacement, params, thicknesses, iors, 0, n0)
+
+
+def _slabResiduals(theta, displacement, params, d, n0):
+    """
+    Residuals and jacobians of displacementModel for many sets of parameters at once, each
+    with its own data, thickness and n0 (like _sandwichResiduals); theta and displacement
+    should have shape (cells, points) and d and n0 shape (cells,).
+    """
+    residuals = displacementModel(theta, params[:,0,None], params[:,1,None], params[:,2,None],
+                                  d[:,None], n0[:,None]) - displacement
+
+    a1, a2 = params[:,1,None], params[:,2,None]
+    d = d[:,None]
+    n0 = n0[:,None]
+
+    u = theta - a1
+    s = np.sin(u)
+    c = np.cos(u)
+    R = np.sqrt(a2**2 - n0**2 * s**2)
+
+    # See displacementJacobian
+    jac = np.empty(residuals.shape + (3,))
+    jac[...,0] = 1
+    jac[...,1] = -d * (c - n0*c**2/R + n0*s**2/R - n0**3 * s**2 * c**2 / R**3)
+    jac[...,2] = d * n0 * a2 * s * c / R**3
+
+    return residuals, jac
+
+
+def _batchLeastSquares(residualFunc, p0, bounds):
+    """
+    Fit many cells at once with Levenberg-Marquardt, where every step for all of the cells
+    is calculated together (each one is just a 3x3 linear system). Steps that would leave
+    the bounds are clipped to them.
+
+    residualFunc(params, cells) should give the residuals and jacobians (see
+    _sandwichResiduals) for the given cells (an array of indices) with the given parameters.
+
+    Returns the best parameters for each cell, with shape (cells, 3).
+    """
+    lower = np.array(bounds[0])
+    upper = np.array(bounds[1])
+
+    params = np.clip(np.array(p0, dtype='double'), lower, upper)
+    residuals, jac = residualFunc(params, np.arange(len(params)))
+    cost = np.sum(residuals**2, axis=-1)
+
+    damping = np.full(len(params), BATCH_INITIAL_DAMPING)
+    active = np.ones(len(params), dtype=bool)
+
+    for i in range(BATCH_MAX_ITERATIONS):
+        if not np.any(active):
+            break
+
+        indices = np.nonzero(active)[0]
+
+        JTJ = np.einsum('cni,cnj->cij', jac[active], jac[active])
+        gradient = np.einsum('cni,cn->ci', jac[active], residuals[active])
+
+        # Marquardt's scaling of the damping by the diagonal
+        diagonal = np.einsum('cii->ci', JTJ)
+        A = JTJ + damping[active,None,None] * (diagonal[:,:,None] * np.eye(3))
+
+        # Parameters that sit on a bound and are being pushed past it are held fixed
+        # for this step, so the others can still move freely
+        blocked = (((params[active] <= lower) & (gradient > 0))
+                   | ((params[active] >= upper) & (gradient < 0)))
+        free = ~blocked
+        A = A * (free[:,:,None] & free[:,None,:]) + blocked[:,:,None] * np.eye(3)
+        gradient = gradient * free
+
+        step = -np.linalg.solve(A, gradient[...,None])[...,0]
+
+        newParams = np.clip(params[active] + step, lower, upper)
+        newResiduals, newJac = residualFunc(newParams, indices)
+        newCost = np.sum(newResiduals**2, axis=-1)
+
+        better = newCost < cost[active]
+        improved = indices[better]
+
+        # Done once the cost or parameters stop changing (or we can't find any way to
+        # lower the cost); the latter happens when the step is pushing against a bound
+        converged = np.zeros(len(indices), dtype=bool)
+        converged[better] = cost[improved] - newCost[better] <= BATCH_TOLERANCE * cost[improved]
+        converged |= np.all(np.abs(newParams - params[active]) <= BATCH_TOLERANCE * (np.abs(params[active]) + BATCH_TOLERANCE), axis=-1)
+        converged |= damping[indices] > BATCH_MAX_DAMPING
+
+        params[improved] = newParams[better]
+        residuals[improved] = newResiduals[better]
+        jac[improved] = newJac[better]
+        cost[improved] = newCost[better]
+
+        damping[improved] /= 10
+        damping[indices[~better]] *= 10
+
+        active[indices[converged]] = False
+
+    return params
+
+
+def _fitSandwichRows(theta, displacement, d1Arr, n1Arr, dtot, n0, bounds, p0):
+    """
+    Fit each row (value of d1) of the grid in turn, with every cell in a row fit at once.
+    Each row starts from the results of the one before it, which are very close.
+    """
+    results = np.zeros((len(d1Arr), len(n1Arr), 3))
+    n1 = np.array(n1Arr, dtype='double')
+
+    for i in range(len(d1Arr)):
+        d1 = np.full(len(n1), d1Arr[i])
+
+        if i == 0:
+            p0Row = np.tile(p0, (len(n1), 1)) if p0 is not None else _sandwichGuess(theta, displacement, d1, n1, dtot, n0, bounds)
+        else:
+            p0Row = results[i-1]
+
+        def residualFunc(params, cells):
+            return _sandwichResiduals(theta, displacement, params, d1[cells], n1[cells], dtot, n0)
+
+        results[i] = _batchLeastSquares(residualFunc, p0Row, bounds)
+
+    return results
+
+
+def _sandwichGuess(theta, displacement, d1, n1, dtot, n0, bounds):
+    """
+    Initial guess for each cell, like initialGuess, but for sandwichModel.
+    """
+    thicknesses, iors = _sandwichLayers(d1, n1, dtot)
+    return _layeredGuess(theta, displacement, thicknesses, iors, 0, n0, bounds)
+
+
+def fitSandwichGrid(theta, displacement, d1Arr, n1Arr, dtot, n0=N_AIR, bounds=DEFAULT_BOUNDS,
+                    p0=None, processes=None, full_output=False):
+    """
+    Fit sandwichModel for every combination of sample thickness d1 (from d1Arr) and glass
+    index of refraction n1 (from n1Arr), as in the AdvancedCurveFitting notebook, eg.
+
+        fitNArr = fitSandwichGrid(angleArr, displacementArr, dArr, nArr, dtot)
+        plt.pcolor(nArr, dArr, fitNArr, shading='auto')
+
+    Returns the fit index of refraction of the sample with shape (len(d1Arr), len(n1Arr)),
+    or all of the parameters (a0, a1, a2) with shape (len(d1Arr), len(n1Arr), 3) if
+    full_output is True.
+
+    If processes is given, the rows are split into that many blocks, which are fit in
+    parallel in separate processes.
+    """
+    theta = np.asarray(theta, dtype='double')
+    displacement = np.asarray(displacement, dtype='double')
+    d1Arr = np.asarray(d1Arr, dtype='double')
+
+    if processes is None or processes <= 1:
+        results = _fitSandwichRows(theta, displacement, d1Arr, n1Arr, dtot, n0, bounds, p0)
+    else:
+        blocks = np.array_split(d1Arr, processes)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_fitSandwichRows, theta, displacement, block, n1Arr, dtot, n0, bounds, p0)
+                       for block in blocks if len(block) > 0]
+            results = np.concatenate([future.result() for future in futures])
+
+    if full_output:
+        return results
+
+    return results[...,2]
+
+
+def _notebookFit(theta, displacement, d, n0=N_AIR, bounds=DEFAULT_BOUNDS):
+    """
+    The fit as it is done in the CurveFitting notebook, for comparison.
+    """
+    def func_form(theta, a0, a1, a2):
+        return a0 + d*np.sin(theta - a1)*(1 - (n0 * np.cos(theta - a1))/np.sqrt(a2**2 - n0**2 * np.sin(theta - a1)**2))
+
+    popt, pcov, infodict, mesg, ier = curve_fit(func_form, theta, displacement, bounds=bounds, full_output=True)
+    return popt, pcov, infodict
+
+
+# Thickness (in mm) of the single slab samples in data/ (see the CurveFitting notebook)
+SAMPLE_WIDTHS = {'data/bk7_glass.txt': 5.59,
+                 'data/glass_slide_1_700nm.txt': .99,
+                 'data/glass_slide_2_700nm.txt': .99,
+                 'data/sapphire_disk_706nm.txt': 2.29,
+                 'data/sapphire_disk_852nm.txt': 2.29,
+                 'data/sapphire_disk_1014nm.txt': 2.29}
+
+
+def benchmark(repeats=20):
+    """
+    Compare fitDisplacement against the curve_fit call from the CurveFitting notebook on each
+    of the files in SAMPLE_WIDTHS, printing the fit IoR, the total number of evaluations of
+    the model (including those used to estimate the jacobian numerically) and the average
+    time per fit for both.
+    """
+    methods = [('notebook', _notebookFit),
+               ('analytic', lambda theta, displacement, d: fitDisplacement(theta, displacement, d, full_output=True))]
+
+    print(f'{"file":32} {"method":10} {"n":>10} {"evals":>6} {"time [ms]":>10}')
+
+    for file, d in SAMPLE_WIDTHS.items():
+        angleArr, displacementArr = loadData(file)
+
+        for method, fit in methods:
+            popt, pcov, infodict = fit(angleArr, displacementArr, d)
+
+            evaluations = infodict['nfev']
+            if method == 'notebook':
+                # Each numerical jacobian takes one evaluation per parameter
+                evaluations += len(popt) * infodict.get('njev', infodict['nfev'])
+
+            start = perf_counter()
+            for i in range(repeats):
+                fit(angleArr, displacementArr, d)
+            elapsed = (perf_counter() - start) / repeats
+
+            print(f'{file:32} {method:10} {popt[2]:10.5f} {evaluations:6} {1e3*elapsed:10.2f}')
+
+
+# So that the benchmark can be run from the command line
+if __name__ == '__main__':
+    benchmark()
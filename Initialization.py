@@ -1,20 +1,228 @@
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
 # Various serial numbers and things
-from Utils import timeout
+from Utils import timeout, runWithDeadline
+from Instrumentation import instrumented
 import Settings
 
+# How long (in seconds) the status of the devices is trusted before being checked again
+HEALTH_TTL = 5
+
+# Timeouts for connecting to each device; the beam profiler has to start the server
+# and run the drum up to speed, which can take ~10 seconds
+STAGE_TIMEOUT = 2
+BEAM_PROFILER_TIMEOUT = 20
+TINKERFORGE_TIMEOUT = 2
+
+
+class DeviceHealth():
+    """
+    The (connected) handles for all of the devices, along with whether each one is
+    working, eg.
+
+        devices = probeDevices()
+        if devices.working():
+            scan = ScanRunner(devices.stage, devices.bp2Device, angles, sensors=devices.sensors())
+
+    Any device that couldn't be connected to is None, and why is in errors (the exception,
+    under the same name as in status). The status is cached for ttl seconds, so it can be
+    checked often (eg. at every angle of a scan) without bothering the devices.
+    """
+
+    def __init__(self, ttl=HEALTH_TTL):
+        self.stage = None
+        self.bp2Device = None
+        self.ipcon = None
+        self.humiditySensor = None
+        self.temperatureSensor = None
+        self.errors = {}
+
+        self.ttl = ttl
+        self._status = {}
+        self._lastChecked = None
+        self._lock = threading.Lock()
+
+    def status(self, refresh=False):
+        """
+        Dictionary of whether each component is working, checking them again if the cached
+        status is older than ttl (or refresh is True).
+        """
+        with self._lock:
+            if refresh or self._lastChecked is None or monotonic() - self._lastChecked > self.ttl:
+                self._status = self._check()
+                self._lastChecked = monotonic()
+
+            return dict(self._status)
+
+    def working(self, refresh=False):
+        """
+        Whether every component is working (see status).
+        """
+        return all(self.status(refresh).values())
+
+    def sensors(self):
+        """
+        The tinkerforge sensors as a dictionary of functions, in the form that ScanRunner
+        takes, and in the same units as the BeamTracking notebook.
+        """
+        sensors = {}
+        if self.temperatureSensor is not None:
+            sensors['temp'] = instrumented('tinkerforge.temp')(lambda: self.temperatureSensor.get_temperature()/100)
+        if self.humiditySensor is not None:
+            sensors['humid'] = instrumented('tinkerforge.humid')(lambda: self.humiditySensor.get_humidity()/10)
+
+        return sensors
+
+    def environment(self, period=None):
+        """
+        An EnvironmentSampler (see Environment.py) that records the tinkerforge sensors in
+        the background, under the same names and in the same units as sensors(). It is
+        already started, and should be stopped when it is no longer needed.
+        """
+        from Environment import EnvironmentSampler, DEFAULT_PERIOD
+
+        environment = EnvironmentSampler(period if period is not None else DEFAULT_PERIOD)
+        if self.temperatureSensor is not None:
+            environment.addBricklet('temp', self.temperatureSensor, 'temperature', 1/100)
+        if self.humiditySensor is not None:
+            environment.addBricklet('humid', self.humiditySensor, 'humidity', 1/10)
+
+        environment.start()
+        return environment
+
+    def disconnect(self):
+        """
+        Disconnect from everything that was connected to.
+        """
+        for device in [self.stage, self.bp2Device, self.ipcon]:
+            if device is None:
+                continue
+            try:
+                device.disconnect()
+            except:
+                pass
+
+        self.stage = self.bp2Device = self.ipcon = None
+        self.humiditySensor = self.temperatureSensor = None
+        self._lastChecked = None
+
+    def _check(self):
+        status = {}
+
+        try:
+            self.stage.getAngle()
+            status['Rotation stage'] = True
+        except:
+            status['Rotation stage'] = False
+
+        try:
+            status['Beam profiler'] = self.bp2Device.getStatus() == 0
+        except:
+            status['Beam profiler'] = False
+
+        try:
+            self.humiditySensor.get_humidity()
+            status['Tinkerforge humidity sensor'] = True
+        except:
+            status['Tinkerforge humidity sensor'] = False
+
+        try:
+            self.temperatureSensor.get_temperature()
+            status['Tinkerforge temperature sensor'] = True
+        except:
+            status['Tinkerforge temperature sensor'] = False
+
+        return status
+
+
+def _probeStage(devices):
+    import ESP301Control
+
+    rotStage = ESP301Control.RotationStage(Settings.MOTION_CONTROLLER_PORT, Settings.ROTATION_STAGE_AXIS_NUM)
+    # Have to have a timeout, so it doesn't hang forever
+    # This one should be pretty instant if it is working correctly, so
+    # the timeout doesn't need to be that long
+    status = runWithDeadline(rotStage.connect, STAGE_TIMEOUT, cleanup=[rotStage.disconnect])
+    if status != 0:
+        rotStage.disconnect()
+        raise Exception(f'Could not connect to the motion controller on {Settings.MOTION_CONTROLLER_PORT} (status {status})')
+
+    devices.stage = rotStage
+
+
+def _probeBeamProfiler(devices):
+    import TLBP2Control
+
+    bpDevice = TLBP2Control.TLBP2()
+
+    # If it takes too long, the server is killed and the pipe closed
+    if bpDevice.connect(timeout=BEAM_PROFILER_TIMEOUT) != 0:
+        bpDevice.disconnect()
+        raise Exception('Beam profiler is connected, but not ready to measure')
+
+    devices.bp2Device = bpDevice
+
+
+def _probeTinkerforge(devices):
+    from tinkerforge.ip_connection import IPConnection
+    from tinkerforge.bricklet_humidity import BrickletHumidity
+    from tinkerforge.bricklet_temperature import BrickletTemperature
+
+    ipcon = IPConnection()
+    # Hangs if the brick daemon doesn't answer
+    runWithDeadline(ipcon.connect, TINKERFORGE_TIMEOUT, Settings.TF_HOST, Settings.TF_PORT, cleanup=[ipcon.disconnect])
+
+    devices.ipcon = ipcon
+    devices.humiditySensor = BrickletHumidity(Settings.TF_HUMIDITY_UID, ipcon)
+    devices.temperatureSensor = BrickletTemperature(Settings.TF_TEMP_UID, ipcon)
+
+
+def probeDevices(ttl=HEALTH_TTL):
+    """
+    Connect to all of the components at the same time, so the whole thing takes as long
+    as the slowest one (usually the beam profiler) rather than the sum of them.
+
+    Returns a DeviceHealth holding whatever could be connected to; these connections are
+    left open so they can be used right away. If a probe fails, its devices are left as
+    None, and the exception is kept in DeviceHealth.errors.
+    """
+    devices = DeviceHealth(ttl)
+
+    # Which components (as named in DeviceHealth.status) each probe connects to
+    probes = {_probeStage: ['Rotation stage'],
+              _probeBeamProfiler: ['Beam profiler'],
+              _probeTinkerforge: ['Tinkerforge humidity sensor', 'Tinkerforge temperature sensor']}
+
+    # Each probe has its own timeout, so this can't wait any longer than the longest one
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {executor.submit(probe, devices): components for probe, components in probes.items()}
+
+    for future, components in futures.items():
+        error = future.exception()
+        if error is not None:
+            for component in components:
+                devices.errors[component] = error
+
+    devices.status(refresh=True)
+    return devices
+
+
 def fastInitialization(printInfo=True):
     """
     Determine which components are available without giving any diagnostic advice.
 
+    The devices are disconnected afterwards; to keep the connections to use for a
+    measurement, use probeDevices() instead.
+
     Returns
     -------
 
     True : All components available
     False : Not all components available
     """
-    failed = False
-
     def printif(msg, **kwargs):
         if printInfo:
             print(msg, **kwargs)
@@ -29,90 +237,20 @@ def fastInitialization(printInfo=True):
         from tinkerforge.bricklet_temperature import BrickletTemperature
 
     except Exception as e:
-        printif("Not all imports are available: {e}")
+        printif(f"Not all imports are available: {e}")
         return False
 
-    # First, check the rotation stage
-
-    printif('Rotation stage' + '.'*20, end='')
-    try:
-        rotStage = ESP301Control.RotationStage(Settings.MOTION_CONTROLLER_PORT, Settings.ROTATION_STAGE_AXIS_NUM)
-        # Have to have a timeout, so it doesn't hang forever
-        # This one should be pretty instant if it is working correctly, so
-        # the timeout doesn't need to be that long
-        @timeout(2) 
-        def testStage():
-            return rotStage.connect()
-
-        testStage()
-        printif('Working')
-
-        rotStage.disconnect()
-    except:
-        printif('Error')
-        failed = True
-
-    # Next, check the beam profiler
-
-    printif('Beam profiler' + '.'*21, end='')
-    try:
-        bpDevice = TLBP2Control.TLBP2()
-
-        # It can take a moment to get the pipe working, so this timeout is a little longer
-        # The drum also has to run up to speed, which can take ~10 seconds
-        @timeout(20)
-        def testBP():
-            return bpDevice.connect()
-        status = testBP()
-
-        # Measure just to make sure it doesn't throw an error
-        measure = bpDevice.getMeasurement()
-
-        if status == 0:
-            printif('Working')
-        else:
-            printif('Error')
-            failed = True
-        
-        bpDevice.disconnect()
-    except:
-        printif('Error')
-        failed = True
-
-    # Next, the tinkerforge stuff
-    printif('Tinkerforge brick' + '.'*17, end='')
-    try:
-        ipcon = IPConnection()
-        humidity = BrickletHumidity(Settings.TF_HUMIDITY_UID, ipcon)
-        temperature = BrickletTemperature(Settings.TF_TEMP_UID, ipcon)
-
-        ipcon.connect(TF_HOST, TF_PORT)
-
-        # Try each one to check
-
-        printif(5 * ' ' + 'Humidity sensor' + '.'*14, end='')
-        try:
-            humidity.get_humidity()
-            printif('Working')
-        except:
-            printif('Error')
-            failed = True
-
-        printif(5 * ' ' + 'Temperature sensor' + '.'*11, end='')
-        try:
-            temperature.get_temperature()
-            printif('Working')
-        except:
-            printif('Error')
-            failed = True
+    devices = probeDevices()
+    status = devices.status()
+    devices.disconnect()
 
-        ipcon.disconnect()
-    except:
-        printif('Error')
-        failed = True
+    for component, working in status.items():
+        error = devices.errors.get(component)
+        printif(component + '.'*(34 - len(component)) + ('Working' if working else 'Error')
+                + (f' ({error!r})' if error is not None and not working else ''))
 
     printif('Initialization complete!')
-    return not failed
+    return all(status.values())
 
 
 def fullInitialization():
@@ -331,10 +469,7 @@ def fullInitialization():
                 bpDevice = TLBP2Control.TLBP2()
 
                 # It can take a moment to get the pipe working, so this timeout is a little longer
-                @timeout(20)
-                def testBP():
-                    return bpDevice.connect()
-                status = testBP()
+                status = bpDevice.connect(timeout=20)
 
                 # Measure just to make sure it doesn't throw an error
                 measure = bpDevice.getMeasurement()
@@ -0,0 +1,220 @@
+"""
+Opt-in timing of the calls that a scan spends its time in (the pipe to the beam profiler
+server, parsing measurements, polling the rotation stage, reading the tinkerforge sensors),
+as latency histograms and counters:
+
+    from Instrumentation import Recorder
+
+    with Recorder(trace=True) as recorder:
+        scan.run()
+
+    recorder.printSummary()
+    recorder.writeTrace('scan_trace.json')
+
+Nothing is recorded unless a Recorder is active, in which case every instrumented call (from
+any thread) goes to it; when none are, each instrumented call only costs a check of a list.
+The trace file can be opened in chrome://tracing or https://ui.perfetto.dev to see exactly
+when each call happened.
+
+Functions are instrumented with the @instrumented(name) decorator, blocks of code with
+`with timed(name):`, and events (eg. failed measurements) are counted with count(name).
+"""
+import functools
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+
+# Histogram bins are spaced evenly in log(latency), with this many per factor of 10,
+# from 1 microsecond up to 100 seconds (anything outside goes in the first/last bin)
+BINS_PER_DECADE = 10
+MIN_LATENCY = 1e-6
+MAX_LATENCY = 100
+
+# Recorders that are currently active; everything instrumented is recorded into all of them
+_recorders = []
+_recordersLock = threading.Lock()
+
+
+class LatencyHistogram():
+
+    def __init__(self):
+        decades = int(round(np.log10(MAX_LATENCY / MIN_LATENCY)))
+        self.edges = MIN_LATENCY * 10**(np.arange(decades * BINS_PER_DECADE + 1) / BINS_PER_DECADE)
+        self.counts = np.zeros(len(self.edges) + 1, dtype='int64')
+
+        self.count = 0
+        self.total = 0.
+        self.min = np.inf
+        self.max = 0.
+
+    def add(self, latency):
+        self.counts[np.searchsorted(self.edges, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.min = min(self.min, latency)
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """
+        Approximate q-th percentile (0-100) of the latencies: the upper edge of the bin that
+        it falls in (so within about 25% of the true value).
+        """
+        if self.count == 0:
+            return np.nan
+
+        i = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        return min(self.edges[min(i, len(self.edges) - 1)], self.max)
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count > 0 else np.nan,
+                'min': self.min if self.count > 0 else np.nan,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': self.max if self.count > 0 else np.nan}
+
+
+class Recorder():
+
+    def __init__(self, trace=False):
+        """
+        If trace is True, every call is also kept (with when it started, and on which
+        thread), for writeTrace.
+        """
+        self.histograms = {}
+        self.counters = {}
+        self.trace = [] if trace else None
+
+        self._lock = threading.Lock()
+        self._started = None
+
+    def start(self):
+        self._started = perf_counter()
+        with _recordersLock:
+            if self not in _recorders:
+                _recorders.append(self)
+
+    def stop(self):
+        with _recordersLock:
+            if self in _recorders:
+                _recorders.remove(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _add(self, name, start, latency):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].add(latency)
+
+            if self.trace is not None:
+                self.trace.append((name, start, latency, threading.get_ident()))
+
+    def _count(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Latency statistics (in seconds) for each instrumented call, and the counters, as
+        {'latency': {name: {...}}, 'counters': {name: n}}.
+        """
+        with self._lock:
+            return {'latency': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def printSummary(self):
+        summary = self.summary()
+
+        print(f'{"call":28} {"count":>7} {"total [s]":>10} {"mean [ms]":>10} {"p50 [ms]":>9} {"p99 [ms]":>9} {"max [ms]":>9}')
+        for name, stats in summary['latency'].items():
+            print(f'{name:28} {stats["count"]:7d} {stats["total"]:10.3f} {1e3*stats["mean"]:10.3f} '
+                  f'{1e3*stats["p50"]:9.3f} {1e3*stats["p99"]:9.3f} {1e3*stats["max"]:9.3f}')
+
+        for name, n in summary['counters'].items():
+            print(f'{name:28} {n:7d}')
+
+    def writeTrace(self, path):
+        """
+        Write every call that was recorded (see trace in __init__) in the Chrome trace event
+        format, with times in microseconds from when the recorder was started.
+        """
+        if self.trace is None:
+            raise ValueError('Recorder was not created with trace=True')
+
+        with self._lock:
+            events = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': thread,
+                       'ts': 1e6 * (start - self._started), 'dur': 1e6 * latency}
+                      for name, start, latency, thread in self.trace]
+
+        with open(path, 'w') as outFile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outFile)
+
+
+def isEnabled():
+    """
+    Whether anything is being recorded, eg. to skip working out a value just to count it.
+    """
+    return len(_recorders) > 0
+
+
+def _record(name, start, latency):
+    for recorder in list(_recorders):
+        recorder._add(name, start, latency)
+
+
+def count(name, n=1):
+    """
+    Add n to the counter name in every active recorder.
+    """
+    if not _recorders:
+        return
+    for recorder in list(_recorders):
+        recorder._count(name, n)
+
+
+def instrumented(name):
+    """
+    Decorator that records how long each call of the function takes, under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _recorders:
+                return func(*args, **kwargs)
+
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, start, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def timed(name):
+    """
+    Record how long the body of a with statement takes, under name.
+    """
+    if not _recorders:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, start, perf_counter() - start)
@@ -0,0 +1,155 @@
+"""
+Live plot of a scan as it runs, which (unlike redrawing the whole figure after every angle,
+as in the BeamTracking notebook) never holds up the measurements:
+
+    from LiveView import LiveView
+
+    scan = ScanRunner(stage, bp2Device, np.arange(50, -51, -1), sensors=sensors, thickness=.99)
+    results = LiveView(scan).watch()
+
+watch() runs the scan in a background thread and redraws the plot from the calling thread,
+at most maxFps times per second. The scan only tells the view which angle has just finished
+(see ScanRunner.subscribe), and the plot is updated in place (rather than being drawn again
+from scratch), with the points thinned out if there are more than maxPoints of them.
+
+In a notebook, this works best with an interactive backend (%matplotlib widget), but with
+the default inline backend the image is replaced at each redraw instead.
+"""
+import threading
+from time import monotonic
+
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from Scan import BEAM_STD_COLUMNS
+
+DEFAULT_MAX_FPS = 4
+DEFAULT_MAX_POINTS = 500
+
+
+class LiveView():
+
+    def __init__(self, scan, column='gauss_center', maxFps=DEFAULT_MAX_FPS, maxPoints=DEFAULT_MAX_POINTS, ax=None):
+        """
+        Plot column (with its standard deviation as error bars) against angle for the given
+        ScanRunner, on ax (a new figure by default).
+        """
+        self.scan = scan
+        self.column = column
+        self.stdColumn = BEAM_STD_COLUMNS.get(column)
+        self.maxFps = maxFps
+        self.maxPoints = maxPoints
+
+        if ax is None:
+            fig, ax = plt.subplots()
+        self.ax = ax
+        self.fig = ax.figure
+
+        # Created once, and then only their data is changed
+        self.points, = ax.plot([], [], 'o', markersize=3)
+        self.errorBars = LineCollection([], linewidths=1, colors=self.points.get_color())
+        ax.add_collection(self.errorBars)
+
+        ax.set_xlabel('Angle [deg]')
+        ax.set_ylabel(f'{column} [$\\mu$m]')
+
+        # Number of finished angles, as of the last time the scan told us (see _onAngle)
+        self._latest = 0
+        self._drawn = 0
+        self._display = None
+
+        scan.subscribe(self._onAngle)
+
+    def _onAngle(self, i):
+        # Called from the scan's thread, so this just makes a note for the next redraw
+        self._latest = max(self._latest, i + 1)
+
+    def _thin(self, *arrays):
+        """
+        Every n-th point, so that there are at most maxPoints of them.
+        """
+        step = int(np.ceil(len(arrays[0]) / self.maxPoints)) if self.maxPoints else 1
+        return [array[::max(step, 1)] for array in arrays]
+
+    def update(self):
+        """
+        Redraw the plot with everything that has been measured so far, if anything has
+        changed since the last time.
+        """
+        count = self._latest
+        if count == self._drawn:
+            return False
+        self._drawn = count
+
+        results = self.scan.results
+        angles = results['angle'][:count]
+        values = results[self.column][:count]
+        stds = results[self.stdColumn][:count] if self.stdColumn is not None else np.zeros(count)
+
+        good = np.isfinite(angles) & np.isfinite(values)
+        angles, values, stds = self._thin(angles[good], values[good], np.nan_to_num(stds[good]))
+
+        segments = np.stack([np.stack([angles, values - stds], axis=-1),
+                             np.stack([angles, values + stds], axis=-1)], axis=1)
+        self.points.set_data(angles, values)
+        self.errorBars.set_segments(segments)
+
+        liveFit = getattr(self.scan, 'liveFit', None)
+        if liveFit is not None and np.isfinite(liveFit.n):
+            self.ax.set_title(f'n = {liveFit.n:.4f} $\\pm$ {liveFit.nStd:.4f}   ({count} angles)')
+        else:
+            self.ax.set_title(f'{count} angles')
+
+        # relim only looks at the points, so the ends of the error bars are added separately
+        self.ax.relim()
+        if len(segments) > 0:
+            self.ax.update_datalim(segments.reshape(-1, 2))
+        self.ax.autoscale_view()
+        self._draw()
+
+        return True
+
+    def _draw(self):
+        if 'inline' in matplotlib.get_backend():
+            # Nothing to update in place, so the image in the notebook has to be replaced
+            from IPython.display import display
+            if self._display is None:
+                self._display = display(self.fig, display_id=True)
+            else:
+                self._display.update(self.fig)
+        else:
+            self.fig.canvas.draw_idle()
+            self.fig.canvas.flush_events()
+
+    def watch(self):
+        """
+        Run the scan in a background thread, updating the plot until it is finished, and
+        return the results (see ScanRunner.run).
+        """
+        outcome = {}
+
+        def runScan():
+            try:
+                outcome['results'] = self.scan.run()
+            except BaseException as e:
+                outcome['error'] = e
+
+        thread = threading.Thread(target=runScan, daemon=True)
+        thread.start()
+
+        interval = 1 / self.maxFps
+        while thread.is_alive():
+            start = monotonic()
+            self.update()
+            thread.join(max(interval - (monotonic() - start), 0))
+
+        # The scan might have finished (or stopped early) since the last redraw
+        self._latest = self.scan.completed
+        self.update()
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        return outcome['results']
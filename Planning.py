@@ -0,0 +1,201 @@
+"""
+Choosing which angles to measure at. The BeamTracking notebook steps through every degree
+from 50 to -50, but most of those angles say very little about the index of refraction:
+near normal incidence the displacement hardly depends on it at all, while at large angles
+it depends on it strongly. Given the thickness of the sample (and a rough idea of its index
+of refraction), planAngles picks the angles that pin down the index of refraction best,
+using the derivatives of the displacement model (see Fitting.displacementJacobian):
+
+    from Planning import planAngles, iorStderr
+
+    angles = planAngles(d=.99, numAngles=20, ior=1.5)
+    # Predicted uncertainty in n (for 1 micron of noise in each point) compared to a full sweep
+    iorStderr(angles, d=.99), iorStderr(np.arange(45, -46, -1), d=.99)
+
+A ScanPlanner does the same thing during a scan, refitting the data after each angle and
+re-planning the angles that are left with the new fit and the noise that has actually been
+measured:
+
+    planner = ScanPlanner(d=.99, numAngles=20)
+    scan = ScanRunner(stage, bp2Device, planner.angles, planner=planner)
+    scan.run()
+    angleArr, displacementArr = loadData('data/sample.txt', trim=0)
+
+Since the planned angles already avoid the extremes, there is no need to trim the data
+before fitting it. Angles here are in degrees, as read from the stage (see Fitting.loadData for the conversion
+to the angle used in the model). The angles are always measured in one sweep from the
+largest to the smallest, so the stage never has to double back.
+"""
+import numpy as np
+
+from Fitting import N_AIR, DEFAULT_BOUNDS, displacementJacobian, toModelAngle, LiveFit
+
+# The analysis notebooks trim the 5 outermost points off of each end of a 50 to -50 sweep,
+# so by default angles are chosen from within that range
+MAX_ANGLE = 45
+ANGLE_STEP = 1
+
+# Noise (standard error, in microns) assumed for each point before any have been measured
+DEFAULT_NOISE = 1.
+
+# The fit isn't updated during a scan until there are at least this many points
+MIN_FIT_POINTS = 5
+
+# Very loose prior on (a0 in mm, a1 in radians, a2), so that the first few angles can be
+# chosen before there are enough of them to determine all three parameters
+PRIOR_STD = np.array([10, .1, .5])
+
+
+def iorStderr(angles, d, ior=1.5, noise=DEFAULT_NOISE, a1=0, n0=N_AIR):
+    """
+    Predicted standard error of the fit index of refraction for a scan at the given angles
+    (in degrees), where noise is the standard error of each point in microns (either a single
+    value, or one for each angle).
+    """
+    theta = toModelAngle(angles)
+    jac = displacementJacobian(theta, 0, a1, ior, d, n0)
+    weights = 1 / np.broadcast_to(np.asarray(noise, dtype='double') * 1e-3, theta.shape)**2
+
+    information = np.einsum('ni,n,nj->ij', jac, weights, jac)
+    return np.sqrt(np.linalg.inv(information)[2,2])
+
+
+def _chooseAngles(jac, noise, covariance, count):
+    """
+    Greedily choose count of the candidate points (each with a row of jac, the derivatives
+    of the model, and its noise in mm), each time taking the one that lowers the variance
+    of the index of refraction the most, given the current covariance of the parameters.
+    Each point can only be chosen once.
+
+    The covariance after adding a point is found directly from the one before (Sherman-Morrison),
+    so every candidate can be checked at once.
+
+    Returns the indices of the chosen points, in the order they were chosen.
+    """
+    covariance = covariance.copy()
+    available = np.ones(len(jac), dtype=bool)
+    chosen = []
+
+    for i in range(min(count, len(jac))):
+        cj = jac @ covariance
+        # Reduction in the variance of a2 from adding each point
+        gain = cj[:,2]**2 / (noise**2 + np.sum(cj * jac, axis=-1))
+        gain[~available] = -np.inf
+
+        best = np.argmax(gain)
+        chosen.append(best)
+        available[best] = False
+
+        cb = cj[best]
+        covariance -= np.outer(cb, cb) / (noise[best]**2 + cb @ jac[best])
+
+    return np.array(chosen, dtype=int)
+
+
+def _priorInformation():
+    return np.diag(1 / PRIOR_STD**2)
+
+
+def planAngles(d, numAngles=20, ior=1.5, noise=DEFAULT_NOISE, a1=0, n0=N_AIR, candidates=None):
+    """
+    Choose numAngles angles (in degrees, from candidates, by default every degree between
+    MAX_ANGLE and -MAX_ANGLE) that give the smallest uncertainty in the index of refraction
+    of a sample of thickness d (in mm), assuming it is about ior. noise is the standard
+    error of each point in microns, which only matters if it is different for each candidate.
+
+    Returns the angles in the order they should be measured (largest to smallest).
+    """
+    if candidates is None:
+        candidates = np.arange(MAX_ANGLE, -MAX_ANGLE - ANGLE_STEP/2, -ANGLE_STEP)
+    candidates = np.asarray(candidates, dtype='double')
+
+    jac = displacementJacobian(toModelAngle(candidates), 0, a1, ior, d, n0)
+    noise = np.broadcast_to(np.asarray(noise, dtype='double') * 1e-3, candidates.shape)
+
+    chosen = _chooseAngles(jac, noise, np.linalg.inv(_priorInformation()), numAngles)
+    return np.sort(candidates[chosen])[::-1]
+
+
+class ScanPlanner():
+
+    def __init__(self, d, numAngles=20, ior=1.5, n0=N_AIR, noise=DEFAULT_NOISE, candidates=None,
+                 bounds=DEFAULT_BOUNDS, adaptive=True):
+        """
+        Plan a scan of numAngles angles for a sample of thickness d (in mm), which is about
+        ior (see planAngles). If adaptive is True, the angles that are left are chosen again
+        after each one is measured (see update).
+        """
+        if candidates is None:
+            candidates = np.arange(MAX_ANGLE, -MAX_ANGLE - ANGLE_STEP/2, -ANGLE_STEP)
+
+        self.d = d
+        self.n0 = n0
+        self.noise = noise
+        self.adaptive = adaptive
+        self.candidates = np.sort(np.asarray(candidates, dtype='double'))[::-1]
+
+        # Initial estimate of (a0, a1, a2), until there are enough points to fit
+        self.guess = np.array([0, 0, ior], dtype='double')
+
+        self.angles = planAngles(d, numAngles, ior, noise, 0, n0, self.candidates)
+
+        # Everything that has been measured so far, and the fit to it
+        self.fit = LiveFit(d, n0, bounds, MIN_FIT_POINTS)
+
+    def __len__(self):
+        return len(self.angles)
+
+    @property
+    def params(self):
+        return self.fit.params if self.fit.params is not None else self.guess
+
+    def nextAngle(self):
+        """
+        The next angle to measure, or None if the scan is finished.
+        """
+        i = len(self.fit)
+        return self.angles[i] if i < len(self.angles) else None
+
+    def update(self, angle, position, stderr):
+        """
+        Add a measurement: the beam position (in microns, as from the beam profiler) at the
+        given angle, and its standard error. Once there are enough points, the model is fit
+        again (starting from the last fit, see Fitting.LiveFit) and, if adaptive, the rest
+        of the angles are re-planned from the candidates that the sweep hasn't passed yet.
+        """
+        self.fit.add(angle, position, stderr)
+
+        if self.adaptive:
+            self._replan()
+
+    def _replan(self):
+        done = len(self.fit)
+        remaining = len(self.angles) - done
+        if remaining <= 0:
+            return
+
+        # The sweep only goes one way, so we can only choose from what is left of it
+        candidates = self.candidates[self.candidates < self.angles[done-1]]
+        if len(candidates) == 0:
+            return
+
+        angles, displacement, stderrs = self.fit.measured()
+        if len(angles) == 0:
+            return
+        stderrs[~(stderrs > 0)] = self.noise * 1e-3
+
+        a0, a1, ior = self.params
+        measuredJac = displacementJacobian(toModelAngle(angles), a0, a1, ior, self.d, self.n0)
+
+        information = _priorInformation() + np.einsum('ni,n,nj->ij', measuredJac, 1 / stderrs**2, measuredJac)
+
+        # Assume that the points still to come will be about as noisy as the ones so far
+        jac = displacementJacobian(toModelAngle(candidates), a0, a1, ior, self.d, self.n0)
+        noise = np.full(len(candidates), np.median(stderrs))
+
+        chosen = _chooseAngles(jac, noise, np.linalg.inv(information), remaining)
+        planned = np.sort(candidates[chosen])[::-1]
+
+        # If there are fewer candidates left than angles still to measure, the plan (and so
+        # the scan) gets shorter
+        self.angles = np.concatenate([self.angles[:done], planned])
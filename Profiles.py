@@ -0,0 +1,110 @@
+"""
+Estimating the beam center from the raw profiles measured by the beam profiler (see
+TLBP2.getProfiles), rather than taking the device's own centroid and gaussian fit as they
+are, eg. to redo the scans where the gaussian fit misbehaves:
+
+    from Profiles import profileCentroids, gaussianCenters
+
+    samples, positions, intensities = bp2Device.getProfiles(100)
+    centroids = profileCentroids(positions, intensities)
+    centers, diameters, amplitudes = gaussianCenters(positions, intensities)
+
+Every function works on any number of profiles at once: positions and intensities can have
+any shape, as long as the points of each profile are along the last axis (eg. (n, 2, L)
+straight from getProfiles, giving results of shape (n, 2)), and there are no loops over
+the profiles in python, so thousands of them can be redone in a fraction of a second.
+
+Only the points above threshold (as a fraction of the highest point in each profile) are
+used, like the clip level on the device, so that the noise in the wings of the profile
+doesn't pull the center around. Profiles that an estimate can't be made for (eg. those of
+invalid samples, which are all zeros) give nan.
+"""
+import numpy as np
+
+# Points below this fraction of the peak of a profile are ignored (1/e^2, as for the beam width)
+DEFAULT_THRESHOLD = .135
+
+
+def _weights(intensities, threshold):
+    """
+    Intensities (as doubles) normalized by the peak of each profile, and whether each point is
+    above threshold.
+    """
+    intensities = np.asarray(intensities, dtype='double')
+    peak = intensities.max(axis=-1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        normalized = intensities / peak
+    above = (normalized >= threshold) & (peak > 0)
+
+    return np.where(above, normalized, 0.), above
+
+
+def profileCentroids(positions, intensities, threshold=DEFAULT_THRESHOLD):
+    """
+    Intensity weighted mean position of each profile, in the same units as positions.
+    """
+    weights, above = _weights(intensities, threshold)
+    positions = np.asarray(positions, dtype='double')
+
+    total = weights.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total > 0, (weights * positions).sum(axis=-1) / total, np.nan)
+
+
+def gaussianCenters(positions, intensities, threshold=DEFAULT_THRESHOLD):
+    """
+    Fit a gaussian to each profile by fitting a parabola to the log of the intensities
+    (Caruana's method), which, unlike a nonlinear fit, has a closed form, so every profile
+    can be fit at once. Each point is weighted by the square of its intensity, to make up
+    for the noise being blown up by the log at low intensities (Guo, 2011).
+
+    Returns (centers, diameters, amplitudes): the center of each gaussian and its 1/e^2
+    diameter, in the same units as positions, and its peak, in the same units as the
+    intensities.
+    """
+    weights, above = _weights(intensities, threshold)
+    positions = np.asarray(positions, dtype='double')
+
+    # The parabola is fit around the centroid, in units of the spread of the points about
+    # it, so that the normal equations stay well conditioned whatever the units
+    total = weights.sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        origin = (weights * positions).sum(axis=-1, keepdims=True) / total
+        scale = np.sqrt((weights * (positions - origin)**2).sum(axis=-1, keepdims=True) / total)
+        x = np.where(above, (positions - origin) / scale, 0.)
+    logIntensity = np.log(np.where(above, weights, 1.))
+
+    # Weighted least squares for log(I) = a + b x + c x^2, solving the normal equations
+    # of every profile in one go
+    moments = []
+    projections = []
+    term = weights**2
+    for k in range(5):
+        moments.append(term.sum(axis=-1))
+        if k < 3:
+            projections.append((term * logIntensity).sum(axis=-1))
+        term = term * x
+    lhs = np.stack([np.stack(moments[i:i+3], axis=-1) for i in range(3)], axis=-2)
+    rhs = np.stack(projections, axis=-1)
+
+    # Fewer than three points (or a flat profile) can't be fit, so those are solved as
+    # something harmless and thrown away afterwards
+    singular = ~(np.abs(np.linalg.det(lhs)) > 1e-12) | ~np.isfinite(lhs).all(axis=(-2, -1))
+    lhs[singular] = np.eye(3)
+    rhs[singular] = 0
+    a, b, c = np.moveaxis(np.linalg.solve(lhs, rhs[..., None])[..., 0], -1, 0)
+
+    # Only a parabola that opens downwards is a gaussian
+    bad = singular | ~(c < 0)
+    c = np.where(bad, -1., c)
+
+    origin, scale = origin[..., 0], scale[..., 0]
+    peak = np.asarray(intensities, dtype='double').max(axis=-1)
+
+    centers = np.where(bad, np.nan, origin - scale * b / (2 * c))
+    # log(I) falls by 2 over the 1/e^2 radius, so c r^2 = -2
+    diameters = np.where(bad, np.nan, 2 * scale * np.sqrt(-2 / c))
+    amplitudes = np.where(bad, np.nan, peak * np.exp(a - b**2 / (4 * c)))
+
+    return centers, diameters, amplitudes
@@ -0,0 +1,475 @@
+"""
+Library version of the measurement loop in the BeamTracking notebook: move the stage through
+a list of angles, and measure the beam position (and any other sensors) at each one.
+
+    from Scan import ScanRunner
+
+    sensors = {'temp': lambda: temperatureSensor.get_temperature()/100,
+               'humid': lambda: humiditySensor.get_humidity()/10}
+
+    scan = ScanRunner(stage, bp2Device, np.arange(50, -51, -1), samplesPerAngle=20, sensors=sensors)
+    results = scan.run()
+    scan.save('data/sample_700nm.txt')
+
+    # Or, keep sampling each angle until the gaussian center is known to within 0.5 microns
+    scan = ScanRunner(stage, bp2Device, np.arange(50, -51, -1), sensors=sensors, targetStderr=.5)
+
+    # Or, only measure at the angles that say the most about the index of refraction (see Planning.py)
+    planner = ScanPlanner(d=.99, numAngles=20)
+    scan = ScanRunner(stage, bp2Device, planner.angles, sensors=sensors, planner=planner)
+
+    # Or, fit the data as it comes in, and stop once n is known to within 1e-3
+    scan = ScanRunner(stage, bp2Device, np.arange(50, -51, -1), sensors=sensors, thickness=.99,
+                      stopTolerance=1e-3, onEstimate=lambda i, n, nStd: print(f'n = {n:.4f} +/- {nStd:.4f}'))
+
+    # To keep all of the raw samples as well (see ScanFile.py)
+    scan.saveScan('data/sample_700nm.scan', metadata={'thickness': .99, 'wavelength': 700})
+
+Rather than doing everything one after another, the work for each angle is split into
+stages that run in parallel where they can: while the stage is moving to the next angle,
+the sensors are read and the beam profiler samples from the previous angle are averaged
+in a background thread. Only the beam profiler measurement itself has to wait for the
+stage to stop.
+
+The noise in the beam position varies a lot from angle to angle (from about a micron to
+hundreds of microns in the data files), so rather than a fixed number of samples, the scan
+can take samples in small batches until the standard error of the mean beam position is
+below a target (see targetStderr). Outliers, like the occasional spikes in the peak
+position, are left out of the averages (though they are kept in the raw samples).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import numpy as np
+
+from Fitting import LiveFit
+from Instrumentation import Recorder
+from ScanFile import saveScan
+
+# Columns that are always in the results, in the same order as the files saved by
+# the BeamTracking notebook (any sensor columns are added on the end)
+BEAM_COLUMNS = ['angle', 'peak_position', 'peak_std', 'gauss_center', 'gauss_std', 'centroid', 'centroid_std']
+
+# Where each of the beam position columns comes from (the x component of these fields)
+BEAM_FIELDS = {'peak_position': 'peak', 'gauss_center': 'gaussian_fit_params_x', 'centroid': 'centroid'}
+BEAM_STD_COLUMNS = {'peak_position': 'peak_std', 'gauss_center': 'gauss_std', 'centroid': 'centroid_std'}
+# Number of samples that went into each average (after leaving out outliers), which is only
+# kept in scans (see ScanRunner.saveScan), not in the text files
+BEAM_COUNT_COLUMNS = {'peak_position': 'peak_count', 'gauss_center': 'gauss_count', 'centroid': 'centroid_count'}
+
+# Steps that each angle goes through, which are timed separately; 'wait' is the time that
+# the main thread spends waiting for the background work from the previous angle
+PHASES = ['move', 'acquire', 'sensors', 'aggregate', 'wait']
+
+# Defaults for adaptive averaging (see ScanRunner)
+MIN_SAMPLES = 5
+MAX_SAMPLES = 100
+ADAPTIVE_BATCH_SIZE = 5
+# Samples further than this many standard deviations from the mean are outliers
+OUTLIER_THRESHOLD = 5
+
+# Scale factor between the median absolute deviation and standard deviation for normal noise
+MAD_TO_STD = 1.4826
+
+
+class RunningStats():
+    """
+    Mean and variance of a stream of values that arrive a batch at a time, without keeping
+    the values around (Welford's algorithm, combining a whole batch in each update).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        # Sum of the squared deviations from the mean
+        self._m2 = 0.
+
+    def update(self, values):
+        n = len(values)
+        if n == 0:
+            return
+
+        batchMean = np.mean(values)
+        batchM2 = np.sum((values - batchMean)**2)
+
+        total = self.count + n
+        delta = batchMean - self.mean
+        self.mean += delta * n / total
+        self._m2 += batchM2 + delta**2 * self.count * n / total
+        self.count = total
+
+    def std(self):
+        """
+        Standard deviation of the values (normalized by the count, the same as np.std).
+        """
+        return np.sqrt(self._m2 / self.count) if self.count > 0 else np.nan
+
+    def stderr(self):
+        """
+        Standard error of the mean (inf until there are at least two values).
+        """
+        if self.count < 2:
+            return np.inf
+        return np.sqrt(self._m2 / (self.count - 1) / self.count)
+
+
+def rejectOutliers(values, stats, threshold=OUTLIER_THRESHOLD):
+    """
+    Remove the outliers from a new batch of values, judged against the values accepted so
+    far (stats, a RunningStats). For the first batch there is nothing to compare against,
+    so the median and median absolute deviation of the batch itself are used instead, which
+    aren't thrown off by a few outliers.
+    """
+    if len(values) == 0:
+        return values
+
+    if stats.count < 2:
+        center = np.median(values)
+        spread = MAD_TO_STD * np.median(np.abs(values - center))
+    else:
+        center = stats.mean
+        spread = stats.std()
+
+    # If all of the values so far happen to be the same, there isn't much to go on
+    if spread == 0:
+        return values
+
+    return values[np.abs(values - center) <= threshold * spread]
+
+
+class ScanRunner():
+
+    def __init__(self, stage, bp2Device, angles, samplesPerAngle=20, sensors=None, moveTimeout=None,
+                 targetStderr=None, targetColumn='gauss_center', minSamples=MIN_SAMPLES,
+                 maxSamples=MAX_SAMPLES, batchSize=ADAPTIVE_BATCH_SIZE, outlierThreshold=OUTLIER_THRESHOLD,
+                 planner=None, thickness=None, stopTolerance=None, onEstimate=None, environment=None,
+                 instrument=False):
+        """
+        stage and bp2Device should be connected already (or be the simulated equivalents,
+        see Simulation.py).
+
+        sensors is a dictionary of column names and functions that take no arguments and
+        return a single value, which are read once per angle. Sensors that are recorded in
+        the background instead (an Environment.EnvironmentSampler, which should already be
+        started) can be given as environment; their values are looked up at the middle
+        of the beam profiler samples at each angle, without reading the sensors at all.
+
+        If targetStderr (in microns) is given, samplesPerAngle is ignored, and instead each
+        angle is sampled (batchSize at a time) until the standard error of targetColumn is
+        below targetStderr, taking at least minSamples and at most maxSamples (including
+        invalid ones). In this mode, outliers (more than outlierThreshold standard deviations
+        from the mean) are left out of all of the averages.
+
+        If a planner is given (see Planning.ScanPlanner), it is told the beam position
+        (targetColumn) after each angle, and the angles still to come are replaced with
+        whatever it chooses next; angles should be planner.angles.
+
+        If the thickness of the sample (in mm) is given, the displacement model is fit to
+        the beam positions (targetColumn) as they come in (see Fitting.LiveFit), and the
+        current estimate of n can be found in liveFit.n and liveFit.nStd. onEstimate, if
+        given, is called with the angle index, n and its standard deviation after each
+        update. If stopTolerance is also given, the scan stops early once both the
+        uncertainty in n and how much it is changing are below it.
+
+        If instrument is True, every instrumented call to the devices during the scan is
+        recorded (see Instrumentation.py), in recorder.
+        """
+        self.stage = stage
+        self.bp2Device = bp2Device
+        self.angles = np.array(angles, dtype='double')
+        self.samplesPerAngle = samplesPerAngle
+        self.sensors = sensors if sensors is not None else {}
+        self.environment = environment
+        self.moveTimeout = moveTimeout
+
+        self.targetStderr = targetStderr
+        self.targetColumn = targetColumn
+        self.minSamples = minSamples
+        self.maxSamples = maxSamples
+        self.batchSize = batchSize
+        self.outlierThreshold = outlierThreshold
+        self.planner = planner
+        self.stopTolerance = stopTolerance
+        self.instrument = instrument
+        self.recorder = None
+        self.onEstimate = onEstimate
+
+        # A planner already keeps its own fit up to date
+        if planner is not None:
+            self.liveFit = planner.fit
+        elif thickness is not None:
+            self.liveFit = LiveFit(thickness)
+        else:
+            self.liveFit = None
+
+        columns = BEAM_COLUMNS + list(self.sensors.keys())
+        if environment is not None:
+            columns += environment.names
+        self.results = {key: np.full(len(self.angles), np.nan) for key in columns}
+        self.timings = {key: np.zeros(len(self.angles)) for key in PHASES}
+        self.counts = {key: np.zeros(len(self.angles), dtype=int) for key in BEAM_FIELDS}
+
+        # All of the raw samples (including invalid ones) and their timestamps at each angle
+        self.samples = [None] * len(self.angles)
+        self.sampleTimestamps = [None] * len(self.angles)
+
+        # Number of angles that have been completely measured so far
+        self.completed = 0
+
+        # Functions to call after each angle is finished (see subscribe)
+        self._subscribers = []
+
+    def run(self):
+        """
+        Run the whole scan, returning the results as a dictionary of columns (numpy arrays
+        with one entry per angle). Angles that couldn't be measured (eg. if every sample
+        was invalid) are left as nan. If the scan stops early (see stopTolerance), or a
+        planner runs out of angles to choose from, the results only include the angles that
+        were measured.
+        """
+        if not self.instrument:
+            return self._run()
+
+        self.recorder = Recorder(trace=True)
+        with self.recorder:
+            return self._run()
+
+    def _run(self):
+        # Only one worker, so the background work for each angle happens in order
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = None
+
+            # A planner can change the angles still to come (and end up with fewer of them)
+            i = 0
+            while i < len(self.angles):
+                # The fit is updated in the background, so this is usually one angle behind
+                # (or, if the fit already had data before the scan, true before the first one)
+                if self._converged():
+                    if pending is not None:
+                        pending.result()
+                    self._truncate(i)
+                    break
+
+                start = monotonic()
+                self.stage.moveAbsolute(self.angles[i], timeout=self.moveTimeout)
+                self.timings['move'][i] = monotonic() - start
+
+                # Anything left over from the previous angle has to be done before we start
+                # on this one, so that the background thread doesn't fall behind
+                start = monotonic()
+                if pending is not None:
+                    pending.result()
+                self.timings['wait'][i] = monotonic() - start
+
+                start = monotonic()
+                if self.targetStderr is None:
+                    # The beam profiler might hand back a view into a buffer it reuses
+                    samples = self.bp2Device.getMeasurements(self.samplesPerAngle).copy()
+                    stats = None
+                    # Like TLBP2 streaming, the samples are assumed to be evenly spread over the request
+                    timestamps = np.linspace(start, monotonic(), len(samples)+1)[1:]
+                else:
+                    samples, timestamps, stats = self._acquireAdaptive()
+                self.results['angle'][i] = self.stage.getAngle()
+                self.timings['acquire'][i] = monotonic() - start
+
+                self.samples[i] = samples
+                self.sampleTimestamps[i] = timestamps
+
+                pending = executor.submit(self._process, i, samples, stats)
+
+                # The next angle depends on the results so far, so they can't wait
+                if self.planner is not None:
+                    pending.result()
+                    self._updatePlanner(i)
+
+                i += 1
+
+            if pending is not None:
+                pending.result()
+
+        # The planner ran out of angles to choose from
+        if len(self.angles) < len(self.results['angle']):
+            self._truncate(len(self.angles))
+
+        return self.results
+
+    def _acquireAdaptive(self):
+        """
+        Take samples at the current angle until the standard error of targetColumn is small
+        enough (see __init__), keeping running statistics for each of the beam positions as
+        they come in. Returns all of the samples, their timestamps and the statistics (a
+        dictionary of RunningStats, one for each of the columns in BEAM_FIELDS).
+        """
+        stats = {key: RunningStats() for key in BEAM_FIELDS}
+        target = stats[self.targetColumn]
+
+        batches = []
+        timestamps = []
+        taken = 0
+        request = min(self.minSamples, self.maxSamples)
+
+        while request > 0:
+            start = monotonic()
+            batch = self.bp2Device.getMeasurements(request).copy()
+            timestamps.append(np.linspace(start, monotonic(), len(batch)+1)[1:])
+            batches.append(batch)
+            taken += len(batch)
+
+            valid = batch[batch['valid']]
+            for key, field in BEAM_FIELDS.items():
+                stats[key].update(rejectOutliers(valid[field][:,0], stats[key], self.outlierThreshold))
+
+            if target.count >= self.minSamples and target.stderr() <= self.targetStderr:
+                break
+
+            # Ask for about as many more samples as it should take to reach the target (from
+            # the spread so far), but no more than a batch, since the estimate is rough
+            if target.count >= 2:
+                needed = int(np.ceil((target.std() / self.targetStderr)**2)) - target.count
+            else:
+                needed = self.batchSize
+            request = min(max(needed, 1), self.batchSize, self.maxSamples - taken)
+
+        return np.concatenate(batches), np.concatenate(timestamps), stats
+
+    def subscribe(self, callback):
+        """
+        Call callback(i) each time the i-th angle is finished (from the background thread),
+        eg. to update a plot (see LiveView.py). It should return quickly, since the next
+        angle can't be processed until it does.
+        """
+        self._subscribers.append(callback)
+
+    def _stderr(self, i):
+        """
+        Standard error of targetColumn at the i-th angle.
+        """
+        count = self.counts[self.targetColumn][i]
+        return self.results[BEAM_STD_COLUMNS[self.targetColumn]][i] / np.sqrt(max(count, 1))
+
+    def _updatePlanner(self, i):
+        """
+        Give the planner the result from the i-th angle, and take the angles it wants next.
+        """
+        self.planner.update(self.results['angle'][i], self.results[self.targetColumn][i], self._stderr(i))
+
+        angles = np.array(self.planner.angles, dtype='double')
+        if len(angles) > len(self.results['angle']):
+            raise ValueError(f'Planner asked for {len(angles)} angles, but the scan was planned for '
+                             f'{len(self.results["angle"])}')
+        self.angles = angles
+        self._publishEstimate(i)
+
+    def _updateFit(self, i):
+        self.liveFit.add(self.results['angle'][i], self.results[self.targetColumn][i], self._stderr(i))
+        self._publishEstimate(i)
+
+    def _publishEstimate(self, i):
+        if self.onEstimate is not None and np.isfinite(self.liveFit.n):
+            self.onEstimate(i, self.liveFit.n, self.liveFit.nStd)
+
+    def _converged(self):
+        if self.liveFit is None or self.stopTolerance is None:
+            return False
+        return self.liveFit.converged(self.stopTolerance)
+
+    def _truncate(self, count):
+        """
+        Drop everything after the first count angles, for when the scan stops early.
+        """
+        self.angles = self.angles[:count]
+        self.results = {key: values[:count] for key, values in self.results.items()}
+        self.timings = {key: values[:count] for key, values in self.timings.items()}
+        self.counts = {key: values[:count] for key, values in self.counts.items()}
+        self.samples = self.samples[:count]
+        self.sampleTimestamps = self.sampleTimestamps[:count]
+
+    def _process(self, i, samples, stats=None):
+        """
+        Background work for the i-th angle: read the sensors and average the beam positions
+        (unless that was already done while sampling, in which case stats is given). This
+        overlaps with the move to the next angle.
+        """
+        start = monotonic()
+        for key, read in self.sensors.items():
+            self.results[key][i] = read()
+        if self.environment is not None and len(self.sampleTimestamps[i]) > 0:
+            t = np.mean(self.sampleTimestamps[i])
+            for key in self.environment.names:
+                self.results[key][i] = self.environment.at(key, t)
+        self.timings['sensors'][i] = monotonic() - start
+
+        start = monotonic()
+        if stats is not None:
+            for key in BEAM_FIELDS:
+                self.counts[key][i] = stats[key].count
+                if stats[key].count > 0:
+                    self.results[key][i] = stats[key].mean
+                    self.results[BEAM_STD_COLUMNS[key]][i] = stats[key].std()
+        else:
+            samples = samples[samples['valid']]
+            if len(samples) > 0:
+                for key, field in BEAM_FIELDS.items():
+                    positions = samples[field][:,0]
+                    self.counts[key][i] = len(positions)
+                    self.results[key][i] = np.mean(positions)
+                    self.results[BEAM_STD_COLUMNS[key]][i] = np.std(positions)
+        self.timings['aggregate'][i] = monotonic() - start
+
+        # With a planner, the fit is updated along with it in the main thread instead
+        if self.liveFit is not None and self.planner is None:
+            self._updateFit(i)
+
+        self.completed = i + 1
+
+        for callback in self._subscribers:
+            callback(i)
+
+    def timingSummary(self):
+        """
+        Total time (in seconds) spent in each phase of the scan so far; phases that run in
+        the background ('sensors' and 'aggregate') overlap with 'move', so the total can add
+        up to more than the time the scan took.
+        """
+        return {key: float(np.sum(self.timings[key])) for key in PHASES}
+
+    def saveScan(self, path, metadata=None):
+        """
+        Save the results, along with all of the raw samples and any metadata (eg. thickness,
+        wavelength), in the binary scan format (see ScanFile.py). The number of samples in
+        each average is saved as well (see BEAM_COUNT_COLUMNS), since with targetStderr it
+        is different at every angle.
+        """
+        measured = [i for i in range(len(self.angles)) if self.samples[i] is not None]
+
+        # samplesPerAngle isn't used when sampling adaptively
+        header = {'samples_per_angle': self.samplesPerAngle if self.targetStderr is None else None}
+        if metadata is not None:
+            header.update(metadata)
+
+        columns = {key: values[measured] for key, values in self.results.items()}
+        for key, counts in self.counts.items():
+            columns[BEAM_COUNT_COLUMNS[key]] = counts[measured]
+
+        if len(measured) == 0:
+            saveScan(path, columns, metadata=header)
+            return
+
+        counts = [len(self.samples[i]) for i in measured]
+        saveScan(path, columns,
+                 samples=np.concatenate([self.samples[i] for i in measured]),
+                 sampleOffsets=np.concatenate([[0], np.cumsum(counts)]),
+                 sampleTimestamps=np.concatenate([self.sampleTimestamps[i] for i in measured]),
+                 metadata=header)
+
+    def save(self, path):
+        """
+        Save the results in the same (csv) format as the BeamTracking notebook, which can
+        be read by the CurveFitting notebooks.
+        """
+        columns = list(self.results.keys())
+        with open(path, 'w') as outFile:
+            outFile.write(','.join(columns))
+            for i in range(len(self.angles)):
+                outFile.write('\n' + ','.join(str(self.results[key][i]) for key in columns))
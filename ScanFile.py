@@ -0,0 +1,226 @@
+"""
+Storage for scans that keeps everything that was measured, not just the averages: the raw
+beam profiler samples at every angle (with their timestamps), the per-angle columns (angle,
+averages, sensor readings, ...) and a metadata header (sample, thickness, wavelength, ...).
+
+A scan is a directory (named *.scan by convention) with one .npy file per column and a
+metadata.json file:
+
+    sample.scan/
+        metadata.json           Metadata, plus the names of the columns
+        angle.npy, temp.npy...  Per-angle columns, one value per angle
+        samples.npy             Raw samples from all angles, as MEASUREMENT_DTYPE
+        sample_timestamps.npy   time.monotonic() for each raw sample
+        sample_offsets.npy      The samples for angle i are samples[offsets[i]:offsets[i+1]]
+
+Since each column is a plain .npy file, they can be memory-mapped, so only the columns (and
+parts of them) that are actually used are ever read from disk:
+
+    scan = loadScan('data/sample.scan')
+    scan.metadata['thickness']
+    scan['angle'], scan['gauss_center']
+    mean, std = scan.aggregate('gaussian_fit_params_x')
+
+Existing text files (from the BeamTracking notebook) can be converted with:
+
+    python ScanFile.py data/*.txt
+
+The text files only had the wavelength (and sometimes the thickness) in their names, eg.
+sapphire_disk_852nm.txt, so these are put in the metadata when converting them.
+"""
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+from TLBP2Control.Control import MEASUREMENT_DTYPE
+
+SCAN_EXTENSION = '.scan'
+METADATA_FILE = 'metadata.json'
+SCAN_FORMAT_VERSION = 1
+
+# Names of the files holding the raw samples (see above)
+SAMPLES = 'samples'
+SAMPLE_TIMESTAMPS = 'sample_timestamps'
+SAMPLE_OFFSETS = 'sample_offsets'
+
+# Wavelength (in nm) and thickness (in mm) in the name of a text file, eg. 852nm or 2.29mm
+WAVELENGTH_PATTERN = re.compile(r'(?<![\d.])(\d+(?:\.\d+)?)nm')
+THICKNESS_PATTERN = re.compile(r'(?<![\d.])(\d+(?:\.\d+)?)mm')
+
+
+def saveScan(path, columns, samples=None, sampleOffsets=None, sampleTimestamps=None, metadata=None):
+    """
+    Save a scan to the directory path (which is created if it doesn't exist).
+
+    columns is a dictionary of per-angle arrays (all the same length). If the raw samples
+    are given (as an array of MEASUREMENT_DTYPE), sampleOffsets should also be given, with
+    one more entry than there are angles (see above).
+    """
+    os.makedirs(path, exist_ok=True)
+
+    header = dict(metadata) if metadata is not None else {}
+    header['format_version'] = SCAN_FORMAT_VERSION
+    header['columns'] = list(columns.keys())
+    header['has_samples'] = samples is not None
+
+    for key, values in columns.items():
+        np.save(os.path.join(path, key + '.npy'), np.asarray(values))
+
+    if samples is not None:
+        np.save(os.path.join(path, SAMPLES + '.npy'), np.asarray(samples, dtype=MEASUREMENT_DTYPE))
+        np.save(os.path.join(path, SAMPLE_OFFSETS + '.npy'), np.asarray(sampleOffsets, dtype='int64'))
+
+        if sampleTimestamps is None:
+            sampleTimestamps = np.full(len(samples), np.nan)
+        np.save(os.path.join(path, SAMPLE_TIMESTAMPS + '.npy'), np.asarray(sampleTimestamps, dtype='double'))
+
+    # Written last, so a scan that was only partially saved doesn't look complete
+    with open(os.path.join(path, METADATA_FILE), 'w') as metadataFile:
+        json.dump(header, metadataFile, indent=4)
+
+
+def loadScan(path, mmap=True):
+    """
+    Open a scan saved with saveScan. If mmap is True, columns are memory-mapped (read-only)
+    rather than read into memory.
+    """
+    return ScanFile(path, mmap)
+
+
+class ScanFile():
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self._mmapMode = 'r' if mmap else None
+
+        with open(os.path.join(path, METADATA_FILE), 'r') as metadataFile:
+            self.metadata = json.load(metadataFile)
+
+        self.columns = self.metadata['columns']
+        # Columns are only opened the first time they are used
+        self._cache = {}
+
+    def _load(self, name):
+        if name not in self._cache:
+            self._cache[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode=self._mmapMode)
+        return self._cache[name]
+
+    def __getitem__(self, column):
+        if column not in self.columns:
+            raise KeyError(column)
+        return self._load(column)
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __len__(self):
+        return len(self[self.columns[0]]) if len(self.columns) > 0 else 0
+
+    def hasSamples(self):
+        return self.metadata['has_samples']
+
+    @property
+    def samples(self):
+        return self._load(SAMPLES)
+
+    @property
+    def sampleTimestamps(self):
+        return self._load(SAMPLE_TIMESTAMPS)
+
+    @property
+    def sampleOffsets(self):
+        return self._load(SAMPLE_OFFSETS)
+
+    def samplesAt(self, i):
+        """
+        The raw samples taken at the i-th angle.
+        """
+        offsets = self.sampleOffsets
+        return self.samples[offsets[i]:offsets[i+1]]
+
+    def validCounts(self):
+        """
+        Number of valid raw samples at each angle.
+        """
+        valid = np.concatenate([[0], np.cumsum(self.samples['valid'])])
+        return np.diff(valid[self.sampleOffsets])
+
+    def aggregate(self, field, component=0, validOnly=True):
+        """
+        Recalculate the mean and standard deviation at every angle of one component of a
+        field of the raw samples (eg. 'gaussian_fit_params_x', component 0 is the center),
+        without looping over the angles. Angles without any (valid) samples are nan.
+        """
+        samples = self.samples
+        offsets = self.sampleOffsets
+
+        values = samples[field]
+        if values.ndim > 1:
+            values = values[:,component]
+
+        weights = samples['valid'].astype('double') if validOnly else np.ones(len(values))
+        values = np.where(weights > 0, values, 0.)
+
+        # Sums over each angle's range of samples
+        def sumPerAngle(x):
+            return np.diff(np.concatenate([[0], np.cumsum(x)])[offsets])
+
+        counts = sumPerAngle(weights)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sumPerAngle(values) / counts
+
+            # Deviations from each angle's mean, rather than the sum of squares, to avoid
+            # losing precision (the positions are large compared to their spread)
+            deviations = np.where(weights > 0, values - np.repeat(mean, np.diff(offsets)), 0.)
+            std = np.sqrt(sumPerAngle(deviations**2) / counts)
+
+        return mean, std
+
+
+def metadataFromName(file):
+    """
+    The wavelength (in nm) and thickness (in mm) given in the name of a text file, as a
+    dictionary with whichever of 'wavelength' and 'thickness' were found.
+    """
+    name = os.path.splitext(os.path.basename(file))[0]
+
+    metadata = {}
+    for key, pattern in [('wavelength', WAVELENGTH_PATTERN), ('thickness', THICKNESS_PATTERN)]:
+        match = pattern.search(name)
+        if match is not None:
+            value = match.group(1)
+            metadata[key] = float(value) if '.' in value else int(value)
+
+    return metadata
+
+
+def convertText(file, path=None, metadata=None):
+    """
+    Convert a text file saved by the BeamTracking notebook into a scan (by default, next to
+    the original with the extension changed). Of course, these don't have any raw samples.
+
+    The wavelength and thickness are taken from the name of the file where they are in it
+    (see metadataFromName), but anything in metadata takes precedence.
+    """
+    if path is None:
+        path = os.path.splitext(file)[0] + SCAN_EXTENSION
+
+    data = np.genfromtxt(file, delimiter=',', names=True)
+    columns = {key: data[key] for key in data.dtype.names}
+
+    header = {'source': os.path.basename(file)}
+    header.update(metadataFromName(file))
+    if metadata is not None:
+        header.update(metadata)
+
+    saveScan(path, columns, metadata=header)
+    return path
+
+
+# So that files can be converted from the command line
+if __name__ == '__main__':
+    for file in sys.argv[1:]:
+        print(f'{file} -> {convertText(file)}')
@@ -1,3 +1,4 @@
+import os
 
 # Tinkerforge variables
 TF_HOST = 'localhost'
@@ -10,3 +11,8 @@ TF_TEMP_UID = '6Jf'
 # Stuff for the motion controller
 MOTION_CONTROLLER_PORT = 'COM4'
 ROTATION_STAGE_AXIS_NUM = 1
+
+# Where fit results are kept so that files don't have to be fit again (see FitCache.py),
+# and how big (in MB) the cache can get before the least recently used results are removed
+FIT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ior_fit_cache')
+FIT_CACHE_MAX_SIZE = 100
@@ -0,0 +1,661 @@
+"""
+Simulated stand-ins for the hardware used in the experiment, so that the acquisition
+code can be run (and timed) without the motion controller, beam profiler or tinkerforge
+bricks plugged in, eg. on a linux machine:
+
+    from Simulation import *
+
+    stage = SimulatedRotationStage(velocity=10)
+    bp2Device = SimulatedTLBP2(stage, ior=1.51, width=.99)
+
+    ipcon = SimulatedIPConnection()
+    humiditySensor = SimulatedHumidity(Settings.TF_HUMIDITY_UID, ipcon)
+    temperatureSensor = SimulatedTemperature(Settings.TF_TEMP_UID, ipcon)
+
+Each one has the same public methods as the real thing, so they can be dropped into
+the BeamTracking notebook in place of RotationStage, TLBP2, etc. The beam position that
+the beam profiler reports follows the displacement model from Nemoto (1992) for the
+current angle of the stage (see the CurveFitting notebook), and the various delays
+(move velocity, settle time, pipe latency, drum spin-up) are all configurable so
+that the throughput of a scan can be estimated.
+"""
+import os
+import socket
+import tempfile
+import threading
+import asyncio
+from time import sleep, monotonic
+
+import numpy as np
+
+from Fitting import nemotoDisplacement
+from Instrumentation import instrumented
+from TLBP2Control.Control import (TLBP2, MEASUREMENT_DTYPE, FRAME_HEADER_DTYPE, FRAME_MAGIC,
+                                  FRAME_VERSION, SAMPLE_SEPARATOR, MEASURE_ERROR,
+                                  PROFILE_FRAME_HEADER_DTYPE, PROFILE_FRAME_MAGIC,
+                                  PROFILE_FRAME_VERSION, PROFILE_DTYPE, profileOffset)
+from TLBP2Control.Server import SocketServer, MESSAGE_HEADER
+from TLBP2Control.SharedMemory import SharedMemoryRing, RING_NOTICE
+
+
+class SimulatedRotationStage():
+    """
+    Stand-in for ESP301Control.RotationStage. Moves happen at a constant velocity (in
+    degrees/second) and are followed by a settling period, during which the stage is
+    still reported as moving. Every command to the controller takes commandLatency
+    seconds, to mimic the serial link.
+    """
+
+    def __init__(self, comPort='COM4', axisNum=1, velocity=10., settleTime=.1,
+                 commandLatency=.002, angleNoise=.001, homeAngle=0., seed=None):
+        self._axisNum = axisNum
+        self._comPort = comPort
+
+        self._velocity = velocity
+        self.settleTime = settleTime
+        self.commandLatency = commandLatency
+        self.angleNoise = angleNoise
+        self._homeAngle = homeAngle
+
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+        # The current move is described by where it started, where it is going,
+        # and when it started; the angle at any time is calculated from these
+        self._startAngle = homeAngle
+        self._targetAngle = homeAngle
+        self._moveStart = monotonic()
+        self._moveDuration = 0.
+        self._isConnected = False
+
+    def _command(self):
+        """
+        Wait for a round trip to the (fake) controller.
+        """
+        if self.commandLatency > 0:
+            sleep(self.commandLatency)
+
+    def _trueAngle(self, t=None):
+        """
+        The angle of the stage at time t (default now), without any noise.
+        """
+        t = monotonic() if t is None else t
+        with self._lock:
+            if self._moveDuration <= 0:
+                return self._targetAngle
+
+            fraction = min((t - self._moveStart) / self._moveDuration, 1.)
+            return self._startAngle + fraction * (self._targetAngle - self._startAngle)
+
+    def _remainingTime(self):
+        with self._lock:
+            return max(self._moveStart + self._moveDuration + self.settleTime - monotonic(), 0.)
+
+    def _startMove(self, theta):
+        current = self._trueAngle()
+        with self._lock:
+            self._startAngle = current
+            self._targetAngle = theta
+            self._moveStart = monotonic()
+            self._moveDuration = abs(theta - current) / self._velocity
+
+    def connect(self):
+        self._command()
+        self._isConnected = True
+        return 0
+
+    def disconnect(self):
+        self._command()
+        self._isConnected = False
+        return 0
+
+    @instrumented('stage.getAngle')
+    def getAngle(self):
+        self._command()
+        angle = self._trueAngle()
+
+        if self.angleNoise > 0:
+            angle += self._rng.normal(0, self.angleNoise)
+
+        return angle
+
+    @instrumented('stage.moveRelative')
+    def moveRelative(self, deltaTheta, wait=True, timeout=None):
+        self._command()
+        self._startMove(self._trueAngle() + deltaTheta)
+
+        if wait:
+            self.waitForMove(timeout=timeout)
+
+        return 0
+
+    @instrumented('stage.moveAbsolute')
+    def moveAbsolute(self, theta, wait=True, timeout=None):
+        self._command()
+        self._startMove(theta)
+
+        if wait:
+            self.waitForMove(timeout=timeout)
+
+        return 0
+
+    async def moveRelativeAsync(self, deltaTheta, timeout=None):
+        self._command()
+        self._startMove(self._trueAngle() + deltaTheta)
+        await self.waitForMoveAsync(timeout=timeout)
+        return 0
+
+    async def moveAbsoluteAsync(self, theta, timeout=None):
+        self._command()
+        self._startMove(theta)
+        await self.waitForMoveAsync(timeout=timeout)
+        return 0
+
+    # Since we know exactly when the move will finish, there is no need to poll;
+    # the expected duration is only accepted to match RotationStage
+    @instrumented('stage.waitForMove')
+    def waitForMove(self, expectedDuration=0, timeout=None):
+        remaining = self._remainingTime()
+        if timeout is not None and remaining > timeout:
+            sleep(timeout)
+            self.stop()
+            raise TimeoutError(f'Stage did not finish moving within {timeout} seconds')
+
+        sleep(remaining)
+        self._command()
+
+    async def waitForMoveAsync(self, expectedDuration=0, timeout=None):
+        remaining = self._remainingTime()
+        if timeout is not None and remaining > timeout:
+            await asyncio.sleep(timeout)
+            self.stop()
+            raise TimeoutError(f'Stage did not finish moving within {timeout} seconds')
+
+        await asyncio.sleep(remaining)
+        self._command()
+
+    def stop(self):
+        self._command()
+        current = self._trueAngle()
+        with self._lock:
+            self._startAngle = current
+            self._targetAngle = current
+            self._moveDuration = 0.
+        return 0
+
+    def setVelocity(self, velocity):
+        self._command()
+        self._velocity = velocity
+        return 0
+
+    def getVelocity(self):
+        self._command()
+        return self._velocity
+
+    def isMoving(self):
+        self._command()
+        return self._remainingTime() > 0
+
+    def resetToHome(self):
+        return self.moveAbsolute(self._homeAngle)
+
+
+class SimulatedPipe():
+    """
+    Stand-in for TLBP2Control.Server.PipeServer, which answers requests the same way
+    that the C# server does. Each message that is read back takes pipeLatency seconds,
+    plus sampleTime seconds for every measurement taken.
+
+    The drum takes spinUpTime seconds to come up to speed after the pipe is created,
+    and connect() waits for it, since the real server doesn't connect to the pipe until
+    the drum is stable.
+
+    The answers themselves come from respond, which SimulatedServer also uses.
+    """
+
+    def __init__(self, device):
+        self._device = device
+        self._responses = []
+        self._binaryMode = False
+        self._ring = None
+        self._created = monotonic()
+        self._closed = threading.Event()
+
+    def connect(self):
+        # Returns early if the pipe is closed in the meantime (see TLBP2._abortConnect)
+        remaining = self._created + self._device.spinUpTime - monotonic()
+        if remaining > 0:
+            self._closed.wait(remaining)
+
+    def respond(self, command):
+        """
+        The server's answer to a single request, as bytes.
+        """
+        if command.startswith('measure '):
+            try:
+                numSamples = int(command[len('measure '):])
+            except ValueError:
+                numSamples = 0
+
+            if numSamples < 1:
+                return b'Error\n'
+            elif self._binaryMode:
+                return self._frame(numSamples)
+            else:
+                return self._batch(numSamples).encode() + b'\n'
+
+        elif command.startswith('profiles '):
+            try:
+                numSamples = int(command[len('profiles '):])
+            except ValueError:
+                numSamples = 0
+
+            # Far too big to send as text, so only in binary mode
+            if numSamples < 1 or not self._binaryMode:
+                return b'Error\n'
+            return self._profileFrame(numSamples)
+
+        elif command == 'measure':
+            record = self._device._measureRecord()
+            return self._text(record).encode() + b'\n'
+
+        elif command == 'status':
+            return f'{self._device._drumStatus()}\n'.encode()
+
+        elif command in ['binary', 'text']:
+            self._binaryMode = (command == 'binary')
+            return b'OK\n'
+
+        elif command.startswith('sharedmemory '):
+            self._closeRing()
+            try:
+                self._ring = SharedMemoryRing(command[len('sharedmemory '):], create=False)
+            except (OSError, ValueError):
+                return b'Error\n'
+            return b'OK\n'
+
+        elif command == 'nosharedmemory':
+            self._closeRing()
+            return b'OK\n'
+
+        elif command == 'stable':
+            stableTime = monotonic() - self._created - self._device.spinUpTime
+            return f'{max(stableTime, 0.)}\n'.encode()
+
+        elif command == 'detach':
+            return b'Detaching\n'
+
+        elif command == 'stop':
+            return b'Stopping\n'
+
+        return b'Error\n'
+
+    def _answer(self, command):
+        """
+        Respond to a request, returning what has to be sent back, which is only a notice
+        if the response (a binary frame) went into shared memory instead.
+        """
+        response = self.respond(command)
+
+        if self._ring is not None and response[:4] in [FRAME_MAGIC, PROFILE_FRAME_MAGIC]:
+            self._ring.write(response)
+            return RING_NOTICE + b'\n'
+
+        return response
+
+    def _closeRing(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+
+    @instrumented('pipe.write')
+    def write(self, message):
+        self._responses.append(self._answer(message.strip()))
+
+    def _nextResponse(self, timeout):
+        self._checkOpen()
+        if not self._responses:
+            # Nothing is ever going to turn up, so there's no point waiting forever
+            if timeout is not None:
+                sleep(timeout)
+            raise TimeoutError('No message from the server')
+
+        sleep(self._device.pipeLatency)
+        return self._responses.pop(0)
+
+    @instrumented('pipe.read')
+    def read(self, timeout=None):
+        return 0, self._nextResponse(timeout)
+
+    @instrumented('pipe.readInto')
+    def readInto(self, buffer, timeout=None):
+        data = self._nextResponse(timeout)
+        numRead = min(len(data), len(buffer))
+        memoryview(buffer)[:numRead] = data[:numRead]
+        return numRead
+
+    def close(self):
+        self._responses = []
+        self._closeRing()
+        self._closed.set()
+
+    def _checkOpen(self):
+        if self._closed.is_set():
+            raise Exception('Pipe has been closed')
+
+    def _text(self, record):
+        """
+        Format a single measurement the way the server does (or 'Error measuring' if
+        record is None).
+        """
+        if record is None:
+            return MEASURE_ERROR
+
+        fields = []
+        for key in MEASUREMENT_DTYPE.names[1:]:
+            values = np.atleast_1d(record[key])
+            fields.append(key + '=' + ','.join(str(v) for v in values))
+
+        return '|'.join(fields)
+
+    def _batch(self, numSamples):
+        return SAMPLE_SEPARATOR.join(self._text(self._device._measureRecord()) for i in range(numSamples))
+
+    def _frame(self, numSamples):
+        header = np.zeros(1, dtype=FRAME_HEADER_DTYPE)
+        header['magic'] = FRAME_MAGIC
+        header['version'] = FRAME_VERSION
+        header['record_size'] = MEASUREMENT_DTYPE.itemsize
+        header['count'] = numSamples
+
+        records = np.zeros(numSamples, dtype=MEASUREMENT_DTYPE)
+        for i in range(numSamples):
+            record = self._device._measureRecord()
+            if record is None:
+                for key in MEASUREMENT_DTYPE.names[1:]:
+                    records[i][key] = np.nan
+            else:
+                records[i] = record
+
+        return header.tobytes() + records.tobytes()
+
+    def _profileFrame(self, numSamples):
+        header = np.zeros(1, dtype=PROFILE_FRAME_HEADER_DTYPE)
+        header['magic'] = PROFILE_FRAME_MAGIC
+        header['version'] = PROFILE_FRAME_VERSION
+        header['record_size'] = MEASUREMENT_DTYPE.itemsize
+        header['count'] = numSamples
+        header['profile_length'] = self._device.profileLength
+
+        records = np.zeros(numSamples, dtype=MEASUREMENT_DTYPE)
+        profiles = np.zeros((numSamples, 2, 2, self._device.profileLength), dtype=PROFILE_DTYPE)
+        for i in range(numSamples):
+            record = self._device._measureRecord()
+            if record is None:
+                for key in MEASUREMENT_DTYPE.names[1:]:
+                    records[i][key] = np.nan
+            else:
+                records[i] = record
+                profiles[i] = self._device._measureProfiles(record)
+
+        padding = bytes(profileOffset(numSamples) - header.nbytes - records.nbytes)
+        return header.tobytes() + records.tobytes() + padding + profiles.tobytes()
+
+
+class SimulatedServer():
+    """
+    Stand-in for the C# server process, for running TLBP2 over a real transport (see
+    SimulatedTLBP2(transport='socket')): it connects to a TLBP2Control.Server.SocketServer
+    the same way that the real server does (once the drum has spun up), and answers
+    requests through it in a background thread, using responder (a SimulatedPipe for
+    device by default) for the answers.
+    """
+
+    def __init__(self, device, address, responder=None):
+        self.address = address
+        self._responder = responder if responder is not None else SimulatedPipe(device)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _serve(self):
+        self._responder.connect()
+
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(self.address)
+            except OSError:
+                return
+
+            try:
+                for line in sock.makefile('rb'):
+                    command = line.decode().strip()
+
+                    response = self._responder._answer(command)
+                    sock.sendall(MESSAGE_HEADER.pack(len(response)) + response)
+
+                    if command in ['stop', 'detach']:
+                        break
+            except OSError:
+                # Python closed the connection (eg. after a timeout)
+                pass
+            finally:
+                self._responder.close()
+
+
+class SimulatedTLBP2(TLBP2):
+    """
+    Stand-in for TLBP2Control.TLBP2, which measures a gaussian beam that has passed
+    through a slab of thickness width (in mm) and index of refraction ior, mounted on
+    the given stage. Positions are reported in microns, like the real beam profiler.
+
+    All of the communication goes through a SimulatedPipe, so the same parsing (or binary
+    decoding) happens as with the real device. Each measurement has gaussian noise of
+    standard deviation positionNoise (in microns) added to it, and fails (as if the drum
+    speed weren't stable) with probability dropoutRate. With probability outlierRate, the
+    peak position is off by outlierSize (in microns) in either direction, like the spikes
+    that show up in the peak_std column of some of the data files.
+
+    Raw profiles (see TLBP2.getProfiles) are gaussians of 1/e^2 diameter beamWidth, centered
+    on the centroid of the sample, sampled at profileLength points across the slit, with
+    gaussian noise of standard deviation profileNoise (in digits) added to them.
+
+    By default, the pipe is simulated as well, but with transport='socket', a real socket
+    is used, with a SimulatedServer on the other end of it, so that the transports (and
+    sharedMemory) can be tested without the real server.
+    """
+
+    def __init__(self, stage, ior=1.5, width=1., beamCenter=0., beamWidth=1000.,
+                 positionNoise=.5, dropoutRate=0., outlierRate=0., outlierSize=400.,
+                 pipeLatency=.001, sampleTime=.05, spinUpTime=10., debug=False,
+                 binary=False, seed=None, transport=None, sharedMemory=False, readTimeout=None,
+                 profileLength=1000, profileNoise=50.):
+        super().__init__(debug, binary, sharedMemory=sharedMemory, readTimeout=readTimeout)
+
+        if transport not in [None, 'socket']:
+            raise ValueError(f'Cannot simulate the {transport} transport')
+        self._transport = transport
+        self._server = None
+
+        self.stage = stage
+        self.ior = ior
+        self.width = width
+        self.beamCenter = beamCenter
+        self.beamWidth = beamWidth
+        self.positionNoise = positionNoise
+        self.dropoutRate = dropoutRate
+        self.outlierRate = outlierRate
+        self.outlierSize = outlierSize
+        self.profileLength = profileLength
+        self.profileNoise = profileNoise
+
+        self.pipeLatency = pipeLatency
+        self.sampleTime = sampleTime
+        self.spinUpTime = spinUpTime
+
+        self._rng = np.random.default_rng(seed)
+
+    def _connect(self):
+        if self._isConnected:
+            return
+
+        # There is no server process to start, so we go straight to the pipe
+        self._csProcess = None
+        self._debugMode = True
+        self._connectedAt = monotonic()
+
+        if self._transport == 'socket':
+            self._pipeCon = SocketServer(self._socketAddress())
+            self._server = SimulatedServer(self, self._pipeCon.address, self._simulatedPipe())
+            self._server.start()
+        else:
+            self._pipeCon = self._simulatedPipe()
+
+        self._pipeCon.connect()
+
+        self._pipeCon.write(self._STATUS)
+        status = self._read()
+
+        if status[0] == 0 and int(status[1].decode()) in [3, 5]:
+            self._isConnected = True
+
+            if self._useBinary:
+                self.setBinaryMode(True)
+
+                if self._useSharedMemory:
+                    self.setSharedMemory(True)
+
+            return 0
+
+        return 1
+
+    def _simulatedPipe(self):
+        # What answers the requests, whichever transport is used
+        return SimulatedPipe(self)
+
+    def _socketAddress(self):
+        # Unique, so that several simulated devices can be connected at once
+        if hasattr(socket, 'AF_UNIX'):
+            return os.path.join(tempfile.gettempdir(), f'TLBP2Simulated-{os.getpid()}-{id(self)}.sock')
+        return ('127.0.0.1', 0)
+
+    def _drumStatus(self):
+        # 4 means the drum is still starting up, 3 that it is stable
+        return 3 if monotonic() - self._connectedAt >= self.spinUpTime else 4
+
+    def _measureRecord(self):
+        """
+        Take a single (fake) measurement as a record of MEASUREMENT_DTYPE, or None if it failed.
+        """
+        sleep(self.sampleTime)
+
+        if self._drumStatus() not in [3, 5] or self._rng.random() < self.dropoutRate:
+            return None
+
+        # The angle is in degrees, with the opposite sign to the one in the model
+        # (see the CurveFitting notebook)
+        theta = -self.stage._trueAngle() * np.pi / 180
+        center = self.beamCenter + 1e3 * nemotoDisplacement(theta, self.ior, self.width)
+
+        record = np.zeros(1, dtype=MEASUREMENT_DTYPE)[0]
+        record['valid'] = True
+        record['drum_speed'] = 10 + self._rng.normal(0, .01)
+
+        xy = np.array([center, self.beamCenter])
+        record['centroid'] = xy + self._rng.normal(0, self.positionNoise, 2)
+        record['peak'] = xy + self._rng.normal(0, 2*self.positionNoise, 2)
+        if self._rng.random() < self.outlierRate:
+            record['peak'][0] += self._rng.choice([-1, 1]) * self.outlierSize
+        record['peak_intensity'] = 80 + self._rng.normal(0, 1, 2)
+        record['beam_width'] = self.beamWidth + self._rng.normal(0, 1, 2)
+
+        for i, key in enumerate(['gaussian_fit_params_x', 'gaussian_fit_params_y']):
+            record[key] = [xy[i] + self._rng.normal(0, self.positionNoise),
+                           self.beamWidth + self._rng.normal(0, 1),
+                           80 + self._rng.normal(0, 1),
+                           99 + self._rng.normal(0, .1)]
+
+        return record
+
+    def _measureProfiles(self, record):
+        """
+        The x and y profiles (positions, then intensities) that go along with a measurement,
+        laid out like a sample in a frame of raw profiles.
+        """
+        # The slits are 9 mm long
+        positions = np.linspace(-4500, 4500, self.profileLength)
+
+        profiles = np.zeros((2, 2, self.profileLength), dtype=PROFILE_DTYPE)
+        for i in range(2):
+            # peak_intensity is a percentage of the range of the AD converter (0x7AFF)
+            amplitude = record['peak_intensity'][i] / 100 * 0x7AFF
+            profiles[i,0] = positions
+            profiles[i,1] = amplitude * np.exp(-8 * (positions - record['centroid'][i])**2 / self.beamWidth**2) \
+                            + self._rng.normal(0, self.profileNoise, self.profileLength)
+
+        return profiles
+
+
+class SimulatedIPConnection():
+    """
+    Stand-in for tinkerforge.ip_connection.IPConnection.
+    """
+
+    def __init__(self, latency=.002):
+        self.latency = latency
+        self._isConnected = False
+
+    def connect(self, host, port):
+        self._isConnected = True
+
+    def disconnect(self):
+        self._isConnected = False
+
+
+class SimulatedTemperature():
+    """
+    Stand-in for tinkerforge.bricklet_temperature.BrickletTemperature; like the real
+    bricklet, the temperature is returned in hundredths of a degree C.
+    """
+
+    def __init__(self, uid, ipcon, temperature=22., noise=.05, seed=None):
+        self._uid = uid
+        self._ipcon = ipcon
+        self.temperature = temperature
+        self.noise = noise
+        self._rng = np.random.default_rng(seed)
+
+    def get_temperature(self):
+        if not self._ipcon._isConnected:
+            raise Exception('Not connected')
+
+        sleep(self._ipcon.latency)
+        return int(round(100 * (self.temperature + self._rng.normal(0, self.noise))))
+
+
+class SimulatedHumidity():
+    """
+    Stand-in for tinkerforge.bricklet_humidity.BrickletHumidity; like the real bricklet,
+    the humidity is returned in tenths of a percent.
+    """
+
+    def __init__(self, uid, ipcon, humidity=40., noise=.2, seed=None):
+        self._uid = uid
+        self._ipcon = ipcon
+        self.humidity = humidity
+        self.noise = noise
+        self._rng = np.random.default_rng(seed)
+
+    def get_humidity(self):
+        if not self._ipcon._isConnected:
+            raise Exception('Not connected')
+
+        sleep(self._ipcon.latency)
+        return int(round(10 * (self.humidity + self._rng.normal(0, self.noise))))
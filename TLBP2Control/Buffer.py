@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+
+# Fixed-capacity storage for measurements streamed from the beam profiler (see
+# TLBP2.startStreaming). Every sample is written twice, at index i and i + capacity,
+# so that any run of up to capacity consecutive samples is contiguous in memory, and
+# can be handed out as a view instead of a copy.
+class MeasurementBuffer():
+
+    def __init__(self, capacity, dtype):
+        self.capacity = capacity
+
+        self._samples = np.zeros(2*capacity, dtype=dtype)
+        self._timestamps = np.zeros(2*capacity, dtype='double')
+
+        # Total number of samples ever written; the latest sample is at index (_total - 1) % capacity
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def append(self, samples, timestamps):
+        """
+        Add a batch of samples along with their (monotonic) timestamps. If more than capacity
+        samples are added at once, only the last capacity are kept.
+        """
+        samples = samples[-self.capacity:]
+        timestamps = timestamps[-self.capacity:]
+        n = len(samples)
+
+        with self._lock:
+            start = self._total % self.capacity
+
+            # The new samples may wrap around the end of the primary copy, in which case
+            # they are split into two pieces
+            firstLength = min(n, self.capacity - start)
+            for offset in [0, self.capacity]:
+                self._samples[start+offset:start+offset+firstLength] = samples[:firstLength]
+                self._timestamps[start+offset:start+offset+firstLength] = timestamps[:firstLength]
+
+                self._samples[offset:offset+n-firstLength] = samples[firstLength:]
+                self._timestamps[offset:offset+n-firstLength] = timestamps[firstLength:]
+
+            self._total += n
+
+    def __len__(self):
+        return min(self._total, self.capacity)
+
+    def totalSamples(self):
+        """
+        The number of samples written since the buffer was created, including
+        any that have since been overwritten.
+        """
+        return self._total
+
+    def latest(self, n=None):
+        """
+        Get the last n samples (or all available samples if n is None) as a tuple of
+        (timestamps, samples).
+
+        Both are views into the buffer, so no data is copied, but they will be overwritten
+        once another capacity samples have been written; copy them if you want to keep them.
+        """
+        with self._lock:
+            available = min(self._total, self.capacity)
+            n = available if n is None else min(n, available)
+
+            start = (self._total - n) % self.capacity
+
+        return self._timestamps[start:start+n], self._samples[start:start+n]
+
+    def since(self, t0):
+        """
+        Get all available samples with timestamps at or after t0 (in the same units as
+        time.monotonic()) as a tuple of (timestamps, samples). See latest() for details.
+        """
+        timestamps, samples = self.latest()
+        first = np.searchsorted(timestamps, t0, side='left')
+
+        return timestamps[first:], samples[first:]
@@ -1,9 +1,13 @@
 ﻿using System;
 using System.IO;
+using System.IO.MemoryMappedFiles;
 using System.IO.Pipes;
+using System.Net;
+using System.Net.Sockets;
 using System.Text;
 using System.Threading;
 using System.Collections.Generic;
+using System.Linq;
 using Thorlabs.TLBP2.Interop;
 
 namespace TLBP2PipeConnection
@@ -13,8 +17,41 @@ namespace TLBP2PipeConnection
 
         // This has to be the same in both python and c#, so should probably not be changed
         private const string PIPE_NAME = "TLBP2PyConnection";
+
+        // Names and number of values of each field in a measurement, in the order that they
+        // are sent. For the binary protocol, this has to match MEASUREMENT_DTYPE in python.
+        private static readonly (string, int)[] RECORD_FIELDS = {
+            ("drum_speed", 1),
+            ("centroid", 2),
+            ("peak", 2),
+            ("peak_intensity", 2),
+            ("beam_width", 2),
+            ("gaussian_fit_params_x", 4),
+            ("gaussian_fit_params_y", 4)
+        };
+        private const int RECORD_LENGTH = 17;
+
+        // Header for a binary frame of measurements, see FRAME_HEADER_DTYPE in python
+        private static readonly byte[] FRAME_MAGIC = Encoding.ASCII.GetBytes("TLBP");
+        private const ushort FRAME_VERSION = 1;
+        private const ushort RECORD_SIZE = 1 + 8 * RECORD_LENGTH;
+
+        // Header for a frame of raw profiles (with the length of the profiles after the count),
+        // see PROFILE_FRAME_HEADER_DTYPE in python
+        private static readonly byte[] PROFILE_FRAME_MAGIC = Encoding.ASCII.GetBytes("TLPF");
+        private const ushort PROFILE_FRAME_VERSION = 1;
+        private const int PROFILE_HEADER_SIZE = 16;
         private static TLBP2 bp2Device = null;
 
+        // How long (in seconds) a persistent server waits for python to connect before shutting down
+        private const int DEFAULT_IDLE_TIMEOUT = 600;
+
+        // How often (in ms) we try connecting to the socket again, if python isn't listening yet
+        private const int SOCKET_RETRY_INTERVAL = 50;
+
+        // When the drum speed last became stable, so python can tell how warmed up the device is
+        private static DateTime stableSince;
+
         static void Main(string[] args)
         {
             // Make sure the device is always stopped when this program ends
@@ -25,12 +62,25 @@ namespace TLBP2PipeConnection
             // will have useful info, but when launched from python it will be quiet
             bool suppressOutput = false;
 
-            if (args.Length == 1)
+            // If persistent, the server keeps running between python sessions (see below),
+            // until no one has connected for idleTimeout seconds
+            bool persistent = false;
+            int idleTimeout = DEFAULT_IDLE_TIMEOUT;
+
+            // With --socket, connect to python through a socket (a unix domain socket path, or
+            // host:port) rather than the pipe; see SocketServer in python
+            string socketAddress = null;
+
+            for (int i = 0; i < args.Length; i++)
             {
-                if (args[0] == "--suppress-output")
-                {
+                if (args[i] == "--suppress-output")
                     suppressOutput = true;
-                }
+                else if (args[i] == "--persistent")
+                    persistent = true;
+                else if (args[i] == "--idle-timeout" && i + 1 < args.Length)
+                    int.TryParse(args[++i], out idleTimeout);
+                else if (args[i] == "--socket" && i + 1 < args.Length)
+                    socketAddress = args[++i];
             }
 
             try
@@ -71,86 +121,231 @@ namespace TLBP2PipeConnection
                 }
                 // Doesn't matter too much, but the device status should switch to 3 after stabilization
 
+                stableSince = DateTime.Now;
+
                 if (!suppressOutput)
                     Console.WriteLine("drum speed stablized!");
 
-                // Now set up the server connection so we can communicate the measurements to python
-                using (NamedPipeClientStream pipeClient = new NamedPipeClientStream(".", PIPE_NAME, PipeDirection.InOut))
+                // When persistent, the server outlives any one python process: once python
+                // disconnects (or detaches) we wait for the next one to create the pipe, so
+                // the drum doesn't have to be spun up again. If nobody connects within the
+                // idle timeout, the server shuts down.
+                while (true)
                 {
+                    // Now set up the server connection so we can communicate the measurements to python
                     if (!suppressOutput)
-                        Console.Write("Attempting connection to pipe...");
+                        Console.Write("Attempting connection to {0}...", socketAddress ?? "pipe");
 
-                    pipeClient.Connect();
+                    Stream connection = (socketAddress == null)
+                        ? ConnectPipe(persistent ? idleTimeout * 1000 : -1)
+                        : ConnectSocket(socketAddress, persistent ? idleTimeout * 1000 : -1);
 
-                    if (!suppressOutput)
+                    if (connection == null)
                     {
-                        Console.WriteLine("connection established!");
-                        Console.WriteLine("Connected to pipe: {0}", PIPE_NAME);
+                        if (!suppressOutput)
+                            Console.WriteLine("no connection within {0} seconds, shutting down", idleTimeout);
+                        break;
                     }
 
-                    using (StreamReader sr = new StreamReader(pipeClient))
+                    if (!suppressOutput)
+                        Console.WriteLine("connection established!");
+
+                    using (connection)
                     {
-                        StreamWriter sw = new StreamWriter(pipeClient);
+                        using (StreamReader sr = new StreamReader(connection))
+                        {
+                            MessageWriter sw = new MessageWriter(connection, socketAddress != null);
 
-                        string line;
+                            // Ring in shared memory that binary frames go into instead, once
+                            // python asks for it with "sharedmemory <name>"
+                            SharedMemoryRing ring = null;
 
-                        while ((line = sr.ReadLine()) != null)
-                        {
-                            switch (line)
+                            string line;
+
+                            // Whether batches of measurements are sent as binary frames or text
+                            bool binaryMode = false;
+
+                            // Set when python detaches, leaving the server running for next time
+                            bool detached = false;
+
+                            while (!detached && (line = sr.ReadLine()) != null)
                             {
                                 //////////////////////////
-                                case "measure":
+                                // "measure N" takes N measurements and sends them back as a single
+                                // message, so python only needs one round trip for many samples
+                                if (line.StartsWith("measure "))
+                                {
+                                    int numSamples;
+                                    if (!int.TryParse(line.Substring("measure ".Length), out numSamples) || numSamples < 1)
+                                    {
+                                        sw.WriteLine("Error");
+                                        continue;
+                                    }
+
                                     if (!suppressOutput)
-                                        Console.Write("Measuring...");
-                                    string message = GetMeasurement(bp2Device);
-                                    if (message.Length > 0)
+                                        Console.Write("Measuring {0} samples...", numSamples);
+
+                                    if (binaryMode)
                                     {
-                                        //sw.WriteLine(message);
-                                        sw.WriteLine(message);
-                                        sw.Flush();
+                                        // Sent as a whole, so the frame is one message
+                                        byte[] frame = GetMeasurementFrame(bp2Device, numSamples);
+                                        if (ring != null)
+                                        {
+                                            ring.Write(frame);
+                                            // Python waits for this, rather than polling the ring
+                                            sw.WriteLine(SharedMemoryRing.RING_NOTICE);
+                                        }
+                                        else
+                                            sw.Write(frame);
                                     }
                                     else
                                     {
-                                        sw.WriteLine("Error measuring");
-                                        sw.Flush();
+                                        sw.WriteLine(GetMeasurementBatch(bp2Device, numSamples));
                                     }
+
                                     if (!suppressOutput)
                                         Console.WriteLine("done!");
-                                    break;
+                                    continue;
+                                }
 
                                 //////////////////////////
-                                case "status":
-                                    bp2Device.get_device_status(out deviceStatus);
-                                    sw.WriteLine(deviceStatus);
-                                    sw.Flush();
+                                // "sharedmemory <name>" attaches to the ring that python created, and
+                                // from then on binary frames are put there instead of being sent
+                                if (line.StartsWith("sharedmemory "))
+                                {
+                                    ring?.Dispose();
+                                    ring = null;
+                                    try
+                                    {
+                                        ring = new SharedMemoryRing(line.Substring("sharedmemory ".Length));
+                                        sw.WriteLine("OK");
+                                    }
+                                    catch (Exception)
+                                    {
+                                        sw.WriteLine("Error");
+                                    }
                                     if (!suppressOutput)
-                                        Console.WriteLine("Status: {0}", deviceStatus);
-                                    break;
+                                        Console.WriteLine("Shared memory: {0}", ring != null ? "attached" : "failed");
+                                    continue;
+                                }
 
                                 //////////////////////////
-                                case "stop":
-                                    if (!suppressOutput)
-                                        Console.Write("Stopping...");
-                                    sw.WriteLine("Stopping");
-                                    sw.Flush();
-                                    bp2Device.Dispose();
+                                // "profiles N" is like "measure N", but with the full x and y profiles of
+                                // each sample as well; only in binary mode, since they are far too big
+                                // to send as text
+                                if (line.StartsWith("profiles "))
+                                {
+                                    int numSamples;
+                                    if (!binaryMode || !int.TryParse(line.Substring("profiles ".Length), out numSamples) || numSamples < 1)
+                                    {
+                                        sw.WriteLine("Error");
+                                        continue;
+                                    }
+
                                     if (!suppressOutput)
-                                        Console.WriteLine("done!");
-                                    return;
+                                        Console.Write("Measuring {0} profiles...", numSamples);
+
+                                    byte[] frame = GetProfileFrame(bp2Device, numSamples);
+                                    if (ring != null)
+                                    {
+                                        ring.Write(frame);
+                                        sw.WriteLine(SharedMemoryRing.RING_NOTICE);
+                                    }
+                                    else
+                                        sw.Write(frame);
 
-                                //////////////////////////
-                                default:
                                     if (!suppressOutput)
-                                        Console.WriteLine("Unknown command: {0}", line);
-                                    sw.WriteLine("Error");
-                                    sw.Flush();
-                                    break;
+                                        Console.WriteLine("done!");
+                                    continue;
+                                }
+
+                                switch (line)
+                                {
+                                    //////////////////////////
+                                    case "measure":
+                                        if (!suppressOutput)
+                                            Console.Write("Measuring...");
+                                        string message = GetMeasurement(bp2Device);
+                                        if (message.Length > 0)
+                                        {
+                                            sw.WriteLine(message);
+                                        }
+                                        else
+                                        {
+                                            sw.WriteLine("Error measuring");
+                                        }
+                                        if (!suppressOutput)
+                                            Console.WriteLine("done!");
+                                        break;
+
+                                    //////////////////////////
+                                    case "status":
+                                        bp2Device.get_device_status(out deviceStatus);
+                                        sw.WriteLine(deviceStatus);
+                                        if (!suppressOutput)
+                                            Console.WriteLine("Status: {0}", deviceStatus);
+                                        break;
+
+                                    //////////////////////////
+                                    case "binary":
+                                    case "text":
+                                        binaryMode = (line == "binary");
+                                        sw.WriteLine("OK");
+                                        if (!suppressOutput)
+                                            Console.WriteLine("Switched to {0} protocol", line);
+                                        break;
+
+                                    //////////////////////////
+                                    case "nosharedmemory":
+                                        ring?.Dispose();
+                                        ring = null;
+                                        sw.WriteLine("OK");
+                                        break;
+
+                                    //////////////////////////
+                                    // Seconds since the drum speed became stable
+                                    case "stable":
+                                        sw.WriteLine((DateTime.Now - stableSince).TotalSeconds);
+                                        break;
+
+                                    //////////////////////////
+                                    // Close this connection, but keep the drum spinning for the next one
+                                    case "detach":
+                                        sw.WriteLine("Detaching");
+                                        detached = true;
+                                        if (!suppressOutput)
+                                            Console.WriteLine("Detached");
+                                        break;
+
+                                    //////////////////////////
+                                    case "stop":
+                                        if (!suppressOutput)
+                                            Console.Write("Stopping...");
+                                        sw.WriteLine("Stopping");
+                                        bp2Device.Dispose();
+                                        if (!suppressOutput)
+                                            Console.WriteLine("done!");
+                                        return;
+
+                                    //////////////////////////
+                                    default:
+                                        if (!suppressOutput)
+                                            Console.WriteLine("Unknown command: {0}", line);
+                                        sw.WriteLine("Error");
+                                        break;
+                                }
                             }
-                        }
 
-                        sw.Close();
+                            ring?.Dispose();
 
+                        }
                     }
+
+                    if (!persistent)
+                        break;
+
+                    if (!suppressOutput)
+                        Console.WriteLine("Waiting for the next connection...");
                 }
 
                 bp2Device.Dispose();
@@ -169,6 +364,70 @@ namespace TLBP2PipeConnection
 
         }
 
+        /// <summary>
+        /// Connect to the pipe that python created, waiting for up to timeout ms for it (or
+        /// for as long as it takes, if timeout is -1). Returns null if it never showed up.
+        /// </summary>
+        static private Stream ConnectPipe(int timeout)
+        {
+            NamedPipeClientStream pipeClient = new NamedPipeClientStream(".", PIPE_NAME, PipeDirection.InOut);
+            try
+            {
+                pipeClient.Connect(timeout);
+                return pipeClient;
+            }
+            catch (TimeoutException)
+            {
+                pipeClient.Dispose();
+                return null;
+            }
+        }
+
+        /// <summary>
+        /// Connect to the socket that python is listening on: a unix domain socket if address
+        /// is a path, or TCP if it is host:port. Unlike the pipe, connecting fails straight
+        /// away if python isn't listening yet, so we keep trying for up to timeout ms (or
+        /// forever, if timeout is -1). Returns null if it never connected.
+        /// </summary>
+        static private Stream ConnectSocket(string address, int timeout)
+        {
+            DateTime start = DateTime.Now;
+            while (true)
+            {
+                Socket socket;
+                EndPoint endPoint;
+
+                // The colon of a drive letter (eg. C:\...) doesn't count
+                int colon = address.LastIndexOf(':');
+                int port;
+                if (colon > 1 && int.TryParse(address.Substring(colon + 1), out port))
+                {
+                    socket = new Socket(AddressFamily.InterNetwork, SocketType.Stream, ProtocolType.Tcp);
+                    // Responses shouldn't be held back to be sent along with others
+                    socket.NoDelay = true;
+                    endPoint = new IPEndPoint(IPAddress.Parse(address.Substring(0, colon)), port);
+                }
+                else
+                {
+                    socket = new Socket(AddressFamily.Unix, SocketType.Stream, ProtocolType.Unspecified);
+                    endPoint = new UnixDomainSocketEndPoint(address);
+                }
+
+                try
+                {
+                    socket.Connect(endPoint);
+                    return new NetworkStream(socket, true);
+                }
+                catch (SocketException)
+                {
+                    socket.Dispose();
+                    if (timeout >= 0 && (DateTime.Now - start).TotalMilliseconds > timeout)
+                        return null;
+                    Thread.Sleep(SOCKET_RETRY_INTERVAL);
+                }
+            }
+        }
+
         /// <summary>
         /// Search for connected devices and connect to the first one.
         /// Use only driver functions and structures.
@@ -266,9 +525,10 @@ namespace TLBP2PipeConnection
         /// probably found somewhere like:
         /// C:\Program Files (x86)\IVI Foundation\VISA\WinNT\TLBP2\Examples\MS VS 2012 CSharp Demo
         /// 
-        /// Returns a string of the measurement values, with fields separated by the pipe character ('|')
+        /// Returns the measurement values in the order given by RECORD_FIELDS (which is the same
+        /// order as MEASUREMENT_DTYPE on the python side), or null if the measurement failed.
         /// </summary>
-        static private string GetMeasurement(TLBP2 bp2Device)
+        static private double[] MeasureRecord(TLBP2 bp2Device, bp2_slit_data[] bp2SlitData = null)
         {
 
             // get the drum speed
@@ -309,8 +569,9 @@ namespace TLBP2PipeConnection
             }
             */
 
-            // array of data structures for each slit.
-            bp2_slit_data[] bp2SlitData = new bp2_slit_data[4];
+            // array of data structures for each slit (given by the caller if it wants the profiles)
+            if (bp2SlitData == null)
+                bp2SlitData = new bp2_slit_data[4];
 
             // array of calculation structures for each slit.
             bp2_calculations[] bp2Calculations = new bp2_calculations[4];
@@ -320,36 +581,23 @@ namespace TLBP2PipeConnection
             float powerWindowSaturation;
             if (0 == bp2Device.get_slit_scan_data(bp2SlitData, bp2Calculations, out power, out powerWindowSaturation, null))
             {
-                // X
-                float peakPosX = bp2Calculations[0].PeakPosition;
-                float centroidPosX = bp2Calculations[0].CentroidPos;
-                float peakIntensityX = (bp2Calculations[0].PeakIntensity * 100.0f / ((float)0x7AFF - bp2SlitData[0].SlitDarkLevel));
-                float widthX = bp2Calculations[0].BeamWidthClip;
-                float gaussianFitCenterX = bp2Calculations[0].GaussianFitCentroid;
-                float gaussianFitAmpX = bp2Calculations[0].GaussianFitAmplitude;
-                float gaussianFitWidthX = bp2Calculations[0].GaussianFitDiameter;
-                float gaussianFitDegreeX = bp2Calculations[0].GaussianFitPercentage;
-
-                // Y
-                float peakPosY = bp2Calculations[1].PeakPosition;
-                float centroidPosY = bp2Calculations[1].CentroidPos;
-                float peakIntensityY = (bp2Calculations[1].PeakIntensity * 100.0f / ((float)0x7AFF - bp2SlitData[1].SlitDarkLevel));
-                float widthY = bp2Calculations[1].BeamWidthClip;
-                float gaussianFitCenterY = bp2Calculations[1].GaussianFitCentroid;
-                float gaussianFitAmpY = bp2Calculations[1].GaussianFitAmplitude;
-                float gaussianFitWidthY = bp2Calculations[1].GaussianFitDiameter;
-                float gaussianFitDegreeY = bp2Calculations[1].GaussianFitPercentage;
-
-
-                List<string> lines = new List<string>();
-
-                lines.Add("centroid=" + centroidPosX + "," + centroidPosY);
-                lines.Add("peak=" + peakPosX + "," + peakPosY);
-                lines.Add("peak_intensity=" + peakIntensityX + "," + peakIntensityY);
-                lines.Add("drum_speed=" + drumSpeed);
-                lines.Add("beam_width=" + widthX + "," + widthY);
-                lines.Add("gaussian_fit_params_x=" + gaussianFitCenterX + "," + gaussianFitWidthX + "," + gaussianFitAmpX + "," + gaussianFitDegreeX);
-                lines.Add("gaussian_fit_params_y=" + gaussianFitCenterY + "," + gaussianFitWidthY + "," + gaussianFitAmpY + "," + gaussianFitDegreeY);
+                // The order here has to match RECORD_FIELDS and MEASUREMENT_DTYPE in python
+                double[] record = new double[RECORD_LENGTH];
+                record[0] = drumSpeed;
+
+                for (int i = 0; i < 2; i++)
+                {
+                    // X is slit 0, Y is slit 1
+                    record[1 + i] = bp2Calculations[i].CentroidPos;
+                    record[3 + i] = bp2Calculations[i].PeakPosition;
+                    record[5 + i] = (bp2Calculations[i].PeakIntensity * 100.0f / ((float)0x7AFF - bp2SlitData[i].SlitDarkLevel));
+                    record[7 + i] = bp2Calculations[i].BeamWidthClip;
+
+                    record[9 + 4*i] = bp2Calculations[i].GaussianFitCentroid;
+                    record[10 + 4*i] = bp2Calculations[i].GaussianFitDiameter;
+                    record[11 + 4*i] = bp2Calculations[i].GaussianFitAmplitude;
+                    record[12 + 4*i] = bp2Calculations[i].GaussianFitPercentage;
+                }
 
                 /*
                 // This stuff ends up being too large to send easily over the pipe
@@ -359,28 +607,192 @@ namespace TLBP2PipeConnection
                 lines.Add("25um_slit_pos_y=" + string.Join(",", bp2SlitData[1].SlitSamplesPositions));
                 lines.Add("25um_slit_int_y=" + string.Join(",", bp2SlitData[1].SlitSamplesIntensities));
                 */
-                /*
-                lines.Add("25um_slit_data_x=");
-                for (int i = 0; i < bp2SlitData[0].SlitSamplesPositions.Length; i++)
-                {
-                    lines.Add(bp2SlitData[0].SlitSamplesPositions[i] + "," + bp2SlitData[0].SlitSamplesIntensities[i]);
-                }
-
-                lines.Add("25um_slit_data_y=");
-                for (int i = 0; i < bp2SlitData[1].SlitSamplesPositions.Length; i++)
-                {
-                    lines.Add(bp2SlitData[1].SlitSamplesPositions[i] + "," + bp2SlitData[1].SlitSamplesIntensities[i]);
-                }
-                */
 
-                return string.Join("|", lines);
+                return record;
                 //this.chart25um.Series[0].Points.DataBindXY(bp2SlitData[0].SlitSamplesPositions, bp2SlitData[0].SlitSamplesIntensities);
                 //this.chart25um.Series[1].Points.DataBindXY(bp2SlitData[1].SlitSamplesPositions, bp2SlitData[1].SlitSamplesIntensities);
                 //this.chart5um.Series[0].Points.DataBindXY(bp2SlitData[2].SlitSamplesPositions, bp2SlitData[2].SlitSamplesIntensities);
                 //this.chart5um.Series[1].Points.DataBindXY(bp2SlitData[3].SlitSamplesPositions, bp2SlitData[3].SlitSamplesIntensities);
             }
 
-            return "";
+            return null;
+        }
+
+        /// <summary>
+        /// Poll for a new measurement (see MeasureRecord).
+        /// 
+        /// Returns a string of the measurement values, with fields separated by the pipe character ('|'),
+        /// or an empty string if the measurement failed.
+        /// </summary>
+        static private string GetMeasurement(TLBP2 bp2Device)
+        {
+            double[] record = MeasureRecord(bp2Device);
+            if (record == null)
+                return "";
+
+            List<string> lines = new List<string>();
+
+            int index = 0;
+            foreach (var (name, size) in RECORD_FIELDS)
+            {
+                // Everything except the drum speed comes from the device as a float, so format
+                // it as such to avoid sending spurious digits
+                var values = new ArraySegment<double>(record, index, size)
+                    .Select(v => name == "drum_speed" ? v.ToString() : ((float)v).ToString());
+                lines.Add(name + "=" + string.Join(",", values));
+                index += size;
+            }
+
+            return string.Join("|", lines);
+        }
+
+        /// <summary>
+        /// Write a single measurement as a fixed-layout binary record: a 1 byte valid flag followed
+        /// by the values as little-endian doubles (see MEASUREMENT_DTYPE on the python side).
+        /// A null record is written as invalid, with all values set to NaN.
+        /// </summary>
+        static private void WriteRecord(BinaryWriter bw, double[] record)
+        {
+            bw.Write(record != null);
+            for (int i = 0; i < RECORD_LENGTH; i++)
+                bw.Write(record != null ? record[i] : double.NaN);
+        }
+
+        /// <summary>
+        /// Take several measurements in a row, checking that the drum is ready before each one.
+        /// 
+        /// Returns a string of the measurements separated by the ';' character. Any sample that
+        /// could not be measured is replaced by "Error measuring", so the number of samples in
+        /// the message is always the same as the number requested.
+        /// </summary>
+        static private string GetMeasurementBatch(TLBP2 bp2Device, int numSamples)
+        {
+            List<string> samples = new List<string>(numSamples);
+
+            for (int i = 0; i < numSamples; i++)
+            {
+                string message = IsReady(bp2Device) ? GetMeasurement(bp2Device) : "";
+                samples.Add(message.Length > 0 ? message : "Error measuring");
+            }
+
+            return string.Join(";", samples);
+        }
+
+        /// <summary>
+        /// Take several measurements in a row (like GetMeasurementBatch), but return them as a
+        /// binary frame: a header (magic, version, record size, count) followed by one fixed-size
+        /// record per sample, all little-endian. Samples that could not be measured are marked
+        /// invalid in their record.
+        /// </summary>
+        static private byte[] GetMeasurementFrame(TLBP2 bp2Device, int numSamples)
+        {
+            using (MemoryStream ms = new MemoryStream(12 + RECORD_SIZE * numSamples))
+            using (BinaryWriter bw = new BinaryWriter(ms))
+            {
+                bw.Write(FRAME_MAGIC);
+                bw.Write(FRAME_VERSION);
+                bw.Write(RECORD_SIZE);
+                bw.Write((uint)numSamples);
+
+                for (int i = 0; i < numSamples; i++)
+                    WriteRecord(bw, IsReady(bp2Device) ? MeasureRecord(bp2Device) : null);
+
+                bw.Flush();
+                return ms.ToArray();
+            }
+        }
+
+        /// <summary>
+        /// Take several measurements in a row (like GetMeasurementFrame), along with the full x and y
+        /// profiles of each sample, so the beam center can be worked out again in python. After the
+        /// header (which also has the length of the profiles) and the records come, starting at the
+        /// next multiple of 8 bytes, the x positions, x intensities, y positions and y intensities of
+        /// each sample, as floats (see PROFILE_FRAME_HEADER_DTYPE in python). Every profile is as
+        /// long as the longest one in the batch; shorter ones are padded with zero intensity, and
+        /// samples that could not be measured have all zero profiles.
+        /// </summary>
+        static private byte[] GetProfileFrame(TLBP2 bp2Device, int numSamples)
+        {
+            double[][] records = new double[numSamples][];
+            bp2_slit_data[][] slitData = new bp2_slit_data[numSamples][];
+            int profileLength = 0;
+
+            for (int i = 0; i < numSamples; i++)
+            {
+                slitData[i] = new bp2_slit_data[4];
+                records[i] = IsReady(bp2Device) ? MeasureRecord(bp2Device, slitData[i]) : null;
+
+                // X is slit 0, Y is slit 1
+                if (records[i] != null)
+                    for (int slit = 0; slit < 2; slit++)
+                        profileLength = Math.Max(profileLength, ProfileCount(slitData[i][slit]));
+            }
+
+            int profileOffset = (PROFILE_HEADER_SIZE + RECORD_SIZE * numSamples + 7) & ~7;
+            using (MemoryStream ms = new MemoryStream(profileOffset + 16 * profileLength * numSamples))
+            using (BinaryWriter bw = new BinaryWriter(ms))
+            {
+                bw.Write(PROFILE_FRAME_MAGIC);
+                bw.Write(PROFILE_FRAME_VERSION);
+                bw.Write(RECORD_SIZE);
+                bw.Write((uint)numSamples);
+                bw.Write((uint)profileLength);
+
+                foreach (double[] record in records)
+                    WriteRecord(bw, record);
+
+                while (ms.Position < profileOffset)
+                    bw.Write((byte)0);
+
+                for (int i = 0; i < numSamples; i++)
+                    for (int slit = 0; slit < 2; slit++)
+                        WriteProfile(bw, slitData[i][slit], records[i] != null, profileLength);
+
+                bw.Flush();
+                return ms.ToArray();
+            }
+        }
+
+        /// <summary>
+        /// Number of points in the profile of a slit.
+        /// </summary>
+        static private int ProfileCount(bp2_slit_data slitData)
+        {
+            if (slitData.SlitSamplesPositions == null || slitData.SlitSamplesIntensities == null)
+                return 0;
+            return Math.Min(slitData.SlitSampleCount,
+                            Math.Min(slitData.SlitSamplesPositions.Length, slitData.SlitSamplesIntensities.Length));
+        }
+
+        /// <summary>
+        /// Write the profile of one slit as profileLength positions followed by profileLength
+        /// intensities, padded with zero intensity at the last position (see GetProfileFrame).
+        /// </summary>
+        static private void WriteProfile(BinaryWriter bw, bp2_slit_data slitData, bool valid, int profileLength)
+        {
+            int count = valid ? ProfileCount(slitData) : 0;
+
+            float lastPosition = 0;
+            for (int i = 0; i < profileLength; i++)
+            {
+                if (i < count)
+                    lastPosition = (float)slitData.SlitSamplesPositions[i];
+                bw.Write(lastPosition);
+            }
+
+            for (int i = 0; i < profileLength; i++)
+                bw.Write(i < count ? (float)slitData.SlitSamplesIntensities[i] : 0f);
+        }
+
+        /// <summary>
+        /// Whether the drum is spinning fast enough to measure; 3 means the drum speed is
+        /// stable, 5 that it is spinning (see the python code).
+        /// </summary>
+        static private bool IsReady(TLBP2 bp2Device)
+        {
+            ushort deviceStatus;
+            bp2Device.get_device_status(out deviceStatus);
+            return deviceStatus == 3 || deviceStatus == 5;
         }
 
         /// <summary>
@@ -393,4 +805,118 @@ namespace TLBP2PipeConnection
         }
     }
 
+
+    /// <summary>
+    /// Sends responses back to python, each one as a single message. Through the pipe that is
+    /// just one write per message, but a socket doesn't keep messages apart, so there each one
+    /// is sent with its length first (see MESSAGE_HEADER in python).
+    /// </summary>
+    class MessageWriter
+    {
+        private readonly Stream stream;
+        private readonly bool withLength;
+
+        public MessageWriter(Stream stream, bool withLength)
+        {
+            this.stream = stream;
+            this.withLength = withLength;
+        }
+
+        public void Write(byte[] message)
+        {
+            if (withLength)
+            {
+                byte[] length = BitConverter.GetBytes((uint)message.Length);
+                stream.Write(length, 0, length.Length);
+            }
+            stream.Write(message, 0, message.Length);
+            stream.Flush();
+        }
+
+        public void WriteLine(object value)
+        {
+            Write(Encoding.UTF8.GetBytes(value + Environment.NewLine));
+        }
+    }
+
+    /// <summary>
+    /// The server's (writing) side of the ring buffer in shared memory that python creates for
+    /// binary frames. The layout is described in SharedMemory.py, and the two have to match.
+    /// </summary>
+    class SharedMemoryRing : IDisposable
+    {
+        private static readonly byte[] RING_MAGIC = Encoding.ASCII.GetBytes("TLSM");
+        private const uint RING_VERSION = 2;
+        // Sent through the connection once a message is in the ring (see RING_NOTICE in SharedMemory.py)
+        public const string RING_NOTICE = "Ring";
+        private const long WRITE_OFFSET = 64;
+        private const long READ_OFFSET = 128;
+        private const long DATA_OFFSET = 192;
+        private const uint WRAP_MARKER = 0xFFFFFFFF;
+
+        private readonly MemoryMappedFile file;
+        private readonly MemoryMappedViewAccessor view;
+        private readonly long capacity;
+
+        public SharedMemoryRing(string name)
+        {
+            file = MemoryMappedFile.OpenExisting(name);
+            view = file.CreateViewAccessor();
+
+            byte[] magic = new byte[RING_MAGIC.Length];
+            view.ReadArray(0, magic, 0, magic.Length);
+            if (!magic.SequenceEqual(RING_MAGIC) || view.ReadUInt32(4) != RING_VERSION)
+            {
+                Dispose();
+                throw new InvalidDataException("Not a measurement ring: " + name);
+            }
+            capacity = view.ReadInt64(8);
+
+            // Touch every page up front, rather than taking page faults in the middle of a
+            // measurement the first time around the ring (python hasn't been sent anything yet)
+            view.WriteArray(DATA_OFFSET, new byte[capacity], 0, (int)capacity);
+        }
+
+        private static long Padded(long n)
+        {
+            return (n + 7) & ~7L;
+        }
+
+        public void Write(byte[] message)
+        {
+            long needed = 8 + Padded(message.Length);
+            if (needed > capacity)
+                throw new InvalidDataException("Message does not fit in the ring");
+
+            long writeIndex = view.ReadInt64(WRITE_OFFSET);
+            long position = writeIndex % capacity;
+
+            // Skip to the start if the message doesn't fit before the end
+            long skip = (capacity - position < needed) ? capacity - position : 0;
+
+            // Python releases the last message it read when it goes to read the next one
+            while (capacity - (writeIndex - view.ReadInt64(READ_OFFSET)) < skip + needed)
+                Thread.Sleep(1);
+
+            if (skip > 0)
+            {
+                view.Write(DATA_OFFSET + position, WRAP_MARKER);
+                position = 0;
+            }
+
+            view.Write(DATA_OFFSET + position, (uint)message.Length);
+            view.Write(DATA_OFFSET + position + 4, (uint)0);
+            view.WriteArray(DATA_OFFSET + position + 8, message, 0, message.Length);
+
+            // The message has to be in place before python can see it
+            Thread.MemoryBarrier();
+            view.Write(WRITE_OFFSET, writeIndex + skip + needed);
+        }
+
+        public void Dispose()
+        {
+            view?.Dispose();
+            file?.Dispose();
+        }
+    }
 }
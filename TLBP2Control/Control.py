@@ -1,13 +1,26 @@
 import subprocess
 from .Server import *
+from .Buffer import MeasurementBuffer
+from .SharedMemory import SharedMemoryRing, DEFAULT_RING_SIZE, RING_NOTICE
+from .Session import readSession, writeSession, DEFAULT_IDLE_TIMEOUT
 import os
-from time import sleep
+import threading
+from time import sleep, monotonic
 
 import numpy as np
 
+from Utils import runWithDeadline
+from Instrumentation import instrumented, count, isEnabled
+
 # Could possibly change if you mess around with directory structure
 CS_SERVER_EXE = r'CSServer\TLBP2PipeConnection.exe'
 LAUNCH_ARGS = ' --suppress-output' # To make the output from the server not be projected into the python output
+PERSISTENT_ARGS = ' --persistent --idle-timeout {}' # Keep the server running between sessions (see TLBP2(persistent=True))
+SOCKET_ARGS = ' --socket "{}"' # Connect to python through a socket instead of the pipe (see TLBP2(transport='socket'))
+
+# How long (in seconds) to wait for a running persistent server to connect to the pipe
+# before giving up on it and starting a new one (see TLBP2._attachPersistentServer)
+ATTACH_TIMEOUT = 10
 
 
 # Current file location (where this script is)
@@ -17,23 +30,190 @@ CURR_FILE_DIR =  os.path.dirname(__file__)
 # server executable above, and would require changing the C# source
 PIPE_NAME = 'TLBP2PyConnection'
 
+# Layout of a single measurement when collected in batches (see TLBP2.getMeasurements)
+# Field names match the keys of the dictionary returned by TLBP2.getMeasurement, with an
+# extra 'valid' flag that is False whenever the server could not take that sample
+MEASUREMENT_DTYPE = np.dtype([('valid', '?'),
+                              ('drum_speed', '<f8'),
+                              ('centroid', '<f8', (2,)),
+                              ('peak', '<f8', (2,)),
+                              ('peak_intensity', '<f8', (2,)),
+                              ('beam_width', '<f8', (2,)),
+                              ('gaussian_fit_params_x', '<f8', (4,)),
+                              ('gaussian_fit_params_y', '<f8', (4,))])
+
+# When using the binary protocol (see TLBP2(binary=True)), a batch of measurements is sent
+# as a single frame: this header, followed by 'count' records laid out exactly as
+# MEASUREMENT_DTYPE (little-endian, no padding), so the records can be read straight
+# out of the receive buffer without any parsing
+FRAME_HEADER_DTYPE = np.dtype([('magic', 'S4'),
+                               ('version', '<u2'),
+                               ('record_size', '<u2'),
+                               ('count', '<u4')])
+FRAME_MAGIC = b'TLBP'
+FRAME_VERSION = 1
+
+# Raw profiles (see TLBP2.getProfiles) come in their own kind of frame: this header, then
+# 'count' records as above, then (starting at the next multiple of 8 bytes, see
+# profileOffset) for each sample its x and y profiles, each of which is profile_length
+# positions (in microns) followed by as many intensities (in digits, with the dark level
+# subtracted), as little-endian floats
+PROFILE_FRAME_HEADER_DTYPE = np.dtype([('magic', 'S4'),
+                                       ('version', '<u2'),
+                                       ('record_size', '<u2'),
+                                       ('count', '<u4'),
+                                       ('profile_length', '<u4')])
+PROFILE_FRAME_MAGIC = b'TLPF'
+PROFILE_FRAME_VERSION = 1
+PROFILE_DTYPE = np.dtype('<f4')
+
+# Most points the device takes across a slit, which the receive buffer has to allow for
+MAX_PROFILE_LENGTH = 7500
+
+# Defaults for streaming mode (see TLBP2.startStreaming)
+STREAM_CAPACITY = 10000
+STREAM_BATCH_SIZE = 10
+
+# Samples in a batched measurement are separated by this character
+SAMPLE_SEPARATOR = ';'
+MEASURE_ERROR = 'Error measuring'
+
+
+def profileOffset(count):
+    """
+    Where the profiles start in a frame of count raw profiles (see PROFILE_FRAME_HEADER_DTYPE).
+    """
+    return (PROFILE_FRAME_HEADER_DTYPE.itemsize + count * MEASUREMENT_DTYPE.itemsize + 7) & ~7
+
+
+def profileFrameSize(count, profileLength):
+    return profileOffset(count) + count * 4 * profileLength * PROFILE_DTYPE.itemsize
+
+
+@instrumented('tlbp2.parse')
+def parseMeasurement(rawData):
+    """
+    Parse a single measurement of the form 'key=v1,v2|key=v1|...' sent by the server
+    into a dictionary of floats (single values) and numpy arrays (multiple values).
+
+    Returns None if the server could not take the measurement.
+    """
+    if rawData == MEASURE_ERROR:
+        count('tlbp2.measureErrors')
+        return None
+
+    # Data fields are separated by | character
+    fieldsArr = rawData.split('|')
+    
+    fieldsDict = {}
+
+    for s in fieldsArr:
+        key, val = s.split('=')
+
+        if len(val.split(',')) == 1:
+            fieldsDict[key] = float(val)
+        else:
+            fieldsDict[key] = np.array([float(ele) for ele in val.split(',')], dtype='double')
+
+    return fieldsDict
+
+
 class TLBP2():
   
     # Messages that can be sent through the pipe
     _STATUS = 'status'
     _MEASURE = 'measure'
+    _MEASURE_BATCH = 'measure {}'
+    _PROFILES = 'profiles {}'
+    _BINARY = 'binary'
+    _TEXT = 'text'
+    _STABLE = 'stable'
+    _SHARED_MEMORY = 'sharedmemory {}'
+    _NO_SHARED_MEMORY = 'nosharedmemory'
+    _DETACH = 'detach'
     _STOP = 'stop'
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, binary=False, persistent=False, idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                 transport=None, sharedMemory=False, readTimeout=None):
         """
-
+        If binary is True, batches of measurements (see getMeasurements) are sent from the
+        server as fixed-layout binary frames instead of text. If the server doesn't support
+        this, the connection falls back to the text protocol.
+
+        transport is how requests get to the server: 'pipe' (a named pipe, only on windows)
+        or 'socket' (see Server.py); by default, the pipe if it is available. If sharedMemory
+        is also True (along with binary), the binary frames come back through a ring buffer
+        in shared memory instead (see SharedMemory.py), which saves copying each frame through
+        the pipe, so it is only worth it for large batches.
+
+        If readTimeout is given, waiting more than that many seconds for a response from the
+        server raises a TimeoutError (and disconnects, since the response could still turn
+        up later, in place of the answer to the next request). By default, reads wait for
+        as long as it takes.
+
+        If persistent is True, the server is left running (with the drum spinning) when
+        disconnecting, and the next TLBP2 to connect (from any python process) attaches to
+        it instead of starting a new one, skipping the ~15 second warm up. The server shuts
+        itself down if no one connects for idleTimeout seconds; see also Session.stopServer.
         """
         self._isConnected = False
         self._serverRunning = False
         self._debugMode = False
+        self._useBinary = binary
+        self._binaryMode = False
+        self._persistent = persistent
+        self._idleTimeout = idleTimeout
+        self._transport = transport if transport is not None else defaultTransport()
+        self._useSharedMemory = sharedMemory
+        self._readTimeout = readTimeout
+        # Set while the server is sending binary frames through shared memory
+        self._ring = None
+        # Reused by every binary read, so it only grows when a larger batch is requested
+        self._recvBuffer = bytearray()
+
+        # Only one request can be in flight through the pipe at a time, which matters
+        # once the streaming thread is also sending requests
+        self._pipeLock = threading.RLock()
+
+        self._streamThread = None
+        self._streamStop = threading.Event()
+        self.buffer = None
+        # Why streaming stopped on its own (eg. a read timed out), or None
+        self.streamStopReason = None
+
+        self._csProcess = None
+        self._pipeCon = None
         pass
 
-    def connect(self):
+    def connect(self, timeout=None):
+        """
+        Start the server and connect to the beam profiler; returns 0 if successful.
+
+        Since starting the server and spinning up the drum can take a while (and hangs
+        forever if the server never connects), a timeout (in seconds) can be given, after
+        which the server is killed, the pipe closed, and a TimeoutError raised.
+        """
+        if timeout is not None:
+            return runWithDeadline(self._connect, timeout, cleanup=[self._abortConnect])
+
+        return self._connect()
+
+    def _abortConnect(self):
+        """
+        Tear down a connection attempt that didn't finish in time, which also unblocks
+        the thread that was waiting on the pipe.
+        """
+        if self._csProcess is not None:
+            self._csProcess.kill()
+
+        if self._pipeCon is not None:
+            self._pipeCon.close()
+        self._closeRing()
+
+        self._serverRunning = False
+        self._isConnected = False
+
+    def _connect(self):
         # First check to see if we need to be connected
         if self._isConnected:
             return
@@ -44,20 +224,33 @@ class TLBP2():
         # 3. Verify that we are ready to take measurements
 
         # 1.
-        if not self._debugMode:
-            self._csProcess = subprocess.Popen(CURR_FILE_DIR + '\\' + CS_SERVER_EXE + LAUNCH_ARGS)
+        # The pipe/socket is created first, so the server has something to connect to
+        self._pipeCon = self._openTransport()
+
+        attached = False
+        if not self._debugMode and self._persistent:
+            # If there is already a server running, it will connect to the pipe by itself
+            if readSession() is not None:
+                attached = self._attachPersistentServer()
+            if not attached:
+                self._launchPersistentServer()
+            # We don't own the server, so we never kill it
+            self._csProcess = None
+            self._serverRunning = True
+        elif not self._debugMode:
+            self._csProcess = subprocess.Popen(CURR_FILE_DIR + '\\' + CS_SERVER_EXE + LAUNCH_ARGS + self._transportArgs())
             self._serverRunning = True
         else:
             self._csProcess = None
             self._serverRunning = False
 
         # 2.
-        self._pipeCon = PipeServer(PIPE_NAME)
-        self._pipeCon.connect()
+        if not attached:
+            self._pipeCon.connect()
 
         # 3.
         self._pipeCon.write(self._STATUS)
-        status = self._pipeCon.read()
+        status = self._read()
 
         # First entry is the status of the actual pipe (ie did the message send/receive)
         # and the second is the status of the beam profiler
@@ -67,19 +260,80 @@ class TLBP2():
         # 5 means the drum is spinning but possibly not stable? (not sure how it differs from 4, but :/)
         if status[0] == 0 and int(status[1].decode()) in [3, 5]:
             self._isConnected = True
+
+            if self._useBinary:
+                self.setBinaryMode(True)
+
+                if self._useSharedMemory:
+                    self.setSharedMemory(True)
+
             return 0
 
         # Otherwise, we have an issue
         return 1
 
+    def _openTransport(self):
+        if self._transport == 'pipe':
+            return PipeServer(PIPE_NAME)
+        elif self._transport == 'socket':
+            return SocketServer()
+
+        raise ValueError(f'Unknown transport: {self._transport}')
+
+    def _transportArgs(self):
+        # The pipe is the default for the server
+        if self._transport == 'socket':
+            return SOCKET_ARGS.format(self._pipeCon.addressString())
+        return ''
+
+    def _attachPersistentServer(self):
+        """
+        Wait for the persistent server that is already running to connect; returns False if
+        it doesn't within ATTACH_TIMEOUT seconds (eg. it shut itself down after idleTimeout
+        just after we found it), in which case a fresh pipe is opened for a new server.
+        """
+        try:
+            runWithDeadline(self._pipeCon.connect, ATTACH_TIMEOUT, cleanup=[self._pipeCon.close])
+            return True
+        except TimeoutError:
+            self._pipeCon = self._openTransport()
+            return False
+
+    def _launchPersistentServer(self):
+        # Detached, so that the server isn't stopped along with this python process
+        flags = getattr(subprocess, 'DETACHED_PROCESS', 0) | getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)
+        process = subprocess.Popen(CURR_FILE_DIR + '\\' + CS_SERVER_EXE + LAUNCH_ARGS + self._transportArgs()
+                                   + PERSISTENT_ARGS.format(int(self._idleTimeout)), creationflags=flags)
+        writeSession(process.pid, self._idleTimeout)
+
+    def _read(self):
+        """
+        Read the response to a request (see readTimeout in __init__).
+        """
+        try:
+            return self._pipeCon.read(self._readTimeout)
+        except TimeoutError:
+            self._abortConnect()
+            raise
+
+    def _readInto(self, buffer):
+        try:
+            return self._pipeCon.readInto(buffer, self._readTimeout)
+        except TimeoutError:
+            self._abortConnect()
+            raise
+
     def disconnect(self):
         # First check if we are connected at all
         if not self._serverRunning and not self._isConnected:
             print("Not connected")
             return
 
+        self.stopStreaming()
+
         # Otherwise, we have to do a few things:
         # 1. Send the stop signal through the pipe to disable the beam profiler
+        #    (or, for a persistent server, just detach from it)
         # 2. Close the pipe connection itself
         # 3. Stop the server process
 
@@ -88,8 +342,8 @@ class TLBP2():
         # manually, which would have closed the pipe already
         # So surround this in try just in case
         try:
-            self._pipeCon.write(self._STOP)
-            response = self._pipeCon.read() # Should be "Stopping" but we don't really care
+            self._pipeCon.write(self._DETACH if self._persistent else self._STOP)
+            response = self._read() # Should be "Stopping" but we don't really care
         except:
             # Though if it happens when not in debug mode, that might be problem
             if not self._debugMode:
@@ -101,16 +355,79 @@ class TLBP2():
 
         # 2.
         self._pipeCon.close()
+        self._closeRing()
 
         # 3. 
-        if not self._debugMode:
+        if self._csProcess is not None:
             self._csProcess.kill()
         
         self._serverRunning = False
         self._isConnected = False
+        self._binaryMode = False
         
         return
+
+    def setBinaryMode(self, binary):
+        """
+        Switch between the text and binary protocol for batches of measurements.
+
+        Returns whether the binary protocol is in use afterwards; older versions of the
+        server don't understand the request, in which case we stay with text.
+        """
+        if not self._isConnected:
+            return False
+
+        with self._pipeLock:
+            self._pipeCon.write(self._BINARY if binary else self._TEXT)
+            response = self._read()[1].decode().strip()
+
+        if response == 'OK':
+            self._binaryMode = binary
+        else:
+            self._binaryMode = False
+
+        return self._binaryMode
+
+    def setSharedMemory(self, enabled, size=DEFAULT_RING_SIZE):
+        """
+        Switch between getting binary frames (see setBinaryMode) through shared memory and
+        through the pipe. The shared memory is a ring buffer of (about) size bytes, which
+        has to be big enough for the largest batch of measurements (137 bytes each).
+
+        Returns whether shared memory is in use afterwards; older versions of the server
+        don't understand the request, in which case we stay with the pipe.
+        """
+        if not self._isConnected:
+            return False
+
+        with self._pipeLock:
+            if not enabled:
+                if self._ring is not None:
+                    self._pipeCon.write(self._NO_SHARED_MEMORY)
+                    self._read()
+                    self._closeRing()
+                return False
+
+            if self._ring is not None:
+                return True
+
+            ring = SharedMemoryRing(size=size)
+            self._pipeCon.write(self._SHARED_MEMORY.format(ring.name))
+            response = self._read()[1].decode().strip()
+
+            if response == 'OK':
+                self._ring = ring
+            else:
+                ring.close()
+
+        return self._ring is not None
+
+    def _closeRing(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
  
+    @instrumented('tlbp2.getStatus')
     def getStatus(self):
         """
         Get the status of the beam profiler control library. Possible states are:
@@ -126,14 +443,32 @@ class TLBP2():
         if not self._isConnected:
             return 2
 
-        self._pipeCon.write(self._STATUS)
-        status = self._pipeCon.read() # Should be 3
+        with self._pipeLock:
+            self._pipeCon.write(self._STATUS)
+            status = self._read() # Should be 3
 
         if not int(status[1].decode()) in [3, 5]:
             return 1
 
         return 0
 
+    def getStableTime(self):
+        """
+        Get how long (in seconds) the drum speed has been stable for, which for a persistent
+        server may be much longer than this connection has been open.
+
+        Returns None if not connected to the beam profiler.
+        """
+        if not self._isConnected:
+            return None
+
+        with self._pipeLock:
+            self._pipeCon.write(self._STABLE)
+            response = self._read()[1].decode().strip()
+
+        return float(response)
+
+    @instrumented('tlbp2.getMeasurement')
     def getMeasurement(self):
         """
         Read out the measurement from the beam profiler. Data is returned in dictionary form,
@@ -154,29 +489,278 @@ class TLBP2():
         """
         # Make sure we actually can take a measurement
         if self.getStatus() != 0:
+            # Callers (eg. the BeamTracking notebook) retry until they get a measurement
+            count('tlbp2.notReady')
             return None
 
         # Grab the raw data
-        self._pipeCon.write(self._MEASURE)
-        rawData = self._pipeCon.read()[1].decode().strip()
+        with self._pipeLock:
+            self._pipeCon.write(self._MEASURE)
+            rawData = self._read()[1].decode().strip()
 
         #print(rawData)
 
-        if rawData == "Error measuring":
+        return parseMeasurement(rawData)
+
+    @instrumented('tlbp2.getMeasurements')
+    def getMeasurements(self, n):
+        """
+        Take n measurements from the beam profiler in a single request to the server.
+
+        Data is returned as a numpy structured array of length n (see MEASUREMENT_DTYPE),
+        with the same fields as the dictionary from getMeasurement, eg:
+
+            samples = bp2Device.getMeasurements(20)
+            gaussCenters = samples['gaussian_fit_params_x'][samples['valid'],0]
+
+        The server checks the drum status before each sample itself, so (unlike getMeasurement)
+        there is no extra status request. Any sample that could not be taken (eg. if the drum
+        speed isn't stable) has its 'valid' field set to False and the rest of its fields set
+        to nan, so there is no need to retry in a loop.
+
+        Raises an Exception if the server is too old to know the request.
+
+        Returns None if not connected to the beam profiler.
+        """
+        if not self._isConnected:
             return None
 
-        # Data fields are separated by | character
-        fieldsArr = rawData.split('|')
-        
-        fieldsDict = {}
+        if n == 0:
+            return np.zeros(0, dtype=MEASUREMENT_DTYPE)
 
-        for s in fieldsArr:
-            key, val = s.split('=')
+        with self._pipeLock:
+            self._pipeCon.write(self._MEASURE_BATCH.format(n))
 
-            if len(val.split(',')) == 1:
-                fieldsDict[key] = float(val)
-            else:
-                fieldsDict[key] = np.array([float(ele) for ele in val.split(',')], dtype='double')
+            if self._binaryMode:
+                # Copied out of the receive buffer (or shared memory), which the next request
+                # reuses; as bytes, since numpy copies structured arrays field by field, which
+                # takes several times longer
+                samples = self._readFrame(n).view(np.uint8).copy().view(MEASUREMENT_DTYPE)
+                self._countInvalid(samples)
+                return samples
+
+            rawData = self._read()[1].decode().strip()
+
+        # What the server answers to a request it doesn't know (unlike a sample that
+        # couldn't be taken, which is 'Error measuring')
+        if rawData == 'Error':
+            raise Exception(f'Server did not understand "{self._MEASURE_BATCH.format(n)}"; it is probably '
+                            'an old build that predates getMeasurements (see TLBP2Control/README.MD)')
+
+        samples = np.zeros(n, dtype=MEASUREMENT_DTYPE)
+
+        rawSamples = rawData.split(SAMPLE_SEPARATOR)
+
+        for i in range(n):
+            fieldsDict = parseMeasurement(rawSamples[i]) if i < len(rawSamples) else None
+
+            if fieldsDict is None:
+                for key in MEASUREMENT_DTYPE.names[1:]:
+                    samples[i][key] = np.nan
+                continue
+
+            samples[i]['valid'] = True
+            for key in MEASUREMENT_DTYPE.names[1:]:
+                samples[i][key] = fieldsDict[key]
+
+        self._countInvalid(samples)
+        return samples
+
+    @instrumented('tlbp2.getProfiles')
+    def getProfiles(self, n):
+        """
+        Take n measurements like getMeasurements, but along with the full x and y profiles
+        that the device measured across the slits, so that the beam center can be worked out
+        again afterwards (eg. with Profiles.py) instead of relying on the device's own fit:
+
+            samples, positions, intensities = bp2Device.getProfiles(20)
+            centers = gaussianCenters(positions[:,0], intensities[:,0])[0]
+
+        Returns (samples, positions, intensities), where samples is the same as from
+        getMeasurements, and positions (in microns) and intensities (in digits, with the dark
+        level subtracted) are float arrays of shape (n, 2, profileLength), with the x profile
+        then the y profile of each sample. Profiles with fewer points than profileLength are
+        padded with zero intensity, and samples that couldn't be taken have zero profiles.
+
+        The profiles are only sent as binary frames, so this needs binary mode (see
+        setBinaryMode). Unlike the samples from getMeasurements, all three arrays are views
+        into the receive buffer (or shared memory), since the profiles are far too big to copy
+        every time, so they are only valid until the next request; copy them if you need to
+        keep them.
+
+        Returns None if not connected in binary mode, or if the server doesn't support raw
+        profiles.
+        """
+        if not self._isConnected or not self._binaryMode:
+            return None
+
+        if n == 0:
+            return np.zeros(0, dtype=MEASUREMENT_DTYPE), np.zeros((0, 2, 0), dtype=PROFILE_DTYPE), \
+                   np.zeros((0, 2, 0), dtype=PROFILE_DTYPE)
+
+        frameSize = profileFrameSize(n, MAX_PROFILE_LENGTH)
+        if self._ring is not None and frameSize > self._ring.capacity // 2:
+            # Allowing for the space skipped when the frame wraps around the end of the ring,
+            # otherwise the server could end up waiting forever for room
+            raise ValueError(f'{n} profiles may not fit in shared memory (see setSharedMemory)')
+
+        with self._pipeLock:
+            self._pipeCon.write(self._PROFILES.format(n))
+            frame = self._receiveFrame(frameSize)
+
+            header = np.frombuffer(frame, dtype=PROFILE_FRAME_HEADER_DTYPE, count=1)[0]
+            if header['magic'] != PROFILE_FRAME_MAGIC:
+                # Most likely the server answered 'Error', not knowing the request
+                return None
+
+            numSamples = int(header['count'])
+            profileLength = int(header['profile_length'])
+            if (header['version'] != PROFILE_FRAME_VERSION or header['record_size'] != MEASUREMENT_DTYPE.itemsize
+                    or numSamples > n or profileLength > MAX_PROFILE_LENGTH):
+                raise Exception('Invalid profile frame received from server')
+
+            samples = np.frombuffer(frame, dtype=MEASUREMENT_DTYPE,
+                                    count=numSamples, offset=PROFILE_FRAME_HEADER_DTYPE.itemsize)
+            profiles = np.frombuffer(frame, dtype=PROFILE_DTYPE, count=numSamples * 4 * profileLength,
+                                     offset=profileOffset(numSamples)).reshape(numSamples, 2, 2, profileLength)
+
+        self._countInvalid(samples)
+        return samples, profiles[:,:,0], profiles[:,:,1]
+
+    def _countInvalid(self, samples):
+        if isEnabled():
+            count('tlbp2.samples', len(samples))
+            count('tlbp2.invalidSamples', int(np.sum(~samples['valid'])))
+
+    def startStreaming(self, capacity=STREAM_CAPACITY, batchSize=STREAM_BATCH_SIZE):
+        """
+        Start a background thread that keeps taking measurements (in batches of batchSize,
+        see getMeasurements) and stores them in a ring buffer holding the latest capacity
+        samples, so acquisition can carry on while the rest of the program is busy moving
+        the stage, plotting, etc.
+
+        Each sample is timestamped with time.monotonic(), and can be read back with
+        eg.
+
+            bp2Device.startStreaming()
+            ...
+            t0 = time.monotonic()
+            timestamps, samples = bp2Device.buffer.since(t0)
+
+        (see MeasurementBuffer in Buffer.py). Invalid samples are stored as well, with
+        their 'valid' field set to False. If streaming stops on its own (eg. the server
+        stopped responding), the reason is left in streamStopReason.
+
+        Returns the buffer, or None if not connected to the beam profiler.
+        """
+        if not self._isConnected:
+            return None
+
+        if self.isStreaming():
+            return self.buffer
+        self.stopStreaming()
+
+        self.buffer = MeasurementBuffer(capacity, MEASUREMENT_DTYPE)
+        self._streamStop.clear()
+        self.streamStopReason = None
+
+        self._streamThread = threading.Thread(target=self._stream, args=(batchSize,), daemon=True)
+        self._streamThread.start()
+
+        return self.buffer
+
+    def stopStreaming(self):
+        """
+        Stop the background thread started by startStreaming. The buffer is kept
+        around (as TLBP2.buffer) so the samples can still be read afterwards.
+        """
+        if self._streamThread is None:
+            return
+
+        self._streamStop.set()
+        self._streamThread.join()
+        self._streamThread = None
+
+    def isStreaming(self):
+        """
+        Returns whether or not measurements are currently being streamed into the buffer.
+        """
+        return self._streamThread is not None and self._streamThread.is_alive()
+
+    def _stream(self, batchSize):
+        """
+        Worker for startStreaming; runs until stopStreaming is called or the pipe fails.
+        """
+        while not self._streamStop.is_set():
+            # Held until the samples are in the buffer, so that requests from other threads
+            # don't end up in between
+            with self._pipeLock:
+                try:
+                    start = monotonic()
+                    samples = self.getMeasurements(batchSize)
+                    end = monotonic()
+                except Exception as e:
+                    self._streamStopped(f'pipe closed unexpectedly ({e!r})')
+                    break
+
+                # A read that timed out (here or in another thread) disconnects the device
+                if samples is None:
+                    self._streamStopped('no longer connected to the beam profiler')
+                    break
+
+                # The server doesn't report when each sample in a batch was taken, so we
+                # assume they are evenly spread over the time the request took
+                timestamps = np.linspace(start, end, len(samples)+1)[1:]
+
+                self.buffer.append(samples, timestamps)
+
+    def _streamStopped(self, reason):
+        self.streamStopReason = reason
+        if not self._debugMode:
+            print(f'Streaming stopped: {reason}!')
+
+    def _receiveFrame(self, frameSize):
+        """
+        Get the next binary frame (of at most frameSize bytes), either from shared memory or
+        read into the receive buffer, which is grown to fit it.
+        """
+        if self._ring is not None:
+            # The server tells us through the pipe once the frame is in shared memory
+            response = self._read()[1]
+            if response.strip() == RING_NOTICE:
+                try:
+                    return self._ring.read(self._readTimeout)
+                except TimeoutError:
+                    self._abortConnect()
+                    raise
+
+        if len(self._recvBuffer) < frameSize:
+            self._recvBuffer = bytearray(frameSize)
+
+        if self._ring is not None:
+            # It answered in the pipe instead (eg. with 'Error'), which isn't a frame
+            numRead = min(len(response), frameSize)
+            self._recvBuffer[:numRead] = response[:numRead]
+        else:
+            self._readInto(self._recvBuffer)
+
+        return self._recvBuffer
+
+    def _readFrame(self, n):
+        """
+        Read a binary frame of (up to) n measurements into the receive buffer (or, with
+        shared memory, straight out of the ring buffer), and return the records as a view
+        into that buffer.
+
+        Note that the buffer is reused, so the returned array is only valid until the next
+        call; copy it if you need to keep it around.
+        """
+        frame = self._receiveFrame(FRAME_HEADER_DTYPE.itemsize + n * MEASUREMENT_DTYPE.itemsize)
 
-        return fieldsDict
+        header = np.frombuffer(frame, dtype=FRAME_HEADER_DTYPE, count=1)[0]
+        if (header['magic'] != FRAME_MAGIC or header['version'] != FRAME_VERSION
+                or header['record_size'] != MEASUREMENT_DTYPE.itemsize or header['count'] > n):
+            raise Exception('Invalid measurement frame received from server')
 
+        return np.frombuffer(frame, dtype=MEASUREMENT_DTYPE,
+                             count=int(header['count']), offset=FRAME_HEADER_DTYPE.itemsize)
@@ -1,12 +1,104 @@
-import win32pipe, win32file
+import ctypes
+import os
+import socket
+import struct
+import tempfile
+import threading
+from time import sleep, monotonic
+
+try:
+    import win32pipe, win32file
+except ImportError:
+    # Only available on Windows; the rest of the library (eg. the simulated backend
+    # in Simulation.py) can still be imported without it
+    win32pipe = win32file = None
+
+from Utils import Deadline
+from Instrumentation import instrumented
 
 BUFFER_SIZE = 65536
 
+# Returned by ReadFile when a message is longer than the buffer we read it into
+ERROR_MORE_DATA = 234
+
+# Access right needed to cancel the I/O of another thread (see _cancelSynchronousIo)
+THREAD_TERMINATE = 0x0001
+
+# How many times (SPIN_TIME apart) PipeServer.close tries to wake up the threads that
+# are waiting on the pipe before closing it anyway
+CLOSE_ATTEMPTS = 50
+
+# How often we check for a message when we can't just wait for one (see _pollIntervals),
+# in seconds
+SPIN_TIME = .002
+MIN_POLL_INTERVAL = .0001
+MAX_POLL_INTERVAL = .005
+
+# Every message from the server over a socket starts with its length, since (unlike the
+# pipe) a socket doesn't keep messages separate
+MESSAGE_HEADER = struct.Struct('<I')
+
+# Where the socket transport listens, if no address is given: a unix domain socket in the
+# temp directory, or (on windows, where python doesn't have them) a port on localhost
+SOCKET_NAME = 'TLBP2PyConnection.sock'
+SOCKET_PORT = 52709
+
+
+def _pollIntervals():
+    """
+    Generate the time to sleep between each check for a message. For the first SPIN_TIME
+    seconds, we only give up the rest of our time slice, so that quick responses are picked
+    up right away, and after that the interval starts small and doubles each time, so that
+    waiting on a long batch of measurements doesn't take up a whole core.
+    """
+    spinUntil = monotonic() + SPIN_TIME
+    while monotonic() < spinUntil:
+        yield 0
+
+    interval = MIN_POLL_INTERVAL
+    while True:
+        yield interval
+        interval = min(2*interval, MAX_POLL_INTERVAL)
+
+
+def _cancelSynchronousIo(threadId):
+    """
+    Cancel the blocking call (eg. ConnectNamedPipe or ReadFile) that the thread with the given
+    (native) id is waiting in, which then fails with ERROR_OPERATION_ABORTED.
+    """
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenThread(THREAD_TERMINATE, False, threadId)
+    if not handle:
+        return
+
+    try:
+        kernel32.CancelSynchronousIo(handle)
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+# Every transport (the way that messages get to and from the C# server) has the same methods:
+#
+#     connect()                     Wait for the server to connect
+#     write(message)                Send a (str) request
+#     read(timeout=None)            Read the next message as (status, bytes)
+#     readInto(buffer, timeout=None)
+#                                   Read the next message into a writable buffer, returning
+#                                   the number of bytes read
+#     close()                       Also wakes up a thread that is waiting in connect or a
+#                                   read, which then raises an error
+#
+# Reads wait for as long as it takes if timeout is None, and otherwise raise a TimeoutError
+# once timeout seconds have passed without a message.
+#
+# In every case, python creates the connection and the server connects to it.
+
+
 # The server setup to communicate with the measurements done in C#
 # The user should not actually use this class, but should interact
 # via the wrappers in Control.py
 class PipeServer():
-    
+
     def __init__(self, pipeName):
         self.pipeName = pipeName
 
@@ -19,17 +111,233 @@ class PipeServer():
                 30, # Long (ish) timeout period
                 None) # No security
 
+        # Closing the handle doesn't wake up a thread that is waiting on the pipe (eg. in
+        # ConnectNamedPipe, when the server never shows up), so close cancels their calls
+        # instead, which needs to know which threads they are (see _blocking)
+        self._blockedThreads = set()
+        self._blockedLock = threading.Lock()
+        self._closed = False
+
+    def _blocking(self, func, *args):
+        """
+        Call func(*args), which might wait on the pipe, such that close (from another
+        thread) can cancel it.
+        """
+        threadId = threading.get_native_id()
+        with self._blockedLock:
+            if self._closed:
+                raise OSError('Pipe has been closed')
+            self._blockedThreads.add(threadId)
+
+        try:
+            return func(*args)
+        finally:
+            with self._blockedLock:
+                self._blockedThreads.discard(threadId)
+
     # Pretty basic wrappers for basic operations with the pipe
-    # Note that this hangs while waiting for a connection
+    # Note that this hangs while waiting for a connection (until the pipe is closed)
     def connect(self):
-        win32pipe.ConnectNamedPipe(self.pipe, None)
+        self._blocking(win32pipe.ConnectNamedPipe, self.pipe, None)
 
+    @instrumented('pipe.write')
     def write(self, message):
-        win32file.WriteFile(self.pipe, message.encode() + b'\n')
+        self._blocking(win32file.WriteFile, self.pipe, message.encode() + b'\n')
+
+    # ReadFile on its own hangs until a message arrives (and can lock up the program), so
+    # with a timeout we first wait for there to be something to read
+    def _waitForMessage(self, timeout):
+        if timeout is None:
+            return
+
+        deadline = Deadline(timeout)
+        for interval in _pollIntervals():
+            data, available, remaining = win32pipe.PeekNamedPipe(self.pipe, 0)
+            if available > 0:
+                return
+            if deadline.expired():
+                raise TimeoutError(f'No message from the server within {timeout} seconds')
+            sleep(interval)
+
+    # Messages longer than the buffer (eg. large batches of measurements) are read in
+    # several chunks and joined back together
+    @instrumented('pipe.read')
+    def read(self, timeout=None):
+        self._waitForMessage(timeout)
+        status, data = self._blocking(win32file.ReadFile, self.pipe, BUFFER_SIZE)
+
+        chunks = [data]
+        while status == ERROR_MORE_DATA:
+            status, data = self._blocking(win32file.ReadFile, self.pipe, BUFFER_SIZE)
+            chunks.append(data)
+
+        if len(chunks) == 1:
+            return status, data
+
+        return status, b''.join(chunks)
+
+    # Read a message directly into a preallocated, writable buffer (eg. a bytearray) so
+    # that no new bytes objects have to be created; returns the number of bytes read.
+    # Anything that doesn't fit in the buffer is thrown away (like SocketServer.readInto),
+    # so the next read still starts at the beginning of a message
+    @instrumented('pipe.readInto')
+    def readInto(self, buffer, timeout=None):
+        self._waitForMessage(timeout)
+        view = memoryview(buffer)
+        numRead = 0
+
+        status = ERROR_MORE_DATA
+        while status == ERROR_MORE_DATA and numRead < len(view):
+            status, data = self._blocking(win32file.ReadFile, self.pipe, view[numRead:])
+            numRead += len(data)
+
+        while status == ERROR_MORE_DATA:
+            status, data = self._blocking(win32file.ReadFile, self.pipe, BUFFER_SIZE)
 
-    # Note that this hangs while waiting for a message, and can lock up the program
-    def read(self):
-        return win32file.ReadFile(self.pipe, BUFFER_SIZE)
+        return numRead
 
     def close(self):
+        with self._blockedLock:
+            self._closed = True
+
+        # A thread might only just be about to start waiting, so this is tried until
+        # they have all woken up (or given up on)
+        for attempt in range(CLOSE_ATTEMPTS):
+            with self._blockedLock:
+                threadIds = list(self._blockedThreads)
+            if not threadIds:
+                break
+
+            for threadId in threadIds:
+                _cancelSynchronousIo(threadId)
+            sleep(SPIN_TIME)
+
         win32file.CloseHandle(self.pipe)
+
+
+# Same as PipeServer, but over a socket, so it works on any platform (and the server could
+# even be on another machine). Requests are sent as lines of text, like the pipe, and each
+# message back is its length (see MESSAGE_HEADER) followed by the message itself.
+class SocketServer():
+
+    def __init__(self, address=None):
+        """
+        address is a path for a unix domain socket, or (host, port) for TCP; by default, the
+        one that the C# server uses when started with --socket (see SOCKET_NAME).
+        """
+        if address is None:
+            address = os.path.join(tempfile.gettempdir(), SOCKET_NAME) if hasattr(socket, 'AF_UNIX') \
+                      else ('127.0.0.1', SOCKET_PORT)
+
+        if isinstance(address, str):
+            # Left behind if python didn't get to close the last one
+            if os.path.exists(address):
+                os.remove(address)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        self._listener.bind(address)
+        self._listener.listen(1)
+
+        # The address that was actually bound (eg. if the port was 0)
+        self.address = self._listener.getsockname()
+        self._sock = None
+        self._closed = False
+
+    def addressString(self):
+        """
+        The address, as given to the C# server with --socket.
+        """
+        if isinstance(self.address, str):
+            return self.address
+        return f'{self.address[0]}:{self.address[1]}'
+
+    # Like ConnectNamedPipe, this waits for as long as it takes, but with a timeout on
+    # accept so that closing the socket from another thread (eg. TLBP2._abortConnect)
+    # still stops it
+    def connect(self):
+        self._listener.settimeout(.1)
+        while self._sock is None:
+            if self._closed:
+                raise OSError('Socket has been closed')
+            try:
+                self._sock, peer = self._listener.accept()
+            except socket.timeout:
+                continue
+
+        self._sock.settimeout(None)
+        if not isinstance(self.address, str):
+            # Requests are tiny, so they shouldn't be held back to be sent along with others
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @instrumented('pipe.write')
+    def write(self, message):
+        self._sock.sendall(message.encode() + b'\n')
+
+    def _receiveInto(self, view, deadline, timeout):
+        """
+        Fill all of view from the socket.
+        """
+        numRead = 0
+        while numRead < len(view):
+            self._sock.settimeout(deadline.remaining())
+            try:
+                received = self._sock.recv_into(view[numRead:])
+            except socket.timeout:
+                raise TimeoutError(f'No message from the server within {timeout} seconds')
+
+            if received == 0:
+                raise ConnectionError('Server closed the connection')
+            numRead += received
+
+    def _messageLength(self, deadline, timeout):
+        header = bytearray(MESSAGE_HEADER.size)
+        self._receiveInto(memoryview(header), deadline, timeout)
+        return MESSAGE_HEADER.unpack(header)[0]
+
+    @instrumented('pipe.read')
+    def read(self, timeout=None):
+        deadline = Deadline(timeout)
+        data = bytearray(self._messageLength(deadline, timeout))
+        self._receiveInto(memoryview(data), deadline, timeout)
+        return 0, bytes(data)
+
+    # Anything that doesn't fit in the buffer is thrown away, so the next read still starts
+    # at the beginning of a message
+    @instrumented('pipe.readInto')
+    def readInto(self, buffer, timeout=None):
+        deadline = Deadline(timeout)
+        length = self._messageLength(deadline, timeout)
+
+        view = memoryview(buffer)
+        numRead = min(length, len(view))
+        self._receiveInto(view[:numRead], deadline, timeout)
+
+        if length > numRead:
+            self._receiveInto(memoryview(bytearray(length - numRead)), deadline, timeout)
+
+        return numRead
+
+    def close(self):
+        self._closed = True
+
+        if self._sock is not None:
+            # Closing alone doesn't always wake up a thread that is waiting in recv
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        self._listener.close()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def defaultTransport():
+    """
+    The pipe where it is available (ie. on windows), and otherwise a socket.
+    """
+    return 'pipe' if win32pipe is not None else 'socket'
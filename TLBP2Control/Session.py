@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import time
+
+try:
+    import win32api, win32con, win32process
+except ImportError:
+    win32api = win32con = win32process = None
+
+# A persistent server (see TLBP2(persistent=True)) keeps running after python disconnects,
+# so that the next script/notebook doesn't have to wait for the drum to spin up again.
+# Which process is the server is recorded in this file, so it can be found again from any
+# python process
+SESSION_FILE = os.path.join(tempfile.gettempdir(), 'TLBP2PyConnection.session')
+
+# Default time (in seconds) that a persistent server waits for a new connection before it
+# shuts itself down (and stops the drum)
+DEFAULT_IDLE_TIMEOUT = 600
+
+# Exit code that Windows reports for a process that is still running
+STILL_ACTIVE = 259
+
+
+def isProcessAlive(pid):
+    """
+    Check whether the process with the given id is still running.
+    """
+    try:
+        handle = win32api.OpenProcess(win32con.PROCESS_QUERY_INFORMATION, False, pid)
+    except Exception:
+        return False
+
+    try:
+        return win32process.GetExitCodeProcess(handle) == STILL_ACTIVE
+    finally:
+        win32api.CloseHandle(handle)
+
+
+def readSession():
+    """
+    Get the details of the persistent server that is currently running (a dictionary with
+    'pid', 'started' and 'idle_timeout') or None if there isn't one.
+    """
+    try:
+        with open(SESSION_FILE, 'r') as sessionFile:
+            session = json.load(sessionFile)
+    except (OSError, ValueError):
+        return None
+
+    if not isProcessAlive(session['pid']):
+        clearSession()
+        return None
+
+    return session
+
+
+def writeSession(pid, idleTimeout):
+    with open(SESSION_FILE, 'w') as sessionFile:
+        json.dump({'pid': pid, 'started': time.time(), 'idle_timeout': idleTimeout}, sessionFile)
+
+
+def clearSession():
+    try:
+        os.remove(SESSION_FILE)
+    except OSError:
+        pass
+
+
+def stopServer():
+    """
+    Kill the persistent server, if there is one running.
+    """
+    session = readSession()
+    if session is None:
+        return
+
+    try:
+        handle = win32api.OpenProcess(win32con.PROCESS_TERMINATE, False, session['pid'])
+        win32api.TerminateProcess(handle, 0)
+        win32api.CloseHandle(handle)
+    finally:
+        clearSession()
@@ -0,0 +1,188 @@
+import struct
+from multiprocessing import shared_memory
+from time import sleep
+
+from Utils import Deadline
+from .Server import _pollIntervals
+
+# Default size of the ring (in bytes): about 120,000 binary measurement records
+DEFAULT_RING_SIZE = 1 << 24
+
+# Layout of the shared memory: a header, the total number of bytes the server (writer) and
+# python (reader) have each gone through, each on its own cache line, and then the data.
+# This has to match SharedMemoryRing in the C# server.
+RING_MAGIC = b'TLSM'
+RING_VERSION = 2
+HEADER = struct.Struct('<4sIQ') # magic, version, capacity of the data section
+WRITE_OFFSET = 64
+READ_OFFSET = 128
+DATA_OFFSET = 192
+
+# Each message in the data section is its length (and 4 bytes of padding, so the message
+# itself is 8 byte aligned) followed by the message, padded to a multiple of 8 bytes. A
+# message never wraps around the end of the ring; if it doesn't fit, WRAP_MARKER is written
+# in place of the length, and the message starts again at the beginning.
+MESSAGE_HEADER = struct.Struct('<II')
+WRAP_MARKER = 0xFFFFFFFF
+INDEX = struct.Struct('<Q')
+
+# Sent through the pipe (or socket) in place of each message that is put in the ring, so that
+# python can wait for it there (without using up a core, or fighting the server for it) rather
+# than polling the ring; new in version 2 of the ring
+RING_NOTICE = b'Ring'
+
+# Shared memory that couldn't be unmapped when its ring was closed (see close)
+_stillMapped = []
+
+
+def _padded(n):
+    return (n + 7) & ~7
+
+
+class SharedMemoryRing():
+    """
+    Ring buffer of messages in shared memory, which the C# server writes batches of binary
+    measurements into (see TLBP2(sharedMemory=True)). Each message is announced through the
+    pipe with a (short) RING_NOTICE, but the message itself never goes through the pipe,
+    and is handed out as a view into the shared memory, rather than being copied.
+
+    The writer only ever changes the write index (after the message itself has been
+    written), and the reader only the read index, so no locking is needed between them.
+    This relies on writes to shared memory being seen in the order they were made, which
+    is true on x86.
+    """
+
+    def __init__(self, name=None, size=DEFAULT_RING_SIZE, create=True):
+        """
+        Create a new ring with (about) size bytes of space for messages, or if create is
+        False, attach to the existing one with the given name.
+        """
+        if create:
+            capacity = _padded(size)
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=DATA_OFFSET + capacity)
+            HEADER.pack_into(self._shm.buf, 0, RING_MAGIC, RING_VERSION, capacity)
+            INDEX.pack_into(self._shm.buf, WRITE_OFFSET, 0)
+            INDEX.pack_into(self._shm.buf, READ_OFFSET, 0)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            magic, version, capacity = HEADER.unpack_from(self._shm.buf, 0)
+            if magic != RING_MAGIC or version != RING_VERSION:
+                self._shm.close()
+                raise ValueError(f'{name} is not a measurement ring')
+
+        self.name = self._shm.name
+        self.capacity = capacity
+
+        # Touch every page up front (on both sides, since each has its own mapping), rather
+        # than taking page faults in the middle of a measurement the first time around the
+        # ring; nothing has been written yet when the server attaches, so this is safe
+        self._shm.buf[DATA_OFFSET:DATA_OFFSET+capacity] = bytes(capacity)
+        self._owner = create
+        self._buf = self._shm.buf
+
+        # Size of the message that was last handed out by read, which is only released
+        # (so the writer can reuse its space) at the next read
+        self._pending = 0
+
+    def _index(self, offset):
+        return INDEX.unpack_from(self._buf, offset)[0]
+
+    def write(self, message, timeout=None):
+        """
+        Add a message (bytes-like) to the ring, waiting for the reader to make room for it
+        if need be. This is the server's side, so it is only used by the stand-in server in
+        Simulation.py.
+        """
+        length = len(message)
+        needed = MESSAGE_HEADER.size + _padded(length)
+        if needed > self.capacity:
+            raise ValueError(f'Message of {length} bytes does not fit in the ring')
+
+        writeIndex = self._index(WRITE_OFFSET)
+        position = writeIndex % self.capacity
+
+        # Skip to the start if the message doesn't fit before the end
+        skip = self.capacity - position if self.capacity - position < needed else 0
+
+        # Only set up for waiting if there isn't room already
+        if self.capacity - (writeIndex - self._index(READ_OFFSET)) < skip + needed:
+            deadline = Deadline(timeout)
+            intervals = _pollIntervals()
+            while self.capacity - (writeIndex - self._index(READ_OFFSET)) < skip + needed:
+                if deadline.expired():
+                    raise TimeoutError(f'No room in the ring within {timeout} seconds')
+                sleep(next(intervals))
+
+        if skip > 0:
+            MESSAGE_HEADER.pack_into(self._buf, DATA_OFFSET + position, WRAP_MARKER, 0)
+            position = 0
+
+        start = DATA_OFFSET + position
+        MESSAGE_HEADER.pack_into(self._buf, start, length, 0)
+        self._buf[start+MESSAGE_HEADER.size:start+MESSAGE_HEADER.size+length] = message
+
+        # Only now can the reader see the message
+        INDEX.pack_into(self._buf, WRITE_OFFSET, writeIndex + skip + needed)
+
+    def read(self, timeout=None):
+        """
+        Wait for the next message (for up to timeout seconds, raising a TimeoutError after
+        that), and return it as a memoryview into the ring.
+
+        The view is only valid until the next call to read (or release), after which the
+        writer can write over it; copy it if you need to keep it.
+        """
+        self.release()
+
+        readIndex = self._index(READ_OFFSET)
+
+        # The server announces each message through the pipe once it is written (see
+        # RING_NOTICE), so normally it is already here and there is nothing to wait for
+        if self._index(WRITE_OFFSET) == readIndex:
+            deadline = Deadline(timeout)
+            intervals = _pollIntervals()
+            while self._index(WRITE_OFFSET) == readIndex:
+                if deadline.expired():
+                    raise TimeoutError(f'No message from the server within {timeout} seconds')
+                sleep(next(intervals))
+
+        position = readIndex % self.capacity
+        length, padding = MESSAGE_HEADER.unpack_from(self._buf, DATA_OFFSET + position)
+
+        if length == WRAP_MARKER:
+            readIndex += self.capacity - position
+            INDEX.pack_into(self._buf, READ_OFFSET, readIndex)
+            position = 0
+            length, padding = MESSAGE_HEADER.unpack_from(self._buf, DATA_OFFSET)
+
+        self._pending = MESSAGE_HEADER.size + _padded(length)
+
+        start = DATA_OFFSET + position + MESSAGE_HEADER.size
+        return self._buf[start:start+length]
+
+    def release(self):
+        """
+        Let the writer reuse the space of the last message that was read.
+        """
+        if self._pending > 0:
+            INDEX.pack_into(self._buf, READ_OFFSET, self._index(READ_OFFSET) + self._pending)
+            self._pending = 0
+
+    def close(self):
+        """
+        Detach from the ring (and remove it, if this is the one that created it). Any views
+        from read are invalid after this.
+        """
+        self._buf = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # Someone is still holding on to a view (eg. an array of samples that wasn't
+            # copied), so the memory has to stay mapped for as long as python is running
+            _stillMapped.append(self._shm)
+
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
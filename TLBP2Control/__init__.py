@@ -1 +1,2 @@
 from .Control import TLBP2
+from .Session import stopServer
@@ -0,0 +1,156 @@
+"""
+Uncertainty in the fit index of refraction, found by fitting the data many times over with
+everything that isn't known exactly varied: the beam positions (within their measured
+standard deviations), the thickness of the sample and the index of refraction of air.
+
+    from Uncertainty import fileUncertainty
+
+    result = fileUncertainty('data/glass_slide_2_700nm.txt', d=.99, dStd=.01)
+    print(result['n'], result['interval'])
+
+Rather than fitting each replicate in turn, all of them are fit together (see
+Fitting._batchLeastSquares), so 10,000 replicates take a few seconds.
+
+There are two ways of generating the replicates:
+
+    'montecarlo'    Noise drawn from the standard deviation columns of the data is added to
+                    the best fit of the model
+    'bootstrap'     The points of the scan are resampled (with replacement)
+
+and in both cases the thickness and n0 are drawn from normal distributions with standard
+deviations dStd and n0Std.
+"""
+import os
+
+import numpy as np
+
+from Fitting import N_AIR, DEFAULT_BOUNDS, loadData, fitDisplacement, displacementModel, _slabResiduals, _batchLeastSquares
+from ScanFile import loadScan
+from Scan import BEAM_STD_COLUMNS, BEAM_COUNT_COLUMNS
+
+DEFAULT_REPLICATES = 10000
+
+# Replicates are fit this many at a time, to keep the memory used down
+REPLICATE_BATCH_SIZE = 2500
+
+# Number of samples averaged at each angle in the BeamTracking notebook (averagingMeasurements)
+DEFAULT_SAMPLES_PER_ANGLE = 20
+
+
+def replicateIor(theta, displacement, d, stds=None, samplesPerAngle=DEFAULT_SAMPLES_PER_ANGLE,
+                 dStd=0, n0=N_AIR, n0Std=0, replicates=DEFAULT_REPLICATES, method='montecarlo',
+                 bounds=DEFAULT_BOUNDS, seed=None):
+    """
+    Fit the index of refraction for many replicates of a scan (see above), returning the
+    best fit to the original data (popt, as from Fitting.fitDisplacement) and the index of
+    refraction for each replicate.
+
+    stds (in the same units as displacement) are the standard deviations of the samples
+    at each angle, so the uncertainty in each point is stds/sqrt(samplesPerAngle), where
+    samplesPerAngle is either a single number or one per angle (use samplesPerAngle=1 if
+    stds are already standard errors). For the 'montecarlo' method, if
+    stds aren't given, the rms of the residuals from the best fit is used for every point.
+    """
+    theta = np.asarray(theta, dtype='double')
+    displacement = np.asarray(displacement, dtype='double')
+    rng = np.random.default_rng(seed)
+
+    popt, pcov = fitDisplacement(theta, displacement, d, n0, bounds)
+    bestFit = displacementModel(theta, *popt, d, n0)
+
+    if stds is not None:
+        noise = np.asarray(stds, dtype='double') / np.sqrt(samplesPerAngle)
+    else:
+        noise = np.full(len(theta), np.sqrt(np.mean((displacement - bestFit)**2)))
+
+    iors = np.zeros(replicates)
+
+    for start in range(0, replicates, REPLICATE_BATCH_SIZE):
+        count = min(REPLICATE_BATCH_SIZE, replicates - start)
+
+        if method == 'montecarlo':
+            thetaArr = np.broadcast_to(theta, (count, len(theta)))
+            displacementArr = bestFit + noise * rng.standard_normal((count, len(theta)))
+        elif method == 'bootstrap':
+            indices = rng.integers(0, len(theta), (count, len(theta)))
+            thetaArr = theta[indices]
+            displacementArr = displacement[indices]
+        else:
+            raise ValueError(f'Unknown method: {method}')
+
+        dArr = d + dStd * rng.standard_normal(count)
+        n0Arr = n0 + n0Std * rng.standard_normal(count)
+
+        def residualFunc(params, cells):
+            return _slabResiduals(thetaArr[cells], displacementArr[cells], params, dArr[cells], n0Arr[cells])
+
+        # Every replicate starts from the best fit to the original data, which is close
+        params = _batchLeastSquares(residualFunc, np.tile(popt, (count, 1)), bounds)
+        iors[start:start+count] = params[:,2]
+
+    return popt, iors
+
+
+def confidenceInterval(values, confidence=.95):
+    """
+    Central interval containing the given fraction of the values.
+    """
+    tail = (1 - confidence) / 2
+    lower, upper = np.quantile(values, [tail, 1 - tail])
+    return float(lower), float(upper)
+
+
+def iorUncertainty(theta, displacement, d, stds=None, confidence=.95, **kwargs):
+    """
+    Fit the index of refraction, along with its uncertainty from replicateIor (which any
+    other keyword arguments are passed on to). Returns a dictionary with:
+
+        'n'             The best fit index of refraction
+        'std'           The standard deviation of the replicates
+        'interval'      The confidence interval (lower, upper) from the replicates
+        'replicates'    The index of refraction for each replicate
+    """
+    popt, iors = replicateIor(theta, displacement, d, stds, **kwargs)
+
+    return {'n': popt[2],
+            'std': np.std(iors),
+            'interval': confidenceInterval(iors, confidence),
+            'replicates': iors}
+
+
+def fileUncertainty(file, d, column='gauss_center', trim=5, **kwargs):
+    """
+    iorUncertainty for a data file (or scan, see ScanFile.py), using the matching standard
+    deviation column (see Scan.BEAM_STD_COLUMNS) for the noise in each point. Other keyword
+    arguments are passed on to iorUncertainty.
+
+    For a scan, the number of samples at each angle is taken from the scan itself (the
+    counts saved by ScanRunner, or else the number of valid raw samples), since it can be
+    different at every angle (see ScanRunner's targetStderr).
+    """
+    angleArr, displacementArr = loadData(file, column, trim)
+
+    if os.path.isdir(file):
+        data = loadScan(file)
+        if BEAM_COUNT_COLUMNS[column] in data:
+            counts = np.asarray(data[BEAM_COUNT_COLUMNS[column]], dtype='double')
+        elif data.hasSamples():
+            counts = data.validCounts().astype('double')
+        else:
+            counts = data.metadata.get('samples_per_angle') or DEFAULT_SAMPLES_PER_ANGLE
+
+        if np.ndim(counts) > 0:
+            # Angles without any samples are nan anyway
+            counts = np.maximum(counts, 1)
+            if trim > 0:
+                counts = counts[trim:-trim]
+        kwargs.setdefault('samplesPerAngle', counts)
+    else:
+        data = np.genfromtxt(file, delimiter=',', names=True)
+
+    # Same units (mm) and trimming as loadData
+    stds = data[BEAM_STD_COLUMNS[column]] * 1e-3
+    if trim > 0:
+        stds = stds[trim:-trim]
+
+    return iorUncertainty(angleArr, displacementArr, d, stds, **kwargs)
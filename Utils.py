@@ -1,16 +1,126 @@
-import multiprocessing.pool
+import concurrent.futures
 import functools
+import threading
+from time import monotonic
 
-def timeout(s):
+# Every call with a deadline runs in its own (daemon) thread, and python can't stop a thread
+# that is stuck, so a call whose cleanup doesn't unblock it leaks its thread; once this many
+# of them are stuck, runWithDeadline refuses to start any more (see runWithDeadline)
+MAX_STUCK_CALLS = 8
+
+# Threads of the calls that timed out and haven't finished since
+_stuckThreads = set()
+_stuckLock = threading.Lock()
+
+
+def _checkStuckThreads():
+    """
+    Forget about the stuck calls that have finished after all, and raise a RuntimeError if
+    there are still MAX_STUCK_CALLS of them.
+    """
+    with _stuckLock:
+        for thread in [thread for thread in _stuckThreads if not thread.is_alive()]:
+            _stuckThreads.discard(thread)
+
+        if len(_stuckThreads) >= MAX_STUCK_CALLS:
+            names = ', '.join(sorted(thread.name for thread in _stuckThreads))
+            raise RuntimeError(f'{len(_stuckThreads)} calls that timed out are still stuck ({names}), '
+                               'so no more are being started; check the devices and restart python')
+
+
+class Deadline():
+    """
+    A point in time (s seconds from creation, or never if s is None) after which some work
+    should give up. Long running functions can check deadline.expired() (eg. in a polling
+    loop) so that they stop by themselves once the caller has given up on them, instead of
+    carrying on in the background.
+    """
+
+    def __init__(self, s=None):
+        self.end = None if s is None else monotonic() + s
+        # A plain flag rather than a threading.Event, since one of these is made for every
+        # read, and setting an attribute is atomic anyway
+        self._cancelled = False
+
+    def remaining(self):
+        """
+        Seconds left until the deadline (never negative), or None if there isn't one.
+        """
+        if self.end is None:
+            return None
+        return max(self.end - monotonic(), 0.)
+
+    def cancel(self):
+        """
+        Expire the deadline right away.
+        """
+        self._cancelled = True
+
+    def expired(self):
+        return self._cancelled or (self.end is not None and monotonic() >= self.end)
+
+
+def runWithDeadline(func, deadline, *args, cleanup=(), **kwargs):
+    """
+    Run func(*args, **kwargs) in a new daemon thread, and return its result, or raise a
+    TimeoutError if it doesn't finish before the deadline (a Deadline, or a number of
+    seconds).
+
+    Python can't stop a thread that is stuck (eg. waiting on a pipe that will never be
+    written to), so on a timeout the deadline is cancelled and each function in cleanup is
+    called, which should do whatever it takes to make func return (eg. killing a process
+    or cancelling a read). If it doesn't, the thread is left behind (it won't keep python
+    from exiting), and is counted as stuck until it does finish; a RuntimeError is raised
+    instead of starting a new call while MAX_STUCK_CALLS of them are stuck.
+    """
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+
+    _checkStuckThreads()
+
+    name = getattr(func, '__name__', 'call')
+    future = concurrent.futures.Future()
+
+    def worker():
+        future.set_running_or_notify_cancel()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    thread = threading.Thread(target=worker, name=f'watchdog-{name}', daemon=True)
+    thread.start()
+
+    # Not future.result(timeout), since func might raise a TimeoutError of its own
+    done, notDone = concurrent.futures.wait([future], deadline.remaining())
+    if done:
+        return future.result()
+
+    deadline.cancel()
+
+    for callback in cleanup:
+        try:
+            callback()
+        except Exception:
+            pass
+
+    with _stuckLock:
+        if thread.is_alive():
+            _stuckThreads.add(thread)
+
+    raise TimeoutError(f'{name} did not finish before the deadline')
+
+
+def timeout(s, cleanup=()):
     """
-    Decorator function to timeout a process after s seconds
+    Decorator function to timeout a process after s seconds (see runWithDeadline)
     """
     def timeout_decorator(item):
         @functools.wraps(item)
         def func_wrapper(*args, **kwargs):
-            pool = multiprocessing.pool.ThreadPool(processes=1)
-            async_result = pool.apply_async(item, args, kwargs)
             # Raise a timeout error if it takes too long
-            return async_result.get(s)
+            return runWithDeadline(item, s, *args, cleanup=cleanup, **kwargs)
         return func_wrapper
     return timeout_decorator
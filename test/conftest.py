@@ -0,0 +1,17 @@
+"""
+Shared setup for the automated tests (run with python -m pytest from the top of the repo),
+which use the stand-ins from Simulation.py in place of the hardware.
+"""
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# ESP301Control loads the .NET command interface through pythonnet, which is only there on
+# the lab machine; the tests replace the controller itself anyway (see FakeController)
+try:
+    import clr
+except ImportError:
+    sys.modules['clr'] = types.SimpleNamespace(AddReference=lambda name: None)
+    sys.modules['CommandInterfaceESP301'] = types.SimpleNamespace(ESP301=object, __all__=['ESP301'])
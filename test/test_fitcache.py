@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import FitCache
+from BatchFit import SUMMARY_COLUMNS, fitEntry, writeSummary
+from FitCache import FitCache as Cache
+from Fitting import displacementModel, toModelAngle
+
+
+def _dataFile(tmp_path, name='sample_700nm.txt', contents='angle,gauss_center\n0,1.\n'):
+    file = tmp_path / name
+    file.write_text(contents)
+    return str(file)
+
+
+def test_keyChangesWithSettings(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'))
+    file = _dataFile(tmp_path)
+
+    assert cache.key(file, 'slab', d=1.) == cache.key(file, 'slab', d=1.)
+    assert cache.key(file, 'slab', d=1.) != cache.key(file, 'slab', d=2.)
+    assert cache.key(file, 'slab', d=1.) != cache.key(file, 'sandwich', d=1.)
+
+
+def test_keyChangesWithData(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'))
+    file = _dataFile(tmp_path)
+    before = cache.key(file, 'slab', d=1.)
+
+    _dataFile(tmp_path, contents='angle,gauss_center\n0,2.5\n')
+
+    assert cache.key(file, 'slab', d=1.) != before
+
+
+def test_keyChangesWithFittingCode(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / 'cache'))
+    file = _dataFile(tmp_path)
+    before = cache.key(file, 'slab', d=1.)
+
+    monkeypatch.setattr(FitCache, 'CODE_HASH', FitCache.hashCode([FitCache.Settings]))
+
+    assert cache.key(file, 'slab', d=1.) != before
+
+
+def test_hashCodeFollowsSource(tmp_path, monkeypatch):
+    module = tmp_path / 'model.py'
+    module.write_text('A = 1\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    import model
+
+    before = FitCache.hashCode([model])
+    module.write_text('A = 2\n')
+
+    assert FitCache.hashCode([model]) != before
+
+
+def _scanFile(tmp_path, d=1., ior=1.5):
+    angles = np.linspace(-40, 40, 41)
+    displacement = displacementModel(toModelAngle(angles), .01, .02, ior, d) * 1e3
+    file = tmp_path / 'scan.txt'
+    np.savetxt(file, np.column_stack([angles, displacement]), delimiter=',', header='angle,gauss_center', comments='')
+    return str(file)
+
+
+def test_fitEntryDoesNotLoadCachedFiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(FitCache, '_defaultCache', Cache(str(tmp_path / 'cache')))
+    entry = {'file': _scanFile(tmp_path), 'thickness': 1.}
+    row = fitEntry(entry)
+
+    def loadData(*args, **kwargs):
+        raise AssertionError('data file loaded for a cached fit')
+
+    monkeypatch.setattr(FitCache, 'loadData', loadData)
+
+    assert fitEntry(entry) == row
+    assert row['n'] == pytest.approx(1.5)
+    assert row['residual_rms'] == pytest.approx(fitEntry(entry, useCache=False)['residual_rms'], abs=1e-9)
+
+
+def test_writeSummaryEndsLines(tmp_path):
+    row = {key: 0 for key in SUMMARY_COLUMNS}
+    path = str(tmp_path / 'summary.txt')
+    writeSummary([row, row], path)
+
+    with open(path, 'r') as summaryFile:
+        assert summaryFile.read() == (','.join(SUMMARY_COLUMNS) + '\n') + ('0,' * (len(SUMMARY_COLUMNS) - 1) + '0\n') * 2
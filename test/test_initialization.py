@@ -0,0 +1,85 @@
+import sys
+import threading
+import types
+
+import pytest
+
+import ESP301Control
+import Initialization
+from Initialization import probeDevices
+
+
+class FakeStage():
+    """
+    RotationStage whose motion controller answers connect with a non-zero status.
+    """
+
+    def __init__(self, comPort, axisNum):
+        self.disconnected = False
+        FakeStage.last = self
+
+    def connect(self):
+        return 1
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def hangingTinkerforge(monkeypatch):
+    # IPConnection.connect never returns, like when the brick daemon doesn't answer
+    release = threading.Event()
+
+    class IPConnection():
+        def connect(self, host, port):
+            release.wait()
+
+        def disconnect(self):
+            release.set()
+
+    modules = {'tinkerforge': types.ModuleType('tinkerforge'),
+               'tinkerforge.ip_connection': types.SimpleNamespace(IPConnection=IPConnection),
+               'tinkerforge.bricklet_humidity': types.SimpleNamespace(BrickletHumidity=None),
+               'tinkerforge.bricklet_temperature': types.SimpleNamespace(BrickletTemperature=None)}
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+    yield
+    release.set()
+
+
+def test_probeErrorsAreKept(monkeypatch):
+    def broken(devices):
+        raise ValueError('bad port')
+
+    monkeypatch.setattr(Initialization, '_probeStage', broken)
+    monkeypatch.setattr(Initialization, '_probeBeamProfiler', lambda devices: None)
+    monkeypatch.setattr(Initialization, '_probeTinkerforge', lambda devices: None)
+
+    devices = probeDevices()
+
+    assert isinstance(devices.errors['Rotation stage'], ValueError)
+    assert 'Beam profiler' not in devices.errors
+    assert not devices.status()['Rotation stage']
+
+
+def test_stageIsDisconnectedIfConnectFails(monkeypatch):
+    monkeypatch.setattr(ESP301Control, 'RotationStage', FakeStage)
+    devices = Initialization.DeviceHealth()
+
+    with pytest.raises(Exception, match='status 1'):
+        Initialization._probeStage(devices)
+
+    assert devices.stage is None
+    assert FakeStage.last.disconnected
+
+
+def test_tinkerforgeProbeTimesOut(monkeypatch, hangingTinkerforge):
+    monkeypatch.setattr(Initialization, 'TINKERFORGE_TIMEOUT', .1)
+    monkeypatch.setattr(Initialization, '_probeStage', lambda devices: None)
+    monkeypatch.setattr(Initialization, '_probeBeamProfiler', lambda devices: None)
+
+    devices = probeDevices()
+
+    assert isinstance(devices.errors['Tinkerforge humidity sensor'], TimeoutError)
+    assert devices.ipcon is None
@@ -0,0 +1,37 @@
+import numpy as np
+
+from Fitting import displacementModel, toModelAngle
+from Planning import MAX_ANGLE, ScanPlanner, iorStderr, planAngles
+
+D = .99
+IOR = 1.51
+
+
+def test_planAngles():
+    angles = planAngles(D, numAngles=20, ior=IOR)
+
+    assert len(angles) == 20
+    assert np.all(np.diff(angles) < 0)
+    assert np.all(np.abs(angles) <= MAX_ANGLE)
+
+    # Better than the same number of angles spread evenly over the range
+    evenAngles = np.linspace(MAX_ANGLE, -MAX_ANGLE, 20)
+    assert iorStderr(angles, D, IOR) < iorStderr(evenAngles, D, IOR)
+
+
+def test_scanPlanner():
+    rng = np.random.default_rng(0)
+    planner = ScanPlanner(D, numAngles=20, ior=1.45)
+    measured = []
+
+    angle = planner.nextAngle()
+    while angle is not None:
+        measured.append(angle)
+        position = displacementModel(toModelAngle(angle), .01, .02, IOR, D) * 1e3 + rng.normal(0, 1)
+        planner.update(angle, position, 1.)
+        angle = planner.nextAngle()
+
+    # One sweep, from the largest angle to the smallest
+    assert np.all(np.diff(measured) < 0)
+    assert len(measured) <= 20
+    assert abs(planner.fit.n - IOR) < 5 * planner.fit.nStd
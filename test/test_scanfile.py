@@ -0,0 +1,32 @@
+import numpy as np
+
+from ScanFile import convertText, loadScan, metadataFromName
+
+
+def _textFile(tmp_path, name):
+    file = tmp_path / name
+    file.write_text('angle,gauss_center,gauss_std\n10,1.5,.1\n0,1.,.1\n-10,.5,.1\n')
+    return str(file)
+
+
+def test_metadataFromName():
+    assert metadataFromName('data/sapphire_disk_852nm.txt') == {'wavelength': 852}
+    assert metadataFromName('glass_0.99mm_700nm.txt') == {'wavelength': 700, 'thickness': .99}
+    assert metadataFromName('data/bk7_glass.txt') == {}
+
+
+def test_convertTextKeepsNameMetadata(tmp_path):
+    scan = loadScan(convertText(_textFile(tmp_path, 'sapphire_disk_2.29mm_852nm.txt')))
+
+    assert scan.metadata['wavelength'] == 852
+    assert scan.metadata['thickness'] == 2.29
+    assert scan.metadata['source'] == 'sapphire_disk_2.29mm_852nm.txt'
+    np.testing.assert_array_equal(scan['angle'], [10, 0, -10])
+
+
+def test_convertTextMetadataTakesPrecedence(tmp_path):
+    path = convertText(_textFile(tmp_path, 'ruby_flat_700nm.txt'), metadata={'wavelength': 694, 'thickness': 1.})
+    scan = loadScan(path)
+
+    assert scan.metadata['wavelength'] == 694
+    assert scan.metadata['thickness'] == 1.
@@ -0,0 +1,75 @@
+import socket
+import threading
+
+import pytest
+
+from TLBP2Control.Server import SocketServer, MESSAGE_HEADER
+
+
+@pytest.fixture
+def connection(tmp_path):
+    server = SocketServer(str(tmp_path / 'test.sock'))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(server.address)
+    server.connect()
+
+    yield server, client
+
+    client.close()
+    server.close()
+
+
+def _inThread(func):
+    outcome = {}
+    def run():
+        try:
+            outcome['result'] = func()
+        except Exception as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+def test_closeWakesUpConnect(tmp_path):
+    server = SocketServer(str(tmp_path / 'test.sock'))
+    thread, outcome = _inThread(server.connect)
+
+    server.close()
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert isinstance(outcome.get('error'), OSError)
+
+
+def test_closeWakesUpRead(connection):
+    server, client = connection
+    thread, outcome = _inThread(server.read)
+
+    server.close()
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert 'error' in outcome
+
+
+def test_readTimesOut(connection):
+    server, client = connection
+    with pytest.raises(TimeoutError):
+        server.read(.05)
+
+
+def _send(client, message):
+    client.sendall(MESSAGE_HEADER.pack(len(message)) + message)
+
+
+def test_readIntoThrowsAwayWhatDoesntFit(connection):
+    server, client = connection
+    _send(client, b'0123456789')
+    _send(client, b'next')
+
+    buffer = bytearray(4)
+    assert server.readInto(buffer, 1) == 4
+    assert buffer == b'0123'
+    assert server.read(1) == (0, b'next')
@@ -0,0 +1,56 @@
+import pytest
+
+from TLBP2Control.SharedMemory import SharedMemoryRing, MESSAGE_HEADER
+
+
+@pytest.fixture
+def ring():
+    # Room for three 16 byte messages (with their headers), so they soon wrap around
+    ring = SharedMemoryRing(size=3 * (MESSAGE_HEADER.size + 16))
+    yield ring
+    ring.close()
+
+
+def test_wraparound(ring):
+    reader = SharedMemoryRing(ring.name, create=False)
+    try:
+        for i in range(10):
+            # Alternating sizes, so messages don't always end right at the end of the ring
+            message = bytes([i]) * (16 if i % 2 else 5)
+            ring.write(message, timeout=1)
+            assert bytes(reader.read(timeout=1)) == message
+    finally:
+        reader.close()
+
+
+def test_writeWaitsForRoom(ring):
+    for i in range(3):
+        ring.write(bytes(16), timeout=0)
+
+    with pytest.raises(TimeoutError):
+        ring.write(bytes(16), timeout=.05)
+
+    # The message handed out last is only released at the next read
+    ring.read(timeout=0)
+    ring.read(timeout=0)
+    ring.write(bytes([1]) * 16, timeout=0)
+    ring.read(timeout=0)
+
+    assert bytes(ring.read(timeout=0)) == bytes([1]) * 16
+
+
+def test_readTimesOut(ring):
+    with pytest.raises(TimeoutError):
+        ring.read(timeout=.05)
+
+
+def test_attachChecksMagic(ring):
+    ring._shm.buf[:4] = b'XXXX'
+
+    with pytest.raises(ValueError):
+        SharedMemoryRing(ring.name, create=False)
+
+
+def test_messageTooBig(ring):
+    with pytest.raises(ValueError):
+        ring.write(bytes(ring.capacity))
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+import ESP301Control.Control
+from ESP301Control.Control import RotationStage
+
+
+class FakeController():
+    """
+    Stand-in for the ESP301 .NET object, which stops answering MD (like a controller that
+    has been unplugged) while hang is set.
+    """
+
+    def __init__(self):
+        self.hang = threading.Event()
+        self.release = threading.Event()
+        self.stopped = False
+        # How long each reply takes
+        self.latency = 0
+
+    def MD(self, axisNum, delay, errorMsg):
+        if self.hang.is_set():
+            self.release.wait()
+        sleep(self.latency)
+        return 0, False, errorMsg
+
+    def ST(self, errorMsg):
+        self.stopped = True
+        return 0
+
+    def VA_Get(self, axisNum, velocity, errorMsg):
+        return 0, 10., errorMsg
+
+
+@pytest.fixture
+def stage():
+    stage = RotationStage()
+    stage._espDev = FakeController()
+    yield stage
+    # Let the stuck worker go, so it doesn't hold on to a watchdog thread
+    stage._espDev.release.set()
+
+
+def test_waitForMoveTimesOut(stage):
+    start = monotonic()
+    with pytest.raises(TimeoutError):
+        stage.waitForMove(timeout=.2)
+
+    assert monotonic() - start < 1
+    assert stage._espDev.stopped
+
+
+def test_waitForMoveTimesOutWhenControllerHangs(stage):
+    stage._espDev.hang.set()
+
+    # In its own thread, so that a deadlock fails the test instead of hanging it
+    outcome = {}
+    def wait():
+        try:
+            stage.waitForMove(timeout=.2)
+        except TimeoutError as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=wait, daemon=True)
+    thread.start()
+    thread.join(2)
+
+    # The worker is still stuck in MD (holding the command lock), but the stage is stopped anyway
+    assert not thread.is_alive()
+    assert 'error' in outcome
+    assert stage._espDev.stopped
+
+
+def test_fewPollsDuringExpectedMove(stage, monkeypatch):
+    # A fake clock, which only moves on when we sleep
+    now = [0.]
+    monkeypatch.setattr(ESP301Control.Control, 'monotonic', lambda: now[0])
+
+    polls = 0
+    for interval in stage._pollIntervals(10):
+        if now[0] >= 10:
+            break
+        polls += 1
+        now[0] += interval
+
+    assert polls <= 12
+
+
+def test_waitForMoveAsyncDoesntBlockLoop(stage):
+    # Every reply from the controller holds things up for a while
+    stage._espDev.latency = .1
+
+    async def main():
+        ticks = 0
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(.01)
+
+        ticker = asyncio.ensure_future(tick())
+        with pytest.raises(TimeoutError):
+            await stage.waitForMoveAsync(timeout=.3)
+        ticker.cancel()
+        return ticks
+
+    # If the commands were sent from the event loop, the ticker would hardly get to run
+    assert asyncio.run(main()) > 15
+    assert stage._espDev.stopped
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from Simulation import SimulatedRotationStage, SimulatedTLBP2, SimulatedPipe
+from TLBP2Control.Control import MEASURE_ERROR, parseMeasurement
+
+
+class OldServerPipe(SimulatedPipe):
+    """
+    Answers like a server from before getMeasurements, which only knows 'measure'.
+    """
+
+    def respond(self, command):
+        if command.startswith('measure '):
+            return b'Error\n'
+        return super().respond(command)
+
+
+class OldServerTLBP2(SimulatedTLBP2):
+
+    def _simulatedPipe(self):
+        return OldServerPipe(self)
+
+
+def device(cls=SimulatedTLBP2, **kwargs):
+    stage = SimulatedRotationStage(commandLatency=0, seed=0)
+    bp2Device = cls(stage, ior=1.51, width=.99, pipeLatency=0, sampleTime=0, spinUpTime=0, seed=0, **kwargs)
+    bp2Device.connect()
+    return bp2Device
+
+
+def test_getMeasurementsFromOldServer():
+    bp2Device = device(OldServerTLBP2)
+
+    with pytest.raises(Exception, match='old build'):
+        bp2Device.getMeasurements(5)
+
+
+def test_getMeasurementsMarksDropouts():
+    bp2Device = device(dropoutRate=.5)
+
+    samples = bp2Device.getMeasurements(50)
+
+    assert len(samples) == 50
+    assert 0 < samples['valid'].sum() < 50
+    assert np.isnan(samples['centroid'][~samples['valid']]).all()
+    assert np.isfinite(samples['centroid'][samples['valid']]).all()
+
+
+def test_binaryMeasurementsAreNotOverwritten():
+    bp2Device = device(binary=True)
+    assert bp2Device._binaryMode
+
+    first = bp2Device.getMeasurements(10)
+    kept = first.copy()
+    bp2Device.getMeasurements(10)
+
+    np.testing.assert_array_equal(first, kept)
+
+
+def test_sharedMemory():
+    bp2Device = device(binary=True, transport='socket', sharedMemory=True)
+    assert bp2Device._ring is not None
+
+    try:
+        samples = bp2Device.getMeasurements(20)
+        assert len(samples) == 20 and samples['valid'].all()
+
+        # An answer that isn't a frame comes through the socket instead
+        bp2Device._pipeCon.write('profiles none')
+        assert bytes(bp2Device._receiveFrame(64)[:5]) == b'Error'
+
+        samples, positions, intensities = bp2Device.getProfiles(3)
+        assert positions.shape == (3, 2, bp2Device.profileLength)
+    finally:
+        bp2Device.disconnect()
+
+
+def test_parseMeasurement():
+    fields = parseMeasurement('drum_speed=10.5|centroid=1.25,-3.5')
+
+    assert fields['drum_speed'] == 10.5
+    np.testing.assert_array_equal(fields['centroid'], [1.25, -3.5])
+    assert parseMeasurement(MEASURE_ERROR) is None
+
+
+def test_textAndBinaryMeasurementsMatch():
+    # Same seed, so both devices see exactly the same samples
+    textSamples = device().getMeasurements(20)
+    binarySamples = device(binary=True).getMeasurements(20)
+
+    assert textSamples.dtype == binarySamples.dtype
+    np.testing.assert_array_equal(textSamples, binarySamples)
+
+
+def test_binaryFrameHeaderIsChecked():
+    bp2Device = device(binary=True)
+    # A frame of raw profiles, which starts with a different header
+    bp2Device._pipeCon.write('profiles 2')
+
+    with pytest.raises(Exception, match='Invalid measurement frame'):
+        bp2Device._readFrame(2)
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+import Utils
+from Utils import Deadline, runWithDeadline
+
+
+@pytest.fixture
+def release():
+    # Set at the end of each test, so that whatever it left stuck can finish
+    release = threading.Event()
+    yield release
+    release.set()
+    for thread in list(Utils._stuckThreads):
+        thread.join(1)
+    Utils._stuckThreads.clear()
+
+
+def test_returnsResult():
+    assert runWithDeadline(lambda a, b=0: a + b, 1, 2, b=3) == 5
+
+
+def test_passesOnExceptions():
+    def fail():
+        raise TimeoutError('from func')
+
+    with pytest.raises(TimeoutError, match='from func'):
+        runWithDeadline(fail, 1)
+
+
+def test_cleanupUnblocksCall(release):
+    unblock = threading.Event()
+    with pytest.raises(TimeoutError):
+        runWithDeadline(unblock.wait, .05, cleanup=[unblock.set])
+
+    for thread in list(Utils._stuckThreads):
+        thread.join(1)
+    assert not any(thread.is_alive() for thread in Utils._stuckThreads)
+
+
+def test_deadlineIsCancelled(release):
+    deadline = Deadline(.05)
+    with pytest.raises(TimeoutError):
+        runWithDeadline(release.wait, deadline)
+
+    assert deadline.expired()
+
+
+def test_stuckCallsDontBlockOthers(release):
+    # More than any fixed number of workers would allow
+    for i in range(Utils.MAX_STUCK_CALLS - 1):
+        with pytest.raises(TimeoutError):
+            runWithDeadline(release.wait, .01)
+
+    assert runWithDeadline(lambda: 'ran', 1) == 'ran'
+
+
+def test_tooManyStuckCalls(release):
+    for i in range(Utils.MAX_STUCK_CALLS):
+        with pytest.raises(TimeoutError):
+            runWithDeadline(release.wait, .01)
+
+    with pytest.raises(RuntimeError, match='stuck'):
+        runWithDeadline(lambda: 'ran', 1)
+
+    # Once they finish, calls can be made again
+    release.set()
+    for thread in list(Utils._stuckThreads):
+        thread.join(1)
+    assert runWithDeadline(lambda: 'ran', 1) == 'ran'